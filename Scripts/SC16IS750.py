@@ -1,5 +1,7 @@
 import sys
 import time
+import threading
+import collections
 import pigpio
 
 # General Registers (Require LCR[7] = 0)
@@ -189,6 +191,75 @@ EFCR_TX_DISABLE     = 0x01 << 2
 EFCR_RX_DISABLE     = 0x01 << 1
 EFCR_RS485_ENABLE   = 0x01 << 0
 
+# Depth of the RX and TX FIFOs in bytes
+FIFO_SIZE = 64
+
+# LCR value that opens the enhanced register set (EFR, XON, XOFF)
+LCR_ENHANCED_ACCESS = 0xBF
+
+# Configuration register values after a software reset, used to seed the driver's shadow copy
+# DLL and DLH are undefined after reset, so they are always written the first time
+SHADOW_RESET = {'LCR': 0x1D, 'MCR': 0x00, 'IER': 0x00, 'FCR': 0x00, 'EFR': 0x00, 'TLR': 0x00, 'TCR': 0x00, 'DLL': None, 'DLH': None}
+
+# Shadowed registers that live in the general register set
+SHADOW_GENERAL = {REG_LCR: 'LCR', REG_MCR: 'MCR', REG_IER: 'IER'}
+
+# MCR and IER bits that can only be changed with EFR[4] set
+MCR_ENHANCED_BITS = MCR_PRESCALER_4 | MCR_IRDA | MCR_XON_ANY | MCR_TCR_TLR
+IER_ENHANCED_BITS = IER_CTS | IER_RTS | IER_XOFF | IER_SLEEP
+
+# TLR and TCR levels are programmed in steps of 4 bytes
+FIFO_LEVEL_STEP = 4
+
+# Characters the far end may still send after RTS is deasserted (its TX shift register plus reaction time)
+FLOW_CONTROL_PEER_LAG = 4
+
+# Largest relative baud rate error between the two ends that still samples reliably
+BAUD_TOLERANCE = 0.02
+
+# The WTC sends packets in chunks of this many bytes, which is the slot size of an RXRing
+CHUNK_SIZE = 32
+
+# Clock of the Pi's I2C bus, used to work out how long a transaction holds it
+I2C_CLOCK = 400000
+
+# Most bytes write_all puts in one transaction. A burst of a whole FIFO holds the bus for about 1.5 ms
+# at 400 kHz, during which an RX round can't start, so bursts are kept to half that
+TX_BURST = 32
+
+# Round a FIFO level down to the 4 byte granularity of TLR/TCR and clamp it to [low, high]
+def fifo_level(level, low = 0, high = FIFO_SIZE - FIFO_LEVEL_STEP):
+	level = int(level) // FIFO_LEVEL_STEP * FIFO_LEVEL_STEP
+	return max(low, min(high, level))
+
+# Longest time (s) one write_all transaction holds the bus: address, THR and the burst, then TXLVL written and read back
+def tx_hold_time(burst = TX_BURST, clock = I2C_CLOCK):
+	return 9 * (burst + 6) / clock
+
+# Compute (RX trigger, RTS halt, RTS resume) FIFO levels for a baud rate and expected IRQ service latency
+# Halt leaves room for the characters the far end sends after RTS drops,
+# the RX trigger fires early enough that the Pi normally drains the FIFO before halt is reached,
+# and resume sits halfway to halt so RTS does not flap
+# In full duplex the RX round can also have to wait for a TX burst that already has the bus, so that is added to latency
+def flow_control_levels(baudrate, latency, charbits = 10, tx_burst = TX_BURST, i2c_clock = I2C_CLOCK):
+	latency += tx_hold_time(tx_burst, i2c_clock)
+	in_latency = -(-latency * baudrate // charbits) # Characters that arrive while the IRQ waits for service
+	halt = fifo_level(FIFO_SIZE - FLOW_CONTROL_PEER_LAG, FIFO_LEVEL_STEP)
+	trigger = fifo_level(halt - in_latency, FIFO_LEVEL_STEP, halt - FIFO_LEVEL_STEP)
+	resume = fifo_level(halt // 2, 0, halt - FIFO_LEVEL_STEP)
+	return (trigger, halt, resume)
+
+# TLR value for RX/TX trigger levels in bytes (0 leaves that trigger to FCR)
+def tlr_value(rx = 0, tx = 0):
+	return (fifo_level(rx) // FIFO_LEVEL_STEP) << 4 | (fifo_level(tx) // FIFO_LEVEL_STEP)
+
+# TCR value for RTS halt/resume levels in bytes (halt must be above resume)
+def tcr_value(halt, resume):
+	halt = fifo_level(halt)
+	resume = fifo_level(resume)
+	if halt <= resume: raise ValueError("RTS halt level must be above the resume level")
+	return (resume // FIFO_LEVEL_STEP) << 4 | (halt // FIFO_LEVEL_STEP)
+
 # Define pigpio i2c_zip constants
 I2C_END     = 0x00 # No more commands
 I2C_ESCAPE  = 0x01 # Next P is two bytes
@@ -208,44 +279,111 @@ class SC16IS750:
 	databits = None
 	stopbits = None
 	parity = None
+	rxpending = None
+	rxstream = None
+	rxier = 0 # RX interrupt enables masked by hold_rx
+	shadow = None
+	channel = 0
+	capture = None # qpaceCapture.Capture to record every byte read from RHR and written to THR
+	tx_burst = TX_BURST # Most bytes written to THR in one transaction
+	rxidle = None  # Cleared by the IRQLine from the IRQ edge until the RX round is done, write_all waits on it
 
-	def __init__(self, pi, i2cbus = 1, i2caddr = 0x48, xtalfreq = 11059200, baudrate = 115200, databits = LCR_DATABITS_8, stopbits = LCR_STOPBITS_1, parity = LCR_PARITY_NONE):
+	# config takes extra register values (e.g. {'fcr': ..., 'ier': ...}) to set in the same transaction as the UART setup
+	# channel selects UART A (0) or B (1) on an SC16IS752. Both channels share the software reset,
+	# so pass reset = False when opening the second channel of a chip that is already running
+	def __init__(self, pi, i2cbus = 1, i2caddr = 0x48, xtalfreq = 11059200, baudrate = 115200, databits = LCR_DATABITS_8, stopbits = LCR_STOPBITS_1, parity = LCR_PARITY_NONE, config = None, channel = 0, reset = True):
 
 		self.pi = pi
 		self.i2c = pi.i2c_open(i2cbus, i2caddr)
+		self.channel = channel
 		self.xtalfreq = xtalfreq
 		self.baudrate = baudrate
 		self.databits = databits
 		self.stopbits = stopbits
 		self.parity = parity
+		self.rxpending = bytearray()
+		self.rxidle = threading.Event()
+		self.rxidle.set()
 
-		self.reset()
-		self.init_uart()
+		if reset: self.reset()
+		else: self.shadow = dict(SHADOW_RESET)
+		self.init_uart(**(config or {}))
 
 	def inWaiting(self):
-		return self.byte_read(REG_RXLVL)
+		if self.rxstream is not None: return len(self.rxpending) + self.rxstream.available()
+		return len(self.rxpending) + self.byte_read(REG_RXLVL)
+
+	# Block until num bytes can be read or the timeout expires
+	# Return True if the bytes are available
+	def wait(self, num = 1, timeout = None):
+		if self.rxstream is not None:
+			return self.rxstream.wait(num - len(self.rxpending), timeout)
+		deadline = None if timeout is None else time.monotonic() + timeout
+		while self.inWaiting() < num:
+			if deadline is not None and time.monotonic() > deadline: return False
+			time.sleep(self.char_time() * FIFO_SIZE / 4)
+		return True
+
+	# Return whatever has been received, waiting up to timeout for at least one byte
+	# With an RXEngine attached this is one burst as serviced by the engine
+	def read_some(self, timeout = None):
+		if len(self.rxpending) > 0:
+			out = self.rxpending
+			self.rxpending = bytearray()
+			return out
+		if self.rxstream is not None:
+			return self.rxstream.readsegment(timeout) or bytearray()
+		if not self.wait(1, timeout): return bytearray()
+		return self.drain()
+
+	# Put bytes back in front of whatever is read next, e.g. ones a handshake read that were not part of it
+	def unread(self, data):
+		self.rxpending[:0] = data
+
+	# Fill buf with received bytes, waiting up to timeout (0 only takes what is already there)
+	# Return number of bytes placed in buf
+	def read_into(self, buf, timeout = None):
+		view = memoryview(buf).cast('B')
+		count = min(len(self.rxpending), len(view))
+		view[:count] = self.rxpending[:count]
+		del self.rxpending[:count]
+		deadline = None if timeout is None else time.monotonic() + timeout
+		while count < len(view):
+			# Past the deadline there is still one read of whatever has already arrived
+			remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+			if self.rxstream is not None:
+				count += self.rxstream.readinto(view[count:], remaining)
+			elif self.wait(1, remaining):
+				count += self.drain(view[count:])
+			if remaining == 0: break
+		return count
 
 	def read(self, num):
 		sys.stdout.write("Waiting for %d bytes ... " % num)
 		sys.stdout.flush()
-		while self.inWaiting() < num: pass
+		out = bytearray(num)
+		self.read_into(out)
 		print("done!")
-		return self.block_read(REG_RHR, num)
+		return out
 
 	def readline(self):
-		out = bytearray()
-		char = None
+		out = self.rxpending
+		self.rxpending = bytearray()
 		sys.stdout.write("Waiting for newline ... ")
 		sys.stdout.flush()
-		while char != 0x0A and char != 0x0D:
-			if self.inWaiting() > 0:
-				char = self.byte_read(REG_RHR)
-				out.append(char)
+		end = -1
+		while end < 0:
+			ends = [i for i in (out.find(b'\n'), out.find(b'\r')) if i >= 0]
+			if ends: end = min(ends)
+			else: out += self.read_some()
+		# Keep anything received after the newline for the next read
+		self.rxpending = out[end+1:]
+		del out[end+1:]
 		print("done!")
 		return out
 
 	def write(self, bytestring):
-		self.block_write(REG_THR, bytestring)
+		return self.write_all(bytestring)
 
 	def close(self):
 		self.pi.i2c_close(self.i2c)
@@ -271,12 +409,11 @@ class SC16IS750:
 		self.print_register(REG_EFCR,      "0x0F REG_EFCR:     ")
 
 	# Initialize UART settings
-	def init_uart(self):
-		s1, v1 = self.byte_write_verify(REG_LCR, LCR_DIVISOR_ENABLE)
-		s2, v2 = self.set_divisor_latch(MCR_PRESCALER_1)
+	# Divisor latch and line settings (plus any extra registers) go out in one verified transaction
+	def init_uart(self, **registers):
 		lcr = self.databits | self.stopbits | self.parity
-		s3, v3 = self.byte_write_verify(REG_LCR, lcr)
-		if not (s1 and s2 and s3):
+		success, values = self.configure(verify = True, lcr = lcr, divisor = self.divisor(MCR_PRESCALER_1), **registers)
+		if not success:
 			print("Error setting up UART port!")
 			sys.exit(1)
 
@@ -284,6 +421,7 @@ class SC16IS750:
 	def reset(self):
 		try: self.byte_write(REG_IOCONTROL, IOCONTROL_SOFTWARE_RESET)
 		except pigpio.error: pass
+		self.shadow = dict(SHADOW_RESET)
 
 	# Write some test patterns to the scratchpad and verify receipt
 	def scratchpad_test(self):
@@ -292,15 +430,110 @@ class SC16IS750:
 		t3b, t3v = self.byte_write_verify(REG_SPR, 0x00)
 		return t1b and t2b and t3b
 
-	# Compute required divider values for DLH and DLL registers
+	# Compute required divider value for DLH and DLL registers
+	def divisor(self, prescaler = MCR_PRESCALER_1, baudrate = None):
+		prescaler = 4 if prescaler == MCR_PRESCALER_4 else 1
+		return round(self.xtalfreq/(prescaler*(baudrate or self.baudrate)*16))
+
+	# Relative error between a baud rate and the closest rate the divisor latch can produce
+	# Return None if the rate is out of the divisor's range
+	def baud_error(self, baudrate, prescaler = MCR_PRESCALER_1):
+		divisor = self.divisor(prescaler, baudrate)
+		if divisor < 1 or divisor > 0xFFFF: return None
+		actual = self.xtalfreq/((4 if prescaler == MCR_PRESCALER_4 else 1)*divisor*16)
+		return abs(actual - baudrate)/baudrate
+
+	# Switch the line to a new baud rate, resetting both FIFOs in the same transaction
+	# Anything still in the FIFOs was framed at the old rate, so the caller should let TX empty first (wait_tx_empty)
+	# Return boolean success of the readback
+	def set_baudrate(self, baudrate):
+		error = self.baud_error(baudrate)
+		if error is None or error > BAUD_TOLERANCE:
+			raise ValueError("baud rate " + str(baudrate) + " can not be generated from a " + str(self.xtalfreq) + " Hz crystal")
+		fcr = self.shadow['FCR'] | FCR_TX_FIFO_RESET | FCR_RX_FIFO_RESET
+		success, values = self.configure(verify = True, divisor = self.divisor(MCR_PRESCALER_1, baudrate), fcr = fcr)
+		self.baudrate = baudrate
+		self.rxpending = bytearray()
+		if self.rxstream is not None: self.rxstream.flush()
+		return success
+
+	# Program DLH and DLL, switching LCR[7] in the same transaction
 	# Return tuple indicating (boolean success, new values in registers)
 	def set_divisor_latch(self, prescaler = MCR_PRESCALER_1):
-		prescaler = 4 if prescaler == MCR_PRESCALER_4 else 1
-		div = round(self.xtalfreq/(prescaler*self.baudrate*16))
-		dlh, dll = divmod(div, 0x100)
-		dlhb, dlhv = self.byte_write_verify(REG_DLH, dlh)
-		dllb, dllv = self.byte_write_verify(REG_DLL, dll)
-		return (dlhb and dllb, (dlhv<<8)|dllv)
+		success, values = self.configure(verify = True, divisor = self.divisor(prescaler))
+		return (success, (self.shadow['DLH']<<8)|self.shadow['DLL'])
+
+	# Write any of the shadowed configuration registers in a single i2c_zip
+	# Registers are given by name (lcr, mcr, ier, fcr, efr, tlr, tcr, dll, dlh) or divisor for DLL/DLH together
+	# Only registers that differ from the shadow copy are written unless force is set; FCR is always written
+	# LCR is switched to 0xBF for EFR, to LCR[7] = 1 for DLL/DLH, and MCR[2] is set around TLR/TCR, then restored
+	# With verify, each readable register is read back inside the same transaction
+	# Return tuple indicating (boolean success, {register name: value read back})
+	def configure(self, verify = False, force = False, divisor = None, **registers):
+		if divisor is not None:
+			registers['dlh'], registers['dll'] = divmod(divisor, 0x100)
+		new = dict(self.shadow)
+		given = set()
+		for name, value in registers.items():
+			name = name.upper()
+			if name not in SHADOW_RESET: raise ValueError("unknown configuration register " + name)
+			if value is None: continue
+			new[name] = value & 0xFF
+			given.add(name)
+		# TLR, TCR and the upper MCR and IER bits are locked unless enhanced functions are enabled
+		if given & {'TLR', 'TCR'} or new['MCR'] & MCR_ENHANCED_BITS or new['IER'] & IER_ENHANCED_BITS:
+			if not new['EFR'] & EFR_ENHANCED_FUNCTIONS_ENABLE:
+				new['EFR'] |= EFR_ENHANCED_FUNCTIONS_ENABLE
+				given.add('EFR')
+		changed = [name for name in given if name == 'FCR' or force or new[name] != self.shadow[name]]
+		if not changed: return (True, {})
+
+		cmds = []
+		checks = []
+		state = {'LCR': self.shadow['LCR'], 'MCR': self.shadow['MCR']}
+		# track names the LCR or MCR write so temporary bank switches are always restored
+		def write(name, reg, value, readable = True, track = None):
+			cmds.extend([I2C_WRITE, 2, self.reg_conv(reg), value])
+			if track is not None: state[track] = value
+			if verify and readable:
+				cmds.extend([I2C_WRITE, 1, self.reg_conv(reg), I2C_READ, 1])
+				checks.append((name, value))
+
+		if 'EFR' in changed:
+			write(None, REG_LCR, LCR_ENHANCED_ACCESS, False, 'LCR')
+			write('EFR', REG_EFR, new['EFR'])
+		if 'DLL' in changed or 'DLH' in changed:
+			if new['LCR'] | LCR_DIVISOR_ENABLE == LCR_ENHANCED_ACCESS:
+				raise ValueError("LCR value would select the enhanced register set instead of the divisor latch")
+			write(None, REG_LCR, new['LCR'] | LCR_DIVISOR_ENABLE, False, 'LCR')
+			if 'DLL' in changed: write('DLL', REG_DLL, new['DLL'])
+			if 'DLH' in changed: write('DLH', REG_DLH, new['DLH'])
+		general = [name for name in ('FCR', 'IER', 'MCR', 'TLR', 'TCR') if name in changed]
+		if general and state['LCR'] != new['LCR'] & ~LCR_DIVISOR_ENABLE:
+			write(None, REG_LCR, new['LCR'] & ~LCR_DIVISOR_ENABLE, False, 'LCR')
+		if 'FCR' in changed:
+			write('FCR', REG_FCR, new['FCR'], False)
+			# FIFO reset bits clear themselves
+			new['FCR'] &= ~(FCR_TX_FIFO_RESET | FCR_RX_FIFO_RESET)
+		if 'IER' in changed: write('IER', REG_IER, new['IER'])
+		if 'TLR' in changed or 'TCR' in changed:
+			write(None, REG_MCR, new['MCR'] | MCR_TCR_TLR, False, 'MCR')
+			if 'TLR' in changed: write('TLR', REG_TLR, new['TLR'])
+			if 'TCR' in changed: write('TCR', REG_TCR, new['TCR'])
+		if state['MCR'] != new['MCR'] or 'MCR' in changed: write('MCR', REG_MCR, new['MCR'], True, 'MCR')
+		if state['LCR'] != new['LCR'] or 'LCR' in changed: write('LCR', REG_LCR, new['LCR'], True, 'LCR')
+
+		n, d = self.pi.i2c_zip(self.i2c, cmds + [I2C_END])
+		if n < 0: raise pigpio.error(pigpio.error_text(n))
+		elif n != len(checks): raise ValueError("unexpected number of bytes received")
+		values = {}
+		for (name, value), readback in zip(checks, d):
+			values[name] = int(readback)
+		success = all(values[name] == value for name, value in checks)
+		for name in changed:
+			# Trust the chip over the intended value when they disagree
+			self.shadow[name] = values.get(name, new[name])
+		return (success, values)
 
 	# Retreive interrupt status (IIR[5:0])
 	def get_interrupt_status(self):
@@ -311,15 +544,144 @@ class SC16IS750:
 		# Mask out two MSBs in IIR value and return tuple
 		return (int(d[0]) & 0x3F, int(d[1]), int(d[2]))
 
+	# Drain the RX FIFO using as few I2C transactions as possible
+	# Each transaction reads the bytes reported by the last RXLVL read followed by a fresh RXLVL
+	# Pass waiting if RXLVL is already known (e.g. from get_interrupt_status) to skip the first read
+	# passes caps the number of transactions, so a stream that keeps arriving can't hold the bus forever
+	# Return bytearray of data, or number of bytes written if buf (bytearray or memoryview) is given
+	def drain(self, buf = None, waiting = None, passes = None):
+		if buf is None:
+			out = bytearray()
+			limit = None
+		else:
+			out = memoryview(buf).cast('B')
+			limit = len(out)
+		count = 0
+		if waiting is None: waiting = self.byte_read(REG_RXLVL)
+		while waiting > 0 and passes != 0:
+			if passes is not None: passes -= 1
+			if limit is not None:
+				waiting = min(waiting, limit - count)
+				if waiting == 0: break
+			n, d = self.pi.i2c_zip(self.i2c, [I2C_WRITE, 1, self.reg_conv(REG_RHR), I2C_READ, waiting, I2C_START, I2C_WRITE, 1, self.reg_conv(REG_RXLVL), I2C_READ, 1, I2C_END])
+			if n < 0: raise pigpio.error(pigpio.error_text(n))
+			elif n != waiting + 1: raise ValueError("all available bytes were not successfully read")
+			if buf is None: out += d[:waiting]
+			else: out[count:count+waiting] = d[:waiting]
+			if self.capture is not None: self.capture.rx(d[:waiting])
+			count += waiting
+			waiting = int(d[waiting])
+		return out if buf is None else count
+
+	# Read waiting bytes from RHR straight into buf (bytearray or memoryview) along with a fresh RXLVL, in one transaction
+	# Return the new RXLVL
+	def read_rhr(self, buf, waiting):
+		n, d = self.pi.i2c_zip(self.i2c, [I2C_WRITE, 1, self.reg_conv(REG_RHR), I2C_READ, waiting, I2C_START, I2C_WRITE, 1, self.reg_conv(REG_RXLVL), I2C_READ, 1, I2C_END])
+		if n < 0: raise pigpio.error(pigpio.error_text(n))
+		elif n != waiting + 1: raise ValueError("all available bytes were not successfully read")
+		buf[:waiting] = d[:waiting]
+		if self.capture is not None: self.capture.rx(d[:waiting])
+		return int(d[waiting])
+
+	# Stream bytes into the TX FIFO without overrunning it
+	# Each transaction writes as many bytes as TXLVL reported free, at most tx_burst, and reads back the new TXLVL
+	# While the FIFO is full, sleep for roughly the time it takes to send a quarter of it
+	# While an RX round is pending the next burst waits for it (at most as long), so RX never queues behind a run of TX bursts
+	# Return number of bytes written (fewer than requested only if the timeout expired)
+	def write_all(self, bytestring, timeout = None):
+		data = memoryview(bytestring).cast('B')
+		deadline = None if timeout is None else time.monotonic() + timeout
+		sent = 0
+		space = self.byte_read(REG_TXLVL) if len(data) > 0 else 0
+		while sent < len(data):
+			if space == 0:
+				if deadline is not None and time.monotonic() > deadline: break
+				time.sleep(self.char_time() * FIFO_SIZE / 4)
+				space = self.byte_read(REG_TXLVL)
+				continue
+			if not self.rxidle.is_set(): self.rxidle.wait(self.char_time() * FIFO_SIZE / 4)
+			chunk = data[sent:sent+min(space, self.tx_burst)]
+			n, d = self.pi.i2c_zip(self.i2c, [I2C_WRITE, len(chunk)+1, self.reg_conv(REG_THR)] + list(chunk) + [I2C_START, I2C_WRITE, 1, self.reg_conv(REG_TXLVL), I2C_READ, 1, I2C_END])
+			if n < 0: raise pigpio.error(pigpio.error_text(n))
+			elif n != 1: raise ValueError("unexpected number of bytes received")
+			if self.capture is not None: self.capture.tx(chunk)
+			sent += len(chunk)
+			space = int(d[0])
+		return sent
+
+	# Block until the TX FIFO and shift register are both empty (LSR[6]) or the timeout expires
+	# Return True if everything written has left the chip
+	def wait_tx_empty(self, timeout = None):
+		deadline = None if timeout is None else time.monotonic() + timeout
+		while not self.byte_read(REG_LSR) & LSR_THR_TSR_EMPTY:
+			if deadline is not None and time.monotonic() > deadline: return False
+			time.sleep(self.char_time() * FIFO_SIZE / 4)
+		return True
+
+	# Time in seconds to shift one character out at the current line settings
+	def char_time(self):
+		return self.char_bits()/self.baudrate
+
 	# Change single bit inside register
 	def enable_register_bit(self, reg, bit, enable):
 		if bit < 0 or bit > 7: return False
 		if enable not in [True, False]: return False
 
-		oldvalue = self.byte_read(reg)
+		# Shadowed registers need no bus read before the change
+		name = SHADOW_GENERAL.get(reg)
+		oldvalue = self.shadow[name] if name is not None else self.byte_read(reg)
 		if enable: newvalue = oldvalue |  (0x01 << bit)
 		else:      newvalue = oldvalue & ~(0x01 << bit)
-		return self.byte_write_verify(REG_LCR, newvalue)
+		if name is None: return self.byte_write_verify(reg, newvalue)
+		success, values = self.configure(verify = True, **{name.lower(): newvalue})
+		return (success, values.get(name, self.shadow[name]))
+
+	# Bits per character on the line, used to convert latency into FIFO bytes
+	def char_bits(self):
+		bits = 1 + 5 + (self.databits & 0x03) + (2 if self.stopbits == LCR_STOPBITS_2 else 1)
+		if self.parity != LCR_PARITY_NONE: bits += 1
+		return bits
+
+	# Set RX and TX trigger levels through TLR in 4 byte steps (4 to 60), None leaves a level unchanged
+	# FCR[7:6] is cleared when TLR takes over the RX trigger, as the datasheet requires
+	# Return tuple indicating (boolean success, {register name: value read back})
+	def set_trigger_levels(self, rx = None, tx = None):
+		tlr = self.shadow['TLR']
+		if rx is not None: tlr = (tlr & 0x0F) | tlr_value(rx = fifo_level(rx, FIFO_LEVEL_STEP))
+		if tx is not None: tlr = (tlr & 0xF0) | tlr_value(tx = fifo_level(tx, FIFO_LEVEL_STEP))
+		registers = {'tlr': tlr}
+		if tlr & 0xF0: registers['fcr'] = (self.shadow['FCR'] & ~(0x03 << 6)) | FCR_FIFO_ENABLE
+		return self.configure(verify = True, **registers)
+
+	# Enable automatic RTS/CTS flow control with levels derived from the baud rate and IRQ latency (seconds)
+	# The RX trigger, RTS halt/resume levels and EFR flow control bits are written in one transaction
+	# Return tuple indicating (boolean success, (RX trigger, halt, resume) in bytes)
+	def enable_flow_control(self, latency, rts = True, cts = True):
+		trigger, halt, resume = flow_control_levels(self.baudrate, latency, self.char_bits())
+		efr = self.shadow['EFR'] & ~(EFR_FLOW_CONTROL_RTS_ENABLE | EFR_FLOW_CONTROL_CTS_ENABLE)
+		if rts: efr |= EFR_FLOW_CONTROL_RTS_ENABLE
+		if cts: efr |= EFR_FLOW_CONTROL_CTS_ENABLE
+		tlr = (self.shadow['TLR'] & 0x0F) | tlr_value(rx = trigger)
+		fcr = (self.shadow['FCR'] & ~(0x03 << 6)) | FCR_FIFO_ENABLE
+		success, values = self.configure(verify = True, efr = efr | EFR_ENHANCED_FUNCTIONS_ENABLE, tcr = tcr_value(halt, resume), tlr = tlr, fcr = fcr)
+		return (success, (trigger, halt, resume))
+
+	def disable_flow_control(self):
+		efr = self.shadow['EFR'] & ~(EFR_FLOW_CONTROL_RTS_ENABLE | EFR_FLOW_CONTROL_CTS_ENABLE)
+		return self.configure(verify = True, efr = efr)
+
+	# Ask the far end to stop (hold True) or resume sending
+	# With auto RTS the TCR halt level drives RTS, so RX interrupts are masked and the FIFO is left to fill up to it
+	# Otherwise RTS is driven directly through MCR[1]
+	# Return tuple indicating (boolean success, {register name: value read back})
+	def hold_rx(self, hold):
+		if self.shadow['EFR'] & EFR_FLOW_CONTROL_RTS_ENABLE:
+			if hold:
+				self.rxier = self.shadow['IER'] & (IER_RX_READY | IER_RX_ERROR)
+				return self.configure(verify = True, ier = self.shadow['IER'] & ~self.rxier)
+			return self.configure(verify = True, ier = self.shadow['IER'] | self.rxier)
+		mcr = self.shadow['MCR'] & ~MCR_RTS if hold else self.shadow['MCR'] | MCR_RTS
+		return self.configure(verify = True, mcr = mcr)
 
 	# MCR[4]: True for local loopback enable, False for disable
 	def enable_local_loopback(self, enable):
@@ -341,6 +703,8 @@ class SC16IS750:
 	# Write I2C byte to specified register
 	def byte_write(self, reg, byte):
 		n, d = self.pi.i2c_zip(self.i2c, [I2C_WRITE, 2, self.reg_conv(reg), byte, I2C_END])
+		# Address 0 is the divisor latch rather than THR while LCR[7] is set
+		if reg == REG_THR and self.capture is not None and not self.shadow['LCR'] & LCR_DIVISOR_ENABLE: self.capture.tx(bytes([byte]))
 
 	# Read I2C byte from specified register
 	# Return byte received from driver
@@ -362,4 +726,383 @@ class SC16IS750:
 
 	# Convert register address given in datasheet to actual address on chip
 	def reg_conv(self, reg):
-		return reg << 3
\ No newline at end of file
+		return reg << 3 | self.channel << 1
+
+class RXStream:
+	"""
+	Receive stream for one chip, filled by an RXEngine and read by any number of consumers.
+	Data is kept in the bursts it arrived in so a consumer can either ask for a byte count
+	or take one burst at a time. Every read takes a timeout so nothing has to poll.
+	listener, if given, is called with the stream after every burst so one thread can wait on several streams.
+	"""
+
+	def __init__(self, listener = None):
+		self.cond = threading.Condition()
+		self.segments = collections.deque()
+		self.count = 0
+		self.listener = listener
+
+	# Drain the chip's RX FIFO into the stream as one burst
+	# Return number of bytes received
+	def receive(self, chip, waiting = None, passes = None):
+		data = chip.drain(waiting = waiting, passes = passes)
+		if len(data) > 0: self.push(data)
+		return len(data)
+
+	def push(self, data):
+		with self.cond:
+			self.segments.append(bytearray(data))
+			self.count += len(data)
+			self.cond.notify_all()
+		if self.listener is not None: self.listener(self)
+
+	def available(self):
+		return self.count
+
+	# Return True once num bytes are available, False if the timeout expired first
+	def wait(self, num = 1, timeout = None):
+		with self.cond:
+			return self.cond.wait_for(lambda: self.count >= num, timeout)
+
+	# Copy up to len(buf) bytes into buf, waiting up to timeout for all of them
+	# Return number of bytes copied
+	def readinto(self, buf, timeout = None):
+		view = memoryview(buf).cast('B')
+		with self.cond:
+			self.cond.wait_for(lambda: self.count >= len(view), timeout)
+			count = 0
+			while count < len(view) and self.segments:
+				segment = self.segments[0]
+				take = min(len(segment), len(view) - count)
+				view[count:count+take] = segment[:take]
+				if take == len(segment): self.segments.popleft()
+				else: del segment[:take]
+				count += take
+			self.count -= count
+			return count
+
+	def read(self, num, timeout = None):
+		out = bytearray(num)
+		del out[self.readinto(out, timeout):]
+		return out
+
+	# Return the oldest burst, or None if nothing arrived before the timeout
+	def readsegment(self, timeout = None):
+		with self.cond:
+			if not self.cond.wait_for(lambda: self.count > 0, timeout): return None
+			segment = self.segments.popleft()
+			self.count -= len(segment)
+			return segment
+
+	def flush(self):
+		with self.cond:
+			self.segments.clear()
+			self.count = 0
+
+class RXRing:
+	"""
+	Fixed capacity receive buffer for an RXEngine, allocated once: capacity slots of CHUNK_SIZE bytes.
+	The engine's thread is the only producer and one consumer thread reads, so the data path takes no
+	lock: the producer only ever advances head and the consumer tail, each with a single assignment.
+	Bytes are read from RHR straight into the slots. A slot is published once it is full or the read
+	left the FIFO empty, so a WTC chunk normally fills one slot and a lone state byte gets its own.
+	peek() hands the consumer a view of the slot itself, valid until release(). The RXStream reads
+	work too, so the chip's wait/read_into keep working with a ring attached.
+	With every slot taken, further bytes are still drained (the IRQ would never clear otherwise) but
+	dropped and counted in overflows. Once high slots would be in use by the bytes already received,
+	those still in the FIFO and the FLOW_CONTROL_PEER_LAG the far end sends after being told, it is asked
+	to hold off (SC16IS750.hold_rx), and that is lifted when the consumer is back down to low.
+	"""
+
+	def __init__(self, capacity = 64, high = None, low = None):
+		self.capacity = capacity
+		self.high = capacity * 3 // 4 if high is None else high
+		self.low = capacity // 4 if low is None else low
+		self.buffer = bytearray(capacity * CHUNK_SIZE)
+		self.view = memoryview(self.buffer)
+		self.lengths = [0] * capacity
+		self.stamps = [0.0] * capacity  # time.monotonic() each slot was published
+		self.edges = [0.0] * capacity   # time.monotonic() of the IRQ edge that started the round that read it
+		self.line = None                # IRQLine serving the ring, set by RXEngine
+		self.scratch = bytearray(FIFO_SIZE) # Where bytes go to be dropped while the ring is full
+		# Producer side
+		self.head = 0      # Slots published
+		self.fill = 0      # Bytes received past the last published slot
+		self.received = 0  # Bytes published
+		self.overflows = 0 # Bytes dropped because the ring was full
+		# Consumer side
+		self.tail = 0      # Slots released
+		self.taken = 0     # Bytes already read from the slot at tail
+		self.consumed = 0  # Bytes read
+		self.event = threading.Event() # Set after every publish
+		self.chip = None
+		self.held = False
+		self.holdlock = threading.Lock() # Only taken to start or lift a hold
+		self.holds = 0     # Times the far end was asked to hold off
+
+	# Drain the chip's RX FIFO into free slots
+	# One transaction reads as much as fits before the ring wraps, so a burst costs no more transactions than drain()
+	# Return number of bytes received, including any dropped
+	def receive(self, chip, waiting = None, passes = None):
+		self.chip = chip
+		if waiting is None: waiting = chip.byte_read(REG_RXLVL)
+		count = 0
+		while waiting > 0 and passes != 0:
+			if passes is not None: passes -= 1
+			free = self.capacity - (self.head - self.tail)
+			if free == 0:
+				take = min(waiting, FIFO_SIZE)
+				rest = chip.read_rhr(self.scratch, take)
+				self.overflows += take
+			else:
+				index = self.head % self.capacity
+				start = index * CHUNK_SIZE + self.fill
+				take = min(waiting, min(free, self.capacity - index) * CHUNK_SIZE - self.fill)
+				rest = chip.read_rhr(self.view[start:start+take], take)
+				self.fill += take
+				while self.fill >= CHUNK_SIZE: self.publish(CHUNK_SIZE)
+				if rest == 0 and self.fill > 0: self.publish(self.fill)
+				# Everything still in the FIFO and on its way lands in the ring too, so count the slots it will take
+				if not self.held and self.head - self.tail + -(-(self.fill + rest + FLOW_CONTROL_PEER_LAG) // CHUNK_SIZE) >= self.high: self.hold(True)
+			count += take
+			waiting = rest
+			# With auto RTS the hold masks the RX interrupts instead. The rest stays in the FIFO, where the chip halts the far end
+			if self.held and not chip.shadow['IER'] & IER_RX_READY: break
+		return count
+
+	# Publish the next length bytes as one slot; the length is stored before head moves so the consumer never sees it stale
+	def publish(self, length):
+		index = self.head % self.capacity
+		self.lengths[index] = length
+		self.stamps[index] = time.monotonic()
+		edge = self.line.servicedtime if self.line is not None else None
+		self.edges[index] = edge or self.stamps[index] # No edge for a round run without one, e.g. when the engine starts
+		self.fill -= length
+		self.received += length
+		self.head += 1
+		self.event.set()
+
+	def hold(self, hold):
+		with self.holdlock:
+			if self.held == hold or self.chip is None: return
+			self.held = hold
+			if hold: self.holds += 1
+			self.chip.hold_rx(hold)
+
+	# Number of bytes waiting to be read
+	def available(self):
+		return self.received - self.consumed
+
+	# Number of slots waiting to be released
+	def slots(self):
+		return self.head - self.tail
+
+	# Return True once num bytes are available, False if the timeout expired first
+	def wait(self, num = 1, timeout = None):
+		deadline = None if timeout is None else time.monotonic() + timeout
+		while self.available() < num:
+			# Clear, then check again, so a publish between the two is never missed
+			self.event.clear()
+			if self.available() >= num: break
+			remaining = None if deadline is None else deadline - time.monotonic()
+			if remaining is not None and remaining <= 0: return False
+			self.event.wait(remaining)
+		return True
+
+	# Return a memoryview of the unread part of the oldest slot, or None if nothing arrived before the timeout
+	# The view points into the ring and is only valid until release()
+	def peek(self, timeout = None):
+		if not self.wait(1, timeout): return None
+		index = self.tail % self.capacity
+		start = index * CHUNK_SIZE
+		return self.view[start+self.taken:start+self.lengths[index]]
+
+	# Return (time of the IRQ edge, time published) of the oldest slot, both from time.monotonic()
+	def times(self):
+		index = self.tail % self.capacity
+		return self.edges[index], self.stamps[index]
+
+	# Hand the oldest slot back to the producer
+	def release(self):
+		index = self.tail % self.capacity
+		self.consumed += self.lengths[index] - self.taken
+		self.taken = 0
+		self.tail += 1
+		if self.held and self.head - self.tail <= self.low: self.hold(False)
+
+	# Copy up to len(buf) bytes into buf, waiting up to timeout for all of them
+	# Return number of bytes copied
+	def readinto(self, buf, timeout = None):
+		view = memoryview(buf).cast('B')
+		self.wait(len(view), timeout)
+		count = 0
+		while count < len(view) and self.available() > 0:
+			slot = self.peek(0)
+			take = min(len(slot), len(view) - count)
+			view[count:count+take] = slot[:take]
+			count += take
+			if take == len(slot): self.release()
+			else:
+				self.taken += take
+				self.consumed += take
+		return count
+
+	def read(self, num, timeout = None):
+		out = bytearray(num)
+		del out[self.readinto(out, timeout):]
+		return out
+
+	# Return a copy of the oldest slot, or None if nothing arrived before the timeout
+	def readsegment(self, timeout = None):
+		slot = self.peek(timeout)
+		if slot is None: return None
+		segment = bytearray(slot)
+		self.release()
+		return segment
+
+	# Discard everything published so far (consumer side only)
+	def flush(self):
+		while self.tail != self.head: self.release()
+
+class IRQLine:
+	"""
+	One IRQ GPIO and the RX engines wired to it, split into a top and a bottom half.
+	The pigpio callback (top half) only records the tick of the edge and wakes the line's thread.
+	The thread (bottom half) services the engines, so pigpio's single callback thread never waits
+	on the bus and a long burst on one chip can't hold up the IRQs of every other chip.
+	Edges that arrive while the thread is busy are coalesced into one more round. Each round goes on
+	until a full pass over the engines finds nothing pending, which is also what lets both channels of
+	an SC16IS752 share one IRQ: it only rises again once neither channel needs service.
+	"""
+
+	def __init__(self, pi, gpio):
+		self.pi = pi
+		self.gpio = gpio
+		self.engines = []
+		self.running = True
+		self.event = threading.Event()
+		self.tick = None     # pigpio tick of the oldest edge not yet serviced
+		self.serviced = None # pigpio tick of the edge that started the latest round
+		self.edgetime = None # time.monotonic() when the callback saw that oldest edge, for comparing with other stages
+		self.servicedtime = None
+		self.edges = 0
+		self.coalesced = 0   # Edges that found a round already pending
+		self.thread = threading.Thread(target = self.run, name = 'irq-' + str(gpio), daemon = True)
+		self.thread.start()
+		pi.set_mode(gpio, pigpio.INPUT)
+		self.callback = pi.callback(gpio, pigpio.FALLING_EDGE, self.handler)
+
+	# The line may already be low if data arrived before the engine was added, so run a round either way
+	def add(self, engine):
+		self.engines.append(engine)
+		self.event.set()
+
+	def handler(self, gpio, level, tick):
+		for engine in self.engines: engine.chip.rxidle.clear() # Hold off TX bursts until the round is done
+		if self.tick is None:
+			self.tick = tick
+			self.edgetime = time.monotonic()
+		elif self.event.is_set(): self.coalesced += 1
+		self.edges += 1
+		self.event.set()
+
+	def run(self):
+		while True:
+			self.event.wait()
+			self.event.clear()
+			if not self.running: return
+			self.serviced = self.tick
+			self.servicedtime = self.edgetime
+			self.tick = None
+			try:
+				# Not bounded like RXEngine.service: giving up with a cause pending would leave the line low with no edge to come
+				while sum(engine.service(1) for engine in list(self.engines)) > 0: pass
+			except (pigpio.error, ValueError) as err:
+				# A failed transaction must not end the thread; the next edge tries again
+				print("IRQ line " + str(self.gpio) + ": " + str(err))
+			finally:
+				# An edge during the round means another one is due, so TX keeps waiting for that
+				if not self.event.is_set():
+					for engine in list(self.engines): engine.chip.rxidle.set()
+
+	def close(self):
+		self.callback.cancel()
+		self.running = False
+		for engine in self.engines: engine.chip.rxidle.set() # No round is coming to release TX
+		self.event.set()
+		if self.thread is not threading.current_thread(): self.thread.join()
+
+class RXEngine:
+	"""
+	Interrupt driven receiver for one chip. Serviced from an IRQLine thread after a falling edge
+	of the chip's IRQ line, it reads IIR, LSR and RXLVL in one transaction and services each cause
+	until IIR reports nothing pending. Received bytes go to the sink, an RXStream unless one is supplied (e.g. an RXRing).
+	A sink only needs a receive(chip, waiting, passes) method that drains the FIFO.
+	passes limits the RHR reads per cause (None drains until the FIFO is empty); whatever is left
+	keeps the interrupt pending, so service() or the next call picks it up.
+	With gpio None the engine gets no IRQLine of its own and the owner of the IRQ line calls service()
+	or adds it to a shared IRQLine, as for the two channels of an SC16IS752.
+	"""
+
+	def __init__(self, pi, chip, gpio, sink = None, passes = None):
+		self.pi = pi
+		self.chip = chip
+		self.gpio = gpio
+		self.passes = passes
+		self.sink = sink if sink is not None else RXStream()
+		self.lock = threading.Lock()
+		# Line error counters, indexed by LSR bit name
+		self.errors = {'overflow': 0, 'parity': 0, 'framing': 0, 'break': 0}
+		if isinstance(self.sink, (RXStream, RXRing)): chip.rxstream = self.sink
+
+		self.line = None
+		if gpio is not None:
+			self.line = IRQLine(pi, gpio)
+			if isinstance(self.sink, RXRing): self.sink.line = self.line
+			self.line.add(self)
+		else:
+			# The line may already be low if data arrived before the owner starts servicing
+			self.service()
+
+	@property
+	def stream(self):
+		return self.sink
+
+	# Service up to causes interrupts, stopping early once none are pending
+	# Bounded so a cause we do not clear can never hang the IRQ thread
+	# Return number of interrupts serviced
+	def service(self, causes = FIFO_SIZE):
+		serviced = 0
+		with self.lock:
+			for attempt in range(causes):
+				iir, lsr, rxlvl = self.chip.get_interrupt_status()
+				if iir & IIR_NONE: break
+				serviced += 1
+				cause = iir & 0x3E
+				if cause == IIR_RX_ERROR:
+					self.rx_error(lsr, rxlvl)
+				elif cause == IIR_RX_READY:
+					# Trigger level reached, more of the burst is probably still arriving
+					self.sink.receive(self.chip, rxlvl, self.passes)
+				elif cause == IIR_RX_TIMEOUT:
+					# Line went idle with data below the trigger level: the end of a burst
+					self.sink.receive(self.chip, rxlvl, self.passes)
+				elif cause == IIR_MODEM:
+					self.chip.byte_read(REG_MSR)
+				elif cause == IIR_GPIO:
+					self.chip.byte_read(REG_IOSTATE)
+				# TX ready, XOFF and CTS/RTS are cleared by the IIR read itself
+		return serviced
+
+	# LSR error bits describe the byte at the top of the FIFO, so count them and keep the data
+	# Checksums further up the stack decide whether the frame is usable
+	def rx_error(self, lsr, rxlvl):
+		if lsr & LSR_OVERFLOW_ERROR:  self.errors['overflow'] += 1
+		if lsr & LSR_PARITY_ERROR:    self.errors['parity'] += 1
+		if lsr & LSR_FRAMING_ERROR:   self.errors['framing'] += 1
+		if lsr & LSR_BREAK_INTERRUPT: self.errors['break'] += 1
+		if rxlvl > 0: self.sink.receive(self.chip, rxlvl, self.passes)
+
+	def stop(self):
+		if self.line is not None: self.line.close()
+		if self.chip.rxstream is self.sink: self.chip.rxstream = None
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# qpaceARQ.py
+# Q-Pace project, Center for Microgravity Research
+# University of Central Florida
+#
+# Selective-repeat ARQ for file transfers. The sender keeps up to a window of pids outstanding
+# instead of waiting a round trip after every few packets. The receiver answers with ACK frames
+# holding a cumulative ack (every pid below base has arrived) and a NAK bitmap of the pids after
+# base that are still missing, and only those are sent again. A pid is resent early when an ACK
+# shows that a pid sent after it arrived (the link keeps frames in order, so it was lost), or when
+# its retransmission timer runs out. The timer follows the measured round trip time the way TCP's
+# does (RFC 6298): smoothed RTT plus four times its variation, doubled on every timeout, and only
+# taken from pids that were sent once (Karn's rule).
+#
+# Only the protocol state is kept here, qpaceFileHandler.Transmitter and Receiver move the frames.
+#
+# Usage:
+#	window = SendWindow(first, last)
+#	while not window.done():
+#		for pid in window.ready(): send(pid); window.sent(pid, time.monotonic())
+#		ack = decodeAck(frame)          # None if frame is not an ACK
+#		for pid in window.ack(*ack, now) + window.expired(now): send(pid); window.sent(pid, now)
+#
+#	chip.write_all(encodeAck(route, base, count, have))
+
+import qpaceCodec as codec
+import qpaceChecksum
+
+ACK_OPCODE = b'ARQAK'
+MAX_WINDOW = codec.ACK.fields['bitmap'][1] * 8 # Most pids one ACK can NAK
+WINDOW = 32    # Default pids outstanding at once
+RETRIES = 10   # Times a pid is resent before the transfer is given up
+
+class RTTEstimator():
+	"""
+	Retransmission timeout from measured round trip times, as in RFC 6298.
+
+	Parameters
+	----------
+	float - initial - Default: 3.0 - timeout (s) until the first sample.
+	float - minimum - Default: 0.2 - shortest timeout (s).
+	float - maximum - Default: 60.0 - longest timeout (s), backoff included.
+	"""
+	alpha = 1/8
+	beta = 1/4
+
+	def __init__(self, initial = 3.0, minimum = .2, maximum = 60.0):
+		self.srtt = None
+		self.rttvar = None
+		self.minimum = minimum
+		self.maximum = maximum
+		self.rto = min(max(initial, minimum), maximum)
+
+	def sample(self, rtt):
+		if self.srtt is None:
+			self.srtt = rtt
+			self.rttvar = rtt / 2
+		else:
+			self.rttvar = (1 - self.beta) * self.rttvar + self.beta * abs(self.srtt - rtt)
+			self.srtt = (1 - self.alpha) * self.srtt + self.alpha * rtt
+		self.rto = min(max(self.srtt + 4 * self.rttvar, self.minimum), self.maximum)
+
+	# A timer ran out, wait twice as long next time
+	def backoff(self):
+		self.rto = min(self.rto * 2, self.maximum)
+
+class SendWindow():
+	"""
+	Sender's side: which pids from first to last (inclusive) are outstanding, and which to send next.
+
+	Parameters
+	----------
+	int - first - first pid to send.
+	int - last - last pid to send. The transfer is done at once if last < first.
+	int - window - Default: WINDOW - pids outstanding at once, base included. At most MAX_WINDOW.
+	int - retries - Default: RETRIES - times a pid may be resent.
+	RTTEstimator - rtt - Default: None - a new one if None.
+	callable - skip - Default: None - skip(pid) is True for pids that are already done, e.g. in a resumed transfer. They are never sent.
+	callable - onAck - Default: None - called with each pid as it is acknowledged.
+
+	Raises
+	------
+	ValueError - if window is out of range.
+	"""
+
+	def __init__(self, first, last, window = WINDOW, retries = RETRIES, rtt = None, skip = None, onAck = None):
+		if window < 1 or window > MAX_WINDOW:
+			raise ValueError("Window of " + str(window) + " pids is outside 1 to " + str(MAX_WINDOW) + ".")
+		self.last = last
+		self.base = first       # Lowest pid not acknowledged yet
+		self.next = first       # Lowest pid not sent yet
+		self.window = window
+		self.retries = retries
+		self.rtt = rtt or RTTEstimator()
+		self.skip = skip
+		self.onAck = onAck
+		self.outstanding = {}   # pid -> [time last sent, times sent, time held until], for every pid sent but not acknowledged
+		self.latest = None      # Time the newest acknowledged copy was sent
+		self.stats = {'sent': 0, 'resent': 0, 'timeouts': 0, 'acks': 0}
+
+	def done(self):
+		return self.base > self.last
+
+	def ready(self):
+		"""
+		New pids the window has room for, lowest first. Call sent() for each as it goes out.
+		"""
+		if self.skip is None:
+			end = min(self.base + self.window, self.last + 1)
+			pids = range(self.next, end)
+			self.next = max(self.next, end)
+			return pids
+		pids = []
+		while True:
+			end = min(self.base + self.window, self.last + 1)
+			while self.next < end:
+				if not self.skip(self.next): pids.append(self.next)
+				self.next += 1
+			base = self.base
+			# Past any pids that were skipped, which makes room for more. Pids handed out here aren't outstanding yet, so stop at those
+			while self.base < self.next and self.base not in self.outstanding and self.skip(self.base): self.base += 1
+			if self.base == base: return pids
+
+	def sent(self, pid, now):
+		"""
+		Record that pid went out at now (time.monotonic()).
+
+		Raises
+		------
+		TimeoutError - if pid has been resent retries times already.
+		"""
+		entry = self.outstanding.get(pid)
+		if entry is None:
+			self.outstanding[pid] = [now, 1, now]
+			self.stats['sent'] += 1
+			return
+		if entry[1] > self.retries:
+			raise TimeoutError("Packet " + str(pid) + " was not acknowledged after " + str(entry[1]) + " sends.")
+		entry[0] = now
+		entry[1] += 1
+		entry[2] = now
+		self.stats['resent'] += 1
+
+	def hold(self, pids, now):
+		"""
+		Don't resend pids on a NAK until something sent after now has arrived, e.g. because parity
+		that could rebuild them went out at now. Their timers are left as they are.
+		"""
+		for pid in pids:
+			entry = self.outstanding.get(pid)
+			if entry is not None: entry[2] = max(entry[2], now)
+
+	def acknowledged(self, pid):
+		# Drop pid from the outstanding pids, and keep the send time of its copy that arrived
+		entry = self.outstanding.pop(pid, None)
+		if entry is None: return None
+		if self.onAck is not None: self.onAck(pid)
+		if self.latest is None or entry[0] > self.latest: self.latest = entry[0]
+		return entry
+
+	def ack(self, base, count, bitmap, now):
+		"""
+		Apply an ACK from the receiver.
+
+		Parameters
+		----------
+		int - base - every pid below base has arrived.
+		int - count - the bitmap covers pids base to base + count - 1.
+		bytes-like - bitmap - bit i (bit i % 8 of byte i // 8) is set if pid base + i is missing.
+		float - now - time.monotonic() the ACK arrived.
+
+		Returns
+		-------
+		list of int - missing pids to resend now.
+		"""
+		self.stats['acks'] += 1
+		newest = None # Only one RTT sample per ACK, from the newest pid it acknowledges
+		base = min(base, self.next) # Can't have arrived before it was sent
+		for pid in range(self.base, base):
+			entry = self.acknowledged(pid)
+			if entry is not None and (newest is None or entry[0] > newest[0]): newest = entry
+		missing = []
+		for i in range(min(count, self.next - base)):
+			pid = base + i
+			if bitmap[i >> 3] & (1 << (i & 7)):
+				missing.append(pid)
+			else:
+				entry = self.acknowledged(pid)
+				if entry is not None and (newest is None or entry[0] > newest[0]): newest = entry
+		if newest is not None and newest[1] == 1: self.rtt.sample(now - newest[0])
+		self.advance()
+		# A missing pid whose last copy went out before one that has arrived was lost, the link keeps frames in order
+		return [pid for pid in missing if pid in self.outstanding and self.latest is not None and self.outstanding[pid][2] < self.latest]
+
+	# Move base up past every pid that is no longer outstanding
+	def advance(self):
+		while self.base < self.next and self.base not in self.outstanding: self.base += 1
+
+	def expired(self, now):
+		"""
+		Pids whose retransmission timer has run out by now, to resend. The timeout backs off if there are any.
+		"""
+		rto = self.rto()
+		pids = [pid for pid, entry in self.outstanding.items() if entry[0] + rto <= now]
+		if pids:
+			self.rtt.backoff()
+			self.stats['timeouts'] += 1
+		return pids
+
+	def rto(self):
+		return self.rtt.rto
+
+	# time.monotonic() at which the next timer runs out, None if nothing is outstanding
+	def deadline(self):
+		if not self.outstanding: return None
+		return min(entry[0] for entry in self.outstanding.values()) + self.rto()
+
+def encodeAck(route, base, count, have):
+	"""
+	Build an ACK frame.
+
+	Parameters
+	----------
+	int - route - routing ID, see qpaceInterpreter.ROUTES.
+	int - base - every pid below base has arrived.
+	int - count - pids after base to report on, cut to MAX_WINDOW.
+	callable - have - have(pid) is True if pid has arrived.
+
+	Returns
+	-------
+	memoryview - the frame, in qpaceCodec.ACK's buffer. Send it before the next ACK is built.
+	"""
+	count = max(min(count, MAX_WINDOW), 0)
+	bitmap = bytearray(codec.ACK.fields['bitmap'][1])
+	for i in range(count):
+		if not have(base + i): bitmap[i >> 3] |= 1 << (i & 7)
+	frame = codec.ACK.encode(route, ACK_OPCODE, base, count, bytes(bitmap), b'')
+	end = codec.ACK.offset('checksum')
+	frame[end:] = qpaceChecksum.checksum(frame[:end])
+	return frame
+
+def decodeAck(frame):
+	"""
+	Unpack an ACK frame.
+
+	Returns
+	-------
+	tuple - (base, count, bitmap) as SendWindow.ack takes them.
+	None - if frame is not an ACK or its checksum is wrong.
+	"""
+	ack = codec.ACK.decode(frame)
+	if ack.opcode != ACK_OPCODE: return None
+	end = codec.ACK.offset('checksum')
+	if qpaceChecksum.checksum(memoryview(frame)[:end]) != ack.checksum: return None
+	return ack.base, min(ack.count, MAX_WINDOW), ack.bitmap
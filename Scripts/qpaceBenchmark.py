@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+# qpaceBenchmark.py
+# Q-Pace project, Center for Microgravity Research
+# University of Central Florida
+#
+# Performance benchmarks for the WTC link, run against the virtual SC16IS750 in qpaceFakePigpio
+# so they work on any Linux machine.
+#
+# Usage:
+#	python3 qpaceBenchmark.py                      # run everything
+#	python3 qpaceBenchmark.py rx tx --baud 230400  # run some benchmarks
+#	python3 qpaceBenchmark.py --save baseline.json
+#	python3 qpaceBenchmark.py --compare baseline.json   # exit 1 on a regression
+#
+# The link benchmarks (rx, tx, echo, ring, dispatch) run on simulated time (qpaceSimulation), so their
+# numbers come from the modelled bus, line and callback timing alone and are the same on every run and host.
+# Exits 1 if a link benchmark loses or corrupts data, e.g. an RX overrun or a lost echo.
+
+import qpaceFakePigpio as fake
+fake.install()
+
+import os
+import sys
+import json
+import time
+import argparse
+import SC16IS750
+import qpaceCodec
+import qpaceChecksum
+import qpaceXTEA
+import qpaceFEC
+import qpaceErasure
+import qpaceCompression
+import qpaceDelta
+import qpaceSimulation
+
+I2C_BUS = 1
+I2C_ADDR = 0x4c
+IRQ_GPIO = 16
+IRQ_LATENCY = .002
+
+BENCHMARKS = {}
+
+def benchmark(name, description, simulated = False):
+	"""
+	Register a benchmark. The function takes the parsed arguments and a Results to fill in.
+	With simulated set it runs on simulated time, with the fake and the driver.
+	"""
+	def register(func):
+		BENCHMARKS[name] = (func, description, simulated)
+		return func
+	return register
+
+class Results():
+	"""
+	Metrics from one run, by benchmark then metric name. Each metric records whether higher
+	is better so --compare knows which way a regression goes. Benchmarks that lost data add
+	a failure, which fails the run whatever the numbers.
+	"""
+
+	def __init__(self):
+		self.metrics = {}
+		self.failures = []
+
+	def add(self, bench, name, value, unit, higher = True):
+		self.metrics.setdefault(bench, {})[name] = {'value': value, 'unit': unit, 'higher': higher}
+		print('{:>10} {:<28} {:>14.3f} {}'.format(bench, name, value, unit))
+
+	def fail(self, bench, reason):
+		self.failures.append((bench, reason))
+		print('{:>10} FAILED: {}'.format(bench, reason))
+
+	def save(self, path):
+		with open(path, 'w') as f:
+			json.dump(self.metrics, f, indent = 1, sort_keys = True)
+
+	# Return the list of metrics that are worse than the baseline by more than tolerance (fraction)
+	def compare(self, path, tolerance):
+		with open(path, 'r') as f:
+			baseline = json.load(f)
+		regressions = []
+		for bench, metrics in self.metrics.items():
+			for name, metric in metrics.items():
+				old = baseline.get(bench, {}).get(name)
+				if old is None or old['value'] == 0: continue
+				change = (metric['value'] - old['value']) / abs(old['value'])
+				if not metric['higher']: change = -change
+				if change < -tolerance:
+					regressions.append((bench, name, old['value'], metric['value'], metric['unit']))
+		return regressions
+
+def percentile(values, fraction):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def openLink(args, peer):
+	"""
+	Start a fresh virtual bus with one chip and peer, and bring the chip up the way
+	qpaceWTCHandler.initWTCConnection does.
+
+	Returns
+	-------
+	(pi, SC16IS750, VirtualSC16IS750, RXEngine)
+	"""
+	fake.reset(args.i2c_clock, args.i2c_overhead, args.callback_latency)
+	device = fake.attach(fake.VirtualSC16IS750(bit_error_rate = args.bit_error_rate), I2C_ADDR, I2C_BUS, IRQ_GPIO)
+	device.connect(peer)
+	gpio = fake.pi()
+	trigger, halt, resume = SC16IS750.flow_control_levels(args.baud, IRQ_LATENCY)
+	fcr = SC16IS750.FCR_TX_FIFO_RESET | SC16IS750.FCR_RX_FIFO_RESET | SC16IS750.FCR_FIFO_ENABLE
+	ier = SC16IS750.IER_RX_ERROR | SC16IS750.IER_RX_READY
+	config = {'fcr': fcr, 'ier': ier, 'tlr': SC16IS750.tlr_value(rx = trigger)}
+	chip = SC16IS750.SC16IS750(gpio, I2C_BUS, I2C_ADDR, baudrate = args.baud, config = config)
+	engine = SC16IS750.RXEngine(gpio, chip, IRQ_GPIO)
+	return (gpio, chip, device, engine)
+
+def closeLink(engine):
+	engine.stop()
+	fake.hardware.shutdown()
+
+@benchmark('rx', 'WTC streams bytes to the Pi through the RX engine', simulated = True)
+def benchRX(args, results):
+	peer = fake.Peer()
+	gpio, chip, device, engine = openLink(args, peer)
+	data = bytes(range(256)) * (args.bytes // 256)
+	buf = bytearray(len(data))
+	start = time.monotonic()
+	peer.send(data)
+	count = chip.read_into(buf, args.timeout)
+	elapsed = time.monotonic() - start
+	closeLink(engine)
+	line = len(data) * chip.char_bits() / args.baud
+	results.add('rx', 'throughput', count / elapsed, 'B/s')
+	results.add('rx', 'line_efficiency', line / elapsed, 'x line rate')
+	results.add('rx', 'i2c_transactions', device.stats['transactions'] * 1024 / max(count, 1), 'per KiB', False)
+	results.add('rx', 'overruns', device.stats['overruns'], 'bytes', False)
+	results.add('rx', 'intact', float(buf == data), 'bool')
+	if device.stats['overruns'] > 0: results.fail('rx', str(device.stats['overruns']) + ' bytes overran the RX FIFO')
+	elif buf != data and args.bit_error_rate == 0: results.fail('rx', 'data received is not what was sent')
+
+@benchmark('tx', 'Pi writes bytes to the WTC with write_all', simulated = True)
+def benchTX(args, results):
+	peer = fake.Peer()
+	gpio, chip, device, engine = openLink(args, peer)
+	data = bytes(range(256)) * (args.bytes // 256)
+	start = time.monotonic()
+	chip.write_all(data, args.timeout)
+	chip.wait_tx_empty(args.timeout)
+	elapsed = time.monotonic() - start
+	closeLink(engine)
+	line = len(data) * chip.char_bits() / args.baud
+	results.add('tx', 'throughput', len(peer.rx) / elapsed, 'B/s')
+	results.add('tx', 'line_efficiency', line / elapsed, 'x line rate')
+	results.add('tx', 'i2c_transactions', device.stats['transactions'] * 1024 / max(len(peer.rx), 1), 'per KiB', False)
+	results.add('tx', 'intact', float(peer.rx == data), 'bool')
+	if peer.rx != data: results.fail('tx', 'data received by the WTC is not what was sent')
+
+@benchmark('echo', 'Round trip of 128 byte frames through an echoing WTC', simulated = True)
+def benchEcho(args, results):
+	gpio, chip, device, engine = openLink(args, fake.EchoPeer())
+	frame = bytes(range(128))
+	buf = bytearray(len(frame))
+	latencies = []
+	lost = 0
+	# An echo can't come back faster than the frame plus one character on the line
+	line = (len(frame) + 1) * chip.char_bits() / args.baud
+	for i in range(args.frames):
+		start = time.monotonic()
+		chip.write_all(frame)
+		if chip.read_into(buf, max(args.timeout / args.frames, 10 * line)) == len(buf) and buf == frame:
+			latencies.append(time.monotonic() - start)
+		else:
+			# Bytes were dropped (e.g. an RX overrun), so let the rest of the echo arrive and start clean
+			lost += 1
+			time.sleep(line)
+			chip.rxstream.flush()
+	closeLink(engine)
+	results.add('echo', 'frames_lost', lost, 'frames', False)
+	results.add('echo', 'overruns', device.stats['overruns'], 'bytes', False)
+	if lost > 0 and args.bit_error_rate == 0: results.fail('echo', str(lost) + ' of ' + str(args.frames) + ' frames lost')
+	if latencies:
+		results.add('echo', 'p50_latency', percentile(latencies, .5) * 1000, 'ms', False)
+		results.add('echo', 'p99_latency', percentile(latencies, .99) * 1000, 'ms', False)
+		results.add('echo', 'line_overhead', percentile(latencies, .5) / line, 'x line time', False)
+
+@benchmark('ring', 'WTC chunks through the RX ring to a consumer that keeps stopping', simulated = True)
+def benchRing(args, results):
+	peer = fake.Peer(flow_control = True)
+	gpio, chip, device, engine = openLink(args, peer)
+	engine.stop()
+	ring = SC16IS750.RXRing(16)
+	# RTS the way uartConfig sets it up with HW_FLOW_CONTROL: the chip halts the WTC itself once the FIFO
+	# reaches the halt level, so a late IRQ round can't overrun it. A ring hold masks the RX interrupts
+	chip.enable_flow_control(IRQ_LATENCY, cts = False)
+	chip.hold_rx(False)
+	engine = SC16IS750.RXEngine(gpio, chip, IRQ_GPIO, ring)
+	chunks = [bytes([i % 256]) * SC16IS750.CHUNK_SIZE for i in range(args.frames * 4)]
+	data = b''.join(chunks)
+	out = bytearray()
+	line = SC16IS750.CHUNK_SIZE * chip.char_bits() / args.baud
+	peer.send(data)
+	start = time.monotonic()
+	busy = 0
+	while len(out) < len(data):
+		slot = ring.peek(args.timeout)
+		if slot is None: break
+		began = time.perf_counter()
+		out += slot
+		ring.release()
+		busy += time.perf_counter() - began
+		# Stall every 8th chunk for longer than the ring takes to fill, so back-pressure has to hold the WTC off
+		if ring.tail % 8 == 0: time.sleep(line * ring.capacity)
+	elapsed = time.monotonic() - start
+	closeLink(engine)
+	results.add('ring', 'throughput', len(out) / elapsed, 'B/s')
+	results.add('ring', 'consumer_cost', busy / max(ring.tail, 1) * 1e6, 'us per slot', False)
+	results.add('ring', 'holds', ring.holds, 'holds')
+	results.add('ring', 'overflows', ring.overflows, 'bytes', False)
+	results.add('ring', 'chip_overruns', device.stats['overruns'], 'bytes', False)
+	results.add('ring', 'intact', float(out == data), 'bool')
+	if device.stats['overruns'] > 0: results.fail('ring', str(device.stats['overruns']) + ' bytes overran the RX FIFO')
+	if ring.overflows > 0: results.fail('ring', str(ring.overflows) + ' bytes dropped with the ring full')
+	if out != data and args.bit_error_rate == 0: results.fail('ring', 'data received is not what was sent')
+
+@benchmark('dispatch', 'Time from the IRQ edge to the consumer holding a WTC state byte', simulated = True)
+def benchDispatch(args, results):
+	peer = fake.Peer()
+	gpio, chip, device, engine = openLink(args, peer)
+	engine.stop()
+	ring = SC16IS750.RXRing(16)
+	engine = SC16IS750.RXEngine(gpio, chip, IRQ_GPIO, ring)
+	line = engine.line
+	latencies = []
+	lost = 0
+	for i in range(args.frames):
+		peer.send(bytes([i % 256]))
+		slot = ring.peek(args.timeout / args.frames)
+		if slot is None:
+			lost += 1
+			continue
+		# pigpio ticks are microseconds and wrap at 32 bits
+		latencies.append(((gpio.get_current_tick() - line.serviced) & 0xFFFFFFFF) / 1000)
+		ring.release()
+	closeLink(engine)
+	results.add('dispatch', 'frames_lost', lost, 'frames', False)
+	if latencies:
+		results.add('dispatch', 'p50_edge_to_dispatch', percentile(latencies, .5), 'ms', False)
+		results.add('dispatch', 'p99_edge_to_dispatch', percentile(latencies, .99), 'ms', False)
+	results.add('dispatch', 'edges_coalesced', line.coalesced, 'edges')
+
+@benchmark('codec', 'Encode and decode of 128 byte frames, against the slicing and joining they replaced')
+def benchCodec(args, results):
+	count = args.frames * 1000
+	frame = memoryview(bytearray(range(128))) # As handed over by the reassembler
+	data = bytes(range(123))
+	tail = data[:100] # The last packet of a file is padded
+
+	def rate(func):
+		start = time.perf_counter()
+		for i in range(count): func()
+		return count / (time.perf_counter() - start)
+
+	def decode():
+		fields = qpaceCodec.COMMAND.decode(frame)
+		return fields.route, fields.opcode, fields.information, fields.checksum
+	def legacyDecode():
+		packetData = bytes(frame)
+		fields = {'route': packetData[0], 'opcode': packetData[1:6], 'information': packetData[6:124], 'checksum': packetData[124:]}
+		return fields['route'], fields['opcode'], fields['information'], fields['checksum']
+	def legacyEncode(data):
+		packet = (1).to_bytes(1, byteorder='big') + (2).to_bytes(4, byteorder='big') + data
+		return packet + b' ' * (128 - len(packet))
+
+	results.add('codec', 'decode', rate(decode), 'frames/s')
+	results.add('codec', 'legacy_decode', rate(legacyDecode), 'frames/s')
+	results.add('codec', 'encode', rate(lambda: qpaceCodec.DATA.encode(1, 2, data)), 'frames/s')
+	results.add('codec', 'legacy_encode', rate(lambda: legacyEncode(data)), 'frames/s')
+	results.add('codec', 'encode_padded', rate(lambda: qpaceCodec.DATA.encode(1, 2, tail)), 'frames/s')
+	results.add('codec', 'legacy_encode_padded', rate(lambda: legacyEncode(tail)), 'frames/s')
+
+@benchmark('checksum', 'FNV-1a and CRC-32 over the 124 checked bytes of 128 byte frames, one at a time and in a batch')
+def benchChecksum(args, results):
+	count = args.frames * 100
+	frames = bytes(i & 0xFF for i in range(count * 128))
+	view = memoryview(frames)
+	covered = qpaceCodec.COMMAND.offset('checksum')
+
+	def rate(func):
+		start = time.perf_counter()
+		for offset in range(0, len(view), 128): func(view[offset:offset+covered])
+		return count / (time.perf_counter() - start)
+	def legacy(data): # CMDPacket.generateChecksum before qpaceChecksum
+		checksum = 0x811C9DC5
+		for byte in data:
+			checksum ^= byte
+			checksum *= 0x1000193
+		checksum &= 0xFFFFFFFF
+		return checksum.to_bytes(4, byteorder='big')
+
+	results.add('checksum', 'legacy_fnv1a', rate(legacy), 'frames/s')
+	results.add('checksum', 'fnv1a', rate(lambda data: qpaceChecksum.checksum(data, 'fnv1a')), 'frames/s')
+	results.add('checksum', 'crc32', rate(lambda data: qpaceChecksum.checksum(data, 'crc32')), 'frames/s')
+	start = time.perf_counter()
+	qpaceChecksum.batch(frames, 128, covered, 'fnv1a')
+	name = 'batch_fnv1a' if qpaceChecksum.numpy is not None else 'batch_fnv1a_nonumpy'
+	results.add('checksum', name, count / (time.perf_counter() - start), 'frames/s')
+
+@benchmark('xtea', 'XTEA over 118 byte information fields, one at a time and in a batch')
+def benchXTEA(args, results):
+	count = args.frames * 10
+	size = qpaceCodec.COMMAND.fields['information'][1]
+	frames = bytes(i & 0xFF for i in range(count * size))
+	key = bytes(range(qpaceXTEA.KEY_SIZE))
+	xtea = qpaceXTEA.Cipher(key)
+	words = [int.from_bytes(key[i:i+4], byteorder='big') for i in range(0, 16, 4)]
+
+	def textbook(v0, v1): # Key words looked up and the sum advanced inside every block
+		total = 0
+		for i in range(qpaceXTEA.CYCLES):
+			v0 = (v0 + ((((v1 << 4) ^ (v1 >> 5)) + v1) ^ (total + words[total & 3]))) & qpaceXTEA.MASK
+			total = (total + qpaceXTEA.DELTA) & qpaceXTEA.MASK
+			v1 = (v1 + ((((v0 << 4) ^ (v0 >> 5)) + v0) ^ (total + words[(total >> 11) & 3]))) & qpaceXTEA.MASK
+		return v0, v1
+	def rate(func):
+		start = time.perf_counter()
+		for offset in range(0, len(frames), size): func(frames[offset:offset+size])
+		return count / (time.perf_counter() - start)
+	def batch(func):
+		start = time.perf_counter()
+		func(frames, size)
+		return count / (time.perf_counter() - start)
+
+	results.add('xtea', 'textbook_encrypt', rate(lambda data: xtea._blocks(data[:112], textbook)), 'frames/s')
+	results.add('xtea', 'encrypt', rate(xtea.encrypt), 'frames/s')
+	results.add('xtea', 'decrypt', rate(xtea.decrypt), 'frames/s')
+	backend = '' if qpaceXTEA.numpy is not None else '_nonumpy'
+	results.add('xtea', 'batch_encrypt' + backend, batch(xtea.encrypt_frames), 'frames/s')
+	results.add('xtea', 'batch_decrypt' + backend, batch(xtea.decrypt_frames), 'frames/s')
+
+@benchmark('fec', 'TMR majority vote over DATA frames with a burst error in one copy, one at a time and in a batch')
+def benchFEC(args, results):
+	count = args.frames * 10
+	offset = qpaceCodec.DATA.offset('data')
+	size = qpaceFEC.width(qpaceCodec.DATA.fields['data'][1])
+	frame = bytearray(qpaceCodec.FRAME_SIZE)
+	frame[offset:offset+qpaceFEC.COPIES*size] = qpaceFEC.encode(bytes(range(size)), size)
+	frame[offset+size:offset+size+32] = bytes(32) # A whole chunk lost in the second copy
+	frames = bytes(frame) * count
+
+	start = time.perf_counter()
+	for base in range(0, len(frames), qpaceCodec.FRAME_SIZE):
+		qpaceFEC.decode(frames[base+offset:base+offset+qpaceFEC.COPIES*size], size)
+	results.add('fec', 'decode', count / (time.perf_counter() - start), 'frames/s')
+	start = time.perf_counter()
+	payloads, corrected = qpaceFEC.decodeFrames(frames, qpaceCodec.FRAME_SIZE, offset, size)
+	backend = '' if qpaceFEC.numpy is not None else '_nonumpy'
+	results.add('fec', 'batch_decode' + backend, count / (time.perf_counter() - start), 'frames/s')
+	if bytes(payloads[0]) != bytes(range(size)):
+		raise RuntimeError("TMR did not correct the burst.")
+
+@benchmark('erasure', 'Reed-Solomon parity for blocks of 16 DATA payloads plus 4 parity, and rebuilding 4 lost payloads')
+def benchErasure(args, results):
+	k, m = 16, 4
+	size = qpaceCodec.DATA.fields['data'][1]
+	blocks = max(args.frames // k, 1)
+	code = qpaceErasure.Code(k, m)
+	payloads = [bytes((i * 7 + j) & 0xFF for j in range(size)) for i in range(k)]
+	parity = code.encode(payloads)
+	shards = {i: payload for i, payload in enumerate(payloads) if i >= m}
+	shards.update((k + j, payload) for j, payload in enumerate(parity))
+
+	start = time.perf_counter()
+	for block in range(blocks): code.encode(payloads)
+	results.add('erasure', 'encode', blocks * k / (time.perf_counter() - start), 'frames/s')
+	start = time.perf_counter()
+	for block in range(blocks): rebuilt = code.decode(shards)
+	results.add('erasure', 'rebuild', blocks * k / (time.perf_counter() - start), 'frames/s')
+	if any(rebuilt[i] != payloads[i] for i in range(m)):
+		raise RuntimeError("Erasure decoding did not rebuild the lost payloads.")
+
+@benchmark('compression', 'Compressed size and speed of every codec on a CSV log like the ones the Pi sends down')
+def benchCompression(args, results):
+	log = ''.join('20181016-{:06d},system,Experiment step {} ok,{:.4f}\n'.format(i, i % 17, i * .37) for i in range(args.frames * 20)).encode()
+	for codec in qpaceCompression.available():
+		if codec == 'none': continue
+		start = time.perf_counter()
+		c = qpaceCompression.compressor(codec)
+		size = len(c.compress(log)) + len(c.flush())
+		results.add('compression', codec + '_ratio', len(log) / size, 'x')
+		results.add('compression', codec + '_speed', len(log) / (time.perf_counter() - start) / 1e6, 'MB/s')
+
+@benchmark('delta', 'Uplink needed to update a script with a one line edit, as a delta against the whole file')
+def benchDelta(args, results):
+	with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'qpaceFileHandler.py'), 'rb') as f: old = f.read()
+	new = old.replace(b'time_to_wait = 5', b'time_to_wait = 7', 1)
+	start = time.perf_counter()
+	sig = qpaceDelta.signature(old)
+	delta = qpaceDelta.delta(sig, new)
+	elapsed = time.perf_counter() - start
+	results.add('delta', 'signature_bytes', len(sig), 'B')
+	results.add('delta', 'delta_bytes', len(delta), 'B')
+	results.add('delta', 'saving', len(new) / (len(sig) + len(delta)), 'x')
+	results.add('delta', 'speed', len(new) / elapsed / 1e6, 'MB/s')
+
+def main(argv = None):
+	parser = argparse.ArgumentParser(description = 'Benchmark the WTC link against a virtual SC16IS750.')
+	parser.add_argument('benchmarks', nargs = '*', help = 'benchmarks to run (' + ', '.join(BENCHMARKS) + '), default all')
+	parser.add_argument('--baud', type = int, default = 115200, help = 'UART baudrate')
+	parser.add_argument('--bytes', type = int, default = 16384, help = 'bytes to move in the throughput benchmarks')
+	parser.add_argument('--frames', type = int, default = 100, help = 'frames to send in the latency benchmarks')
+	parser.add_argument('--timeout', type = float, default = 10, help = 'seconds before a benchmark gives up')
+	parser.add_argument('--i2c-clock', type = int, default = fake.I2C_CLOCK, help = 'simulated I2C clock (Hz)')
+	parser.add_argument('--i2c-overhead', type = float, default = fake.I2C_OVERHEAD, help = 'simulated per transaction overhead (s)')
+	parser.add_argument('--callback-latency', type = float, default = fake.CALLBACK_LATENCY, help = 'simulated time from an IRQ edge to its callback (s)')
+	parser.add_argument('--bit-error-rate', type = float, default = 0, help = 'probability of each received bit flipping')
+	parser.add_argument('--save', metavar = 'FILE', help = 'write the results as JSON')
+	parser.add_argument('--compare', metavar = 'FILE', help = 'compare against saved results, exit 1 on a regression')
+	parser.add_argument('--tolerance', type = float, default = .2, help = 'allowed fractional regression for --compare')
+	args = parser.parse_args(argv)
+
+	names = args.benchmarks or list(BENCHMARKS)
+	for name in names:
+		if name not in BENCHMARKS: parser.error('unknown benchmark ' + name)
+	results = Results()
+	for name in names:
+		func, description, simulated = BENCHMARKS[name]
+		if simulated: qpaceSimulation.run(func, args, results, modules = [fake, SC16IS750, sys.modules[__name__]])
+		else: func(args, results)
+	if args.save: results.save(args.save)
+	regressions = []
+	if args.compare:
+		regressions = results.compare(args.compare, args.tolerance)
+		for bench, name, old, new, unit in regressions:
+			print('REGRESSION {} {}: {:.3f} -> {:.3f} {}'.format(bench, name, old, new, unit))
+	return 1 if regressions or results.failures else 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# qpaceCapture.py
+# Q-Pace project, Center for Microgravity Research
+# University of Central Florida
+#
+# Records everything that goes over a UART link to a compact binary file, so a pass can be
+# replayed later (qpaceReplay.py). The file is MAGIC followed by one record per transaction:
+# direction (1 byte), pigpio tick (4 bytes, microseconds, wraps) and length (2 bytes), little
+# endian, then the bytes themselves.
+#
+# Usage:
+#	chip.capture = Capture('/home/pi/logs/wtc.qpcap', gpio)   # every RHR read and THR write from now on
+#	...
+#	chip.capture = None; capture.close()
+#
+#	for direction, tick, data in read('/home/pi/logs/wtc.qpcap'):
+#		if direction == RX: ...
+
+import struct
+import threading
+
+MAGIC = b'QPCAP\x01'
+RECORD = struct.Struct('<BIH')
+RX = 0 # Bytes the Pi received
+TX = 1 # Bytes the Pi sent
+
+class Capture():
+	"""
+	Capture file being written. rx() and tx() may be called from any thread (the IRQ thread reads,
+	the interpreter writes); records are written whole and in the order the calls were made.
+
+	Parameters
+	----------
+	str - path - file to create. An existing file is overwritten.
+	pigpio.pi - pi - where the ticks come from, so they line up with the IRQ ticks.
+	"""
+
+	def __init__(self, path, pi):
+		self.path = path
+		self.pi = pi
+		self.lock = threading.Lock()
+		self.records = 0
+		self.file = open(path, 'wb')
+		self.file.write(MAGIC)
+
+	def record(self, direction, data):
+		tick = self.pi.get_current_tick()
+		with self.lock:
+			if self.file is None: return
+			self.file.write(RECORD.pack(direction, tick, len(data)))
+			self.file.write(data)
+			self.records += 1
+
+	def rx(self, data):
+		self.record(RX, data)
+
+	def tx(self, data):
+		self.record(TX, data)
+
+	def close(self):
+		with self.lock:
+			if self.file is not None:
+				self.file.close()
+				self.file = None
+
+def read(path):
+	"""
+	Read a capture file.
+
+	Returns
+	-------
+	generator of (int, int, bytes) - direction (RX or TX), pigpio tick and data of every record, in order.
+
+	Raises
+	------
+	ValueError - if the file is not a capture or a record is cut short.
+	"""
+	with open(path, 'rb') as f:
+		if f.read(len(MAGIC)) != MAGIC:
+			raise ValueError(path + " is not a capture file.")
+		while True:
+			header = f.read(RECORD.size)
+			if not header: return
+			if len(header) < RECORD.size:
+				raise ValueError(path + ": Capture ends in the middle of a record.")
+			direction, tick, length = RECORD.unpack(header)
+			data = f.read(length)
+			if len(data) < length:
+				raise ValueError(path + ": Capture ends in the middle of a record.")
+			yield direction, tick, data
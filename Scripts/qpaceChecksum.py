@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# qpaceChecksum.py
+# Q-Pace project, Center for Microgravity Research
+# University of Central Florida
+#
+# Frame checksums. FNV-1a is what the packet structure document specifies; CRC-32 can be agreed with
+# the WTC instead (qpaceWTCHandler.negotiateChecksum). Every frame goes through here in both directions.
+#
+# Usage:
+#	checksum(data)                        # 4 bytes, big endian, with the agreed algorithm
+#	fnv = FNV1a(); fnv.update(a); fnv.update(b); fnv.digest()
+#	batch(frames, 128, 124)               # checksums of every frame in a buffer, one call
+
+import zlib
+
+try:
+	import numpy
+except ImportError:
+	numpy = None # batch() falls back to one frame at a time
+
+FNV_OFFSET = 0x811C9DC5 # 32-Bit FNV Offset Basis
+FNV_PRIME = 0x01000193  # 32-Bit FNV Prime
+MASK = 0xFFFFFFFF
+
+# Algorithm IDs for negotiation (sent after CHECKSUMCHANGE), by name. 0x00 has always meant FNV-1a on the wire
+ALGORITHMS = {'fnv1a': 0x00, 'crc32': 0x01}
+
+# Algorithm in use on the link. Only changed by setAlgorithm, once both ends agree
+algorithm = 'fnv1a'
+
+def fnv1a(data, value = FNV_OFFSET):
+	"""
+	FNV-1a checksum of data as an int, continuing from value.
+
+	Each byte is XORed in and then multiplied by the prime, which is FNV-1a (FNV-1 multiplies first).
+	It is the order CMDPacket.generateChecksum always used and the ground and WTC expect. The value is masked to 32 bits after every byte,
+	which gives the same result as masking once at the end but keeps every step a small int,
+	so the cost is linear in the length of data.
+	"""
+	for byte in data:
+		value = ((value ^ byte) * FNV_PRIME) & MASK
+	return value
+
+def crc32(data, value = 0):
+	return zlib.crc32(data, value)
+
+FUNCTIONS = {'fnv1a': (fnv1a, FNV_OFFSET), 'crc32': (crc32, 0)}
+
+class Checksum():
+	"""
+	Incremental checksum, fed a piece at a time like hashlib (e.g. a frame as it is reassembled).
+
+	Parameters
+	----------
+	str - name - Default: None - algorithm from ALGORITHMS, the one in use on the link if None.
+	"""
+
+	def __init__(self, name = None):
+		self.name = name or algorithm
+		self.function, self.value = FUNCTIONS[self.name]
+
+	def update(self, data):
+		self.value = self.function(data, self.value)
+
+	def copy(self):
+		other = Checksum(self.name)
+		other.value = self.value
+		return other
+
+	def digest(self):
+		return self.value.to_bytes(4, byteorder='big')
+
+class FNV1a(Checksum):
+	def __init__(self):
+		Checksum.__init__(self, 'fnv1a')
+
+def checksum(data, name = None):
+	"""
+	Checksum of data, 4 bytes big endian.
+
+	Parameters
+	----------
+	bytes-like - data - what to checksum.
+	str - name - Default: None - algorithm from ALGORITHMS, the one in use on the link if None.
+	"""
+	function, value = FUNCTIONS[name or algorithm]
+	return function(data, value).to_bytes(4, byteorder='big')
+
+def batch(frames, size, covered = None, name = None):
+	"""
+	Checksum every frame in a buffer of back to back frames.
+
+	With NumPy, FNV-1a runs one frame per lane: the bytes at each position of every frame are folded in
+	together, so the Python loop is over the frame length rather than over every byte.
+
+	Parameters
+	----------
+	bytes-like - frames - frames of size bytes each, back to back.
+	int - size - bytes per frame.
+	int - covered - Default: size - bytes at the start of each frame the checksum covers.
+	str - name - Default: None - algorithm from ALGORITHMS, the one in use on the link if None.
+
+	Returns
+	-------
+	bytes - the checksums, 4 bytes big endian each, in frame order.
+
+	Raises
+	------
+	ValueError - if the buffer is not a whole number of frames.
+	"""
+	name = name or algorithm
+	covered = size if covered is None else covered
+	view = memoryview(frames).cast('B')
+	if len(view) % size != 0:
+		raise ValueError("A buffer of " + str(len(view)) + " bytes is not a whole number of " + str(size) + " byte frames.")
+	if name == 'fnv1a' and numpy is not None:
+		lanes = numpy.frombuffer(view, dtype=numpy.uint8).reshape(-1, size)[:, :covered]
+		value = numpy.full(len(lanes), FNV_OFFSET, dtype=numpy.uint32)
+		prime = numpy.uint32(FNV_PRIME)
+		for column in lanes.T:
+			value ^= column
+			value *= prime # uint32 arithmetic wraps, which is the mask
+		return value.astype('>u4').tobytes()
+	function, start = FUNCTIONS[name]
+	out = bytearray()
+	for offset in range(0, len(view), size):
+		out += function(view[offset:offset+covered], start).to_bytes(4, byteorder='big')
+	return bytes(out)
+
+def setAlgorithm(name):
+	"""
+	Switch the checksum used for every frame. Only call once the other end has agreed.
+
+	Raises
+	------
+	KeyError - if the algorithm is unknown.
+	"""
+	global algorithm
+	FUNCTIONS[name]
+	algorithm = name
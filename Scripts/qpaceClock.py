@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# qpaceClock.py
+# Q-Pace project, Center for Microgravity Research
+# University of Central Florida
+#
+# Wall clock time from the WTC. The Pi has no RTC, so its clock is wrong until the WTC sends
+# TIMESTAMP. setEpoch() records that epoch against time.monotonic() and from then on now() is
+# the WTC's time, without touching the system clock and unaffected if it jumps. The system
+# clock can be set to match on a background thread, through clock_settime directly rather than
+# a shell and sudo, so the handshake never waits on a fork.
+#
+# Usage:
+#	qpaceClock.setEpoch(epoch)     # WTC time, seconds since 1970, as of right now
+#	qpaceClock.setSystemClock()    # returns at once
+#	qpaceClock.now()               # like time.time(), but from the WTC's epoch once there is one
+#	time.strftime("%Y%m%d-%H%M%S", qpaceClock.gmtime())
+
+import os
+import time
+import ctypes
+import ctypes.util
+import datetime
+import threading
+import qpaceLogger as logger
+
+# Set the system clock to the WTC's time as well as keeping the offset. Off for replays and on the bench.
+SET_SYSTEM_CLOCK = True
+CLOCK_REALTIME = 0
+
+_offset = None # WTC epoch minus time.monotonic(), None until TIMESTAMP
+_lock = threading.Lock()
+
+class _timespec(ctypes.Structure):
+	_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+_libc = None
+
+def setEpoch(epoch):
+	"""
+	Take epoch (seconds since 1970, int or float) as the time right now.
+	"""
+	global _offset
+	_offset = epoch - time.monotonic()
+
+def synced():
+	return _offset is not None
+
+def now():
+	"""
+	Seconds since 1970. From the WTC's epoch once setEpoch has been called, from the system clock before that.
+	"""
+	offset = _offset
+	if offset is None: return time.time()
+	return time.monotonic() + offset
+
+def gmtime():
+	return time.gmtime(now())
+
+def utcnow():
+	return datetime.datetime.utcfromtimestamp(now())
+
+def _settime(seconds):
+	# clock_settime(CLOCK_REALTIME) through libc. Needs root or CAP_SYS_TIME.
+	global _libc
+	if _libc is None:
+		_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+	whole = int(seconds)
+	spec = _timespec(whole, int((seconds - whole) * 1000000000))
+	if _libc.clock_settime(CLOCK_REALTIME, ctypes.byref(spec)) != 0:
+		errno = ctypes.get_errno()
+		raise OSError(errno, os.strerror(errno))
+
+def _setSystemClock():
+	with _lock:
+		try:
+			_settime(now()) # The time as of when the call is made, not as of TIMESTAMP
+		except (OSError, AttributeError) as err:
+			logger.logError("Clock: Could not set the system clock, times come from the WTC offset only.", err)
+		else:
+			logger.logSystem([["Clock: System clock set from the WTC."]])
+
+def setSystemClock():
+	"""
+	Set the system clock to now() on a background thread and return at once.
+	Does nothing if SET_SYSTEM_CLOCK is off or setEpoch has not been called.
+
+	Returns
+	-------
+	threading.Thread - the thread doing it, or None.
+	"""
+	if not SET_SYSTEM_CLOCK or _offset is None: return None
+	thread = threading.Thread(target = _setSystemClock, name = 'clock', daemon = True)
+	thread.start()
+	return thread
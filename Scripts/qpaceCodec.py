@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# qpaceCodec.py
+# Q-Pace project, Center for Microgravity Research
+# University of Central Florida
+#
+# Frame layouts for everything that goes over the WTC link, as precompiled struct.Struct objects.
+# decode() unpacks every field in one call straight from whatever buffer the frame is in (a ring or
+# reassembly slot, a mmap), so the frame itself is never copied out first. view() gives memoryviews
+# instead, for fields that should not be copied at all. Encoding packs straight into a buffer that
+# is kept and reused, or into one the caller supplies, padding included, in one pack_into.
+#
+# Usage:
+#	frame = COMMAND.decode(packetData)
+#	if frame.opcode in COMMANDS: ...
+#	packet = DATA.encode(rid, pid, data)   # memoryview, valid until the next DATA.encode
+
+import struct
+import functools
+import collections
+
+FRAME_SIZE = 128
+
+class Layout():
+	"""
+	One frame layout: a struct.Struct (big endian, no alignment) plus the offset and size of every field.
+
+	Parameters
+	----------
+	str - name - for error messages.
+	list of (str, str) - fields - (field name, struct format) in frame order. Only single fields, e.g. 'B', 'I', '118s' or 'x'.
+	dict - padding - Default: None - field name: byte to fill the unused end of a bytes field with,
+					 instead of the zeros struct pads with. One field at most.
+	"""
+
+	def __init__(self, name, fields, padding = None):
+		self.name = name
+		self.struct = struct.Struct('>' + ''.join(fmt for field, fmt in fields))
+		self.size = self.struct.size
+		self.names = tuple(field for field, fmt in fields if fmt != 'x') # Fields that take a value when encoding
+		self.fields = {}  # name -> (offset, size)
+		self.getters = {} # name -> slice for bytes fields, struct.Struct for numbers
+		offset = 0
+		for field, fmt in fields:
+			single = struct.Struct('>' + fmt)
+			self.fields[field] = (offset, single.size)
+			self.getters[field] = slice(offset, offset + single.size) if fmt[-1] in 'sx' else single
+			offset += single.size
+		# A padded field of n bytes gets a struct for every length it can be given, with the field split in two:
+		# the value, then fill bytes for the rest (struct cuts the fill to fit). So padding costs no more calls
+		self.position = None # Position of the padded field among the encode values
+		self.packers = None  # pack_into of each of those structs, by length of the value
+		self.fill = None
+		self.last = False    # Whether the padded field is the last one
+		if padding:
+			if len(padding) > 1: raise ValueError(name + " can only pad one field.")
+			(padded, byte), = padding.items()
+			size = self.fields[padded][1]
+			self.position = self.names.index(padded)
+			self.fill = bytes([byte]) * size
+			self.packers = []
+			for used in range(size + 1):
+				split = ''.join(str(used) + 's' + str(size - used) + 's' if field == padded else fmt for field, fmt in fields)
+				self.packers.append(struct.Struct('>' + split).pack_into)
+			self.last = self.position == len(self.names) - 1
+		self.frame = collections.namedtuple(name + 'Frame', self.names)
+		self.make = functools.partial(tuple.__new__, self.frame) # namedtuple._make without its Python level checks
+		self.buffer = bytearray(self.size)
+		self.memory = memoryview(self.buffer)
+
+	def offset(self, field):
+		return self.fields[field][0]
+
+	def decode(self, buffer, offset = 0):
+		"""
+		Unpack the frame at buffer[offset:] in one call.
+
+		Returns
+		-------
+		namedtuple - one attribute per field: int for numbers, bytes for bytes fields.
+
+		Raises
+		------
+		struct.error - if the buffer is too short for the layout.
+		"""
+		return self.make(self.struct.unpack_from(buffer, offset))
+
+	def view(self, buffer, offset = 0):
+		"""
+		Return a FrameView over buffer[offset:offset+size]. Nothing is copied.
+
+		Raises
+		------
+		ValueError - if the buffer is too short for the layout.
+		"""
+		view = memoryview(buffer)
+		if view.format != 'B': view = view.cast('B')
+		if offset != 0 or len(view) != self.size: view = view[offset:offset+self.size]
+		if len(view) != self.size:
+			raise ValueError(self.name + " frame needs " + str(self.size) + " bytes, got " + str(len(view)) + ".")
+		return FrameView(self, view)
+
+	def encode_into(self, buffer, offset, *values):
+		"""
+		Pack values (in field order) into buffer at offset, padding short bytes fields as the layout says.
+
+		Raises
+		------
+		struct.error - if a value does not fit its field or the buffer is too short.
+		"""
+		if self.packers is None:
+			self.struct.pack_into(buffer, offset, *values)
+			return
+		position = self.position
+		# Longer values are cut to fit, as struct does
+		packer = self.packers[min(len(values[position]), len(self.fill))]
+		packer(buffer, offset, *values[:position+1], self.fill, *values[position+1:])
+
+	def encode(self, *values):
+		"""
+		Pack values (in field order) into the layout's own buffer.
+
+		Returns
+		-------
+		memoryview - the frame. It is overwritten by the next encode() on this layout, so send or copy it first.
+		"""
+		# encode_into written out again for the usual case of padding last, as in DATA: this is the innermost call of a downlink
+		if self.packers is None: self.struct.pack_into(self.buffer, 0, *values)
+		elif self.last:
+			try:
+				self.packers[len(values[-1])](self.buffer, 0, *values, self.fill)
+			except IndexError: # Longer than the field, so cut to fit as struct does
+				self.packers[-1](self.buffer, 0, *values, self.fill)
+		else: self.encode_into(self.buffer, 0, *values)
+		return self.memory
+
+class FrameView():
+	"""
+	A frame left where it is. frame['name'] gives an int for number fields and a memoryview into the
+	original buffer for bytes fields. Slicing a view costs more than copying a few bytes, so this is
+	for large fields that are passed on as they are, like the data of a DATA frame going to a file.
+	"""
+	__slots__ = ('layout', 'view')
+
+	def __init__(self, layout, view):
+		self.layout = layout
+		self.view = view
+
+	def __getitem__(self, field):
+		getter = self.layout.getters[field]
+		if getter.__class__ is slice: return self.view[getter]
+		return getter.unpack_from(self.view, self.layout.fields[field][0])[0]
+
+	def __contains__(self, field):
+		return field in self.layout.fields
+
+	# Bytes from the start of field first to the end of field last, e.g. everything a checksum covers
+	def span(self, first, last):
+		start = self.layout.fields[first][0]
+		end = self.layout.fields[last][0] + self.layout.fields[last][1]
+		return self.view[start:end]
+
+	def tobytes(self):
+		return self.view.tobytes()
+
+# Command frame from the ground, see the packet structure document
+COMMAND = Layout('Command', [('route', 'B'), ('opcode', '5s'), ('information', '118s'), ('checksum', '4s')])
+
+# Information field of an XTEA command (NOOP* or NOOP<) once decrypted
+XTEA = Layout('XTEA', [('header', '4s'), ('opcode', '2s'), ('information', '92s'), ('tag', '2s'), ('reserved', '6s'), ('padding', '12s')])
+
+# File transfer frame, see qpaceFileHandler.DataPacket
+DATA = Layout('Data', [('rid', 'B'), ('pid', 'I'), ('data', '123s')], padding = {'data': ord(b' ')})
+
+# Data field of the frame that ends a file transfer, see qpaceFileHandler.TransmitCompletePacket
+TRANSMIT_COMPLETE = Layout('TransmitComplete', [('marker', '2s'), ('filechecksum', '4s'), ('separator', 'x'), ('pathname', '109s'), ('checksum', '4s')], padding = {'pathname': 0x04})
+TRANSMIT_COMPLETE_MARKER = b'\x04\x04'
+
+# Acknowledgement of DATA frames, laid out as a COMMAND frame, see qpaceARQ
+# Every pid below base has arrived, and bit i of the bitmap is set if pid base + i is still missing
+ACK = Layout('Ack', [('route', 'B'), ('opcode', '5s'), ('base', 'I'), ('count', 'H'), ('bitmap', '112s'), ('checksum', '4s')])
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# qpaceCompression.py
+# Q-Pace project, Center for Microgravity Research
+# University of Central Florida
+#
+# Compression for file transfers. Before a file is packetized it can be compressed into an
+# artifact: HEADER (MAGIC, codec, original size) followed by the compressed stream. The codec is
+# picked per file by compressing a few samples of it, so CSV logs and listings get compressed and
+# GoPro video goes out as it is. Compression and decompression both stream a block at a time, so
+# memory use does not depend on the size of the file. Artifacts are kept in CACHE_PATH under the
+# file's CRC-32 and size, so a retry on a later pass sends the same artifact without compressing
+# the file again.
+#
+# zlib and lzma are always there. zstd is used if the zstandard module is installed.
+#
+# Usage:
+#	source, codec = prepare(pathname)         # the file to packetize, pathname itself if codec is 'none'
+#	inflater = Decompressor(pathname)         # on the receiving side
+#	inflater.feed(data)                       # the artifact in order, as it arrives
+#	inflater.finish()                         # pathname now holds the original file
+
+import os
+import lzma
+import zlib
+import struct
+import qpaceJournal
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None # No zstd, the other codecs still work
+
+CACHE_PATH = "/home/pi/cache/"
+CACHE_LIMIT = 256 * 1024 * 1024 # Bytes of artifacts kept before the least recently used are removed
+MAGIC = b'\x89QPZ\r\n\x1a\n'
+HEADER = struct.Struct('>8sBQ') # MAGIC, codec ID, size of the original file
+BLOCK_SIZE = 64 * 1024          # Bytes read at a time
+SAMPLE_SIZE = 48 * 1024         # Bytes sampled to choose a codec, from the start, middle and end of the file
+MIN_SIZE = 512                  # Files smaller than this are not worth the header
+WORTHWHILE = .9                 # Compress only if a sample shrinks to less than this
+LZMA_MARGIN = .9                # lzma is slower, so only use it if it beats the next best by this much
+
+CODECS = {'none': 0, 'zlib': 1, 'lzma': 2, 'zstd': 3}
+NAMES = {value: name for name, value in CODECS.items()}
+ERRORS = (zlib.error, lzma.LZMAError) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+def available():
+	"""
+	Names of the codecs that can be used here, 'none' first.
+	"""
+	return [name for name in CODECS if name != 'zstd' or zstandard is not None]
+
+def compressor(codec):
+	if codec == 'zlib': return zlib.compressobj(6)
+	if codec == 'lzma': return lzma.LZMACompressor(preset = 6)
+	if codec == 'zstd' and zstandard is not None: return zstandard.ZstdCompressor(level = 10).compressobj()
+	raise ValueError("Unknown or unavailable codec " + str(codec) + ".")
+
+def decompressor(codec):
+	if codec == 'zlib': return zlib.decompressobj()
+	if codec == 'lzma': return lzma.LZMADecompressor()
+	if codec == 'zstd' and zstandard is not None: return zstandard.ZstdDecompressor().decompressobj()
+	raise ValueError("Unknown or unavailable codec " + str(codec) + ".")
+
+def sample(pathname, size = SAMPLE_SIZE):
+	# Up to size bytes from the start, middle and end of the file
+	length = os.path.getsize(pathname)
+	if length <= size:
+		with open(pathname, 'rb') as f: return f.read()
+	piece = size // 3
+	out = b''
+	with open(pathname, 'rb') as f:
+		for offset in (0, (length - piece) // 2, length - piece):
+			f.seek(offset)
+			out += f.read(piece)
+	return out
+
+def choose(pathname):
+	"""
+	Pick a codec for a file by compressing a sample of it with each one.
+
+	Returns
+	-------
+	str - a name from CODECS. 'none' if the file is small or nothing makes the sample smaller by enough.
+	"""
+	if os.path.getsize(pathname) < MIN_SIZE: return 'none'
+	data = sample(pathname)
+	sizes = {}
+	for codec in available():
+		if codec == 'none': continue
+		c = compressor(codec)
+		sizes[codec] = len(c.compress(data)) + len(c.flush())
+	best = min((codec for codec in sizes if codec != 'lzma'), key = sizes.get)
+	if 'lzma' in sizes and sizes['lzma'] < sizes[best] * LZMA_MARGIN: best = 'lzma'
+	return best if sizes[best] < len(data) * WORTHWHILE else 'none'
+
+def compress(pathname, destination, codec):
+	"""
+	Write the artifact for pathname to destination, BLOCK_SIZE bytes at a time. Destination only appears once it is whole.
+	"""
+	c = compressor(codec)
+	temp = destination + '.new'
+	with open(pathname, 'rb') as source, open(temp, 'wb') as out:
+		out.write(HEADER.pack(MAGIC, CODECS[codec], os.fstat(source.fileno()).st_size))
+		for block in iter(lambda: source.read(BLOCK_SIZE), b''):
+			out.write(c.compress(block))
+		out.write(c.flush())
+		out.flush()
+		os.fsync(out.fileno())
+	os.replace(temp, destination)
+
+def prune(keep = None, limit = CACHE_LIMIT):
+	# Remove the least recently used artifacts until the cache is under limit, never keep
+	try:
+		entries = [os.path.join(CACHE_PATH, name) for name in os.listdir(CACHE_PATH)]
+	except FileNotFoundError:
+		return
+	entries = sorted((os.stat(path).st_mtime, os.stat(path).st_size, path) for path in entries if os.path.isfile(path))
+	total = sum(size for mtime, size, path in entries)
+	for mtime, size, path in entries:
+		if total <= limit: break
+		if path == keep: continue
+		os.remove(path)
+		total -= size
+
+def prepare(pathname, codec = 'auto'):
+	"""
+	The file to send for pathname: a cached artifact, a new one, or pathname itself if it is not worth compressing.
+
+	Parameters
+	----------
+	str - pathname - the file to send.
+	str - codec - Default: 'auto' - a name from CODECS, or 'auto' to choose().
+
+	Returns
+	-------
+	str - pathname of the file to packetize.
+	str - the codec used.
+
+	Raises
+	------
+	ValueError - if the codec is unknown or unavailable.
+	"""
+	if codec == 'auto': codec = choose(pathname)
+	if codec == 'none': return pathname, codec
+	if codec not in available():
+		raise ValueError("Unknown or unavailable codec " + str(codec) + ".")
+	key = '{:08x}-{}'.format(qpaceJournal.fileCRC(pathname), os.path.getsize(pathname))
+	destination = os.path.join(CACHE_PATH, key + '.' + codec)
+	if os.path.exists(destination):
+		os.utime(destination) # Recently used, so pruned last
+		return destination, codec
+	os.makedirs(CACHE_PATH, exist_ok = True)
+	compress(pathname, destination, codec)
+	prune(keep = destination)
+	return destination, codec
+
+class Decompressor():
+	"""
+	Rebuilds a file from its artifact, fed in order as it arrives. A stream that does not start with
+	MAGIC was sent as it is, and is not decompressed: finish() just moves it into place.
+
+	Parameters
+	----------
+	str - pathname - where the original file goes.
+	"""
+
+	def __init__(self, pathname):
+		self.pathname = pathname
+		self.temp = pathname + '.inflating'
+		self.header = bytearray()
+		self.codec = None     # None until the header is in, 'none' for a file that was not compressed
+		self.size = None      # Size of the original file
+		self.fed = 0          # Bytes of the artifact fed so far
+		self.written = 0      # Bytes of the original file written so far
+		self.stream = None
+		self.out = None
+
+	def feed(self, data):
+		"""
+		Decompress the next part of the artifact.
+
+		Raises
+		------
+		ValueError - if the header names an unknown codec or the stream is corrupt.
+		"""
+		data = memoryview(data).cast('B')
+		self.fed += len(data)
+		if self.codec is None:
+			take = HEADER.size - len(self.header)
+			self.header += data[:take]
+			data = data[take:]
+			if self.header[:len(MAGIC)] != MAGIC[:len(self.header)]:
+				self.codec = 'none'
+				return
+			if len(self.header) < HEADER.size: return
+			magic, codec, self.size = HEADER.unpack(self.header)
+			self.codec = NAMES.get(codec)
+			if self.codec is None or self.codec == 'none':
+				raise ValueError("Unknown codec ID " + str(codec) + " in the header of " + self.pathname + ".")
+			self.stream = decompressor(self.codec)
+			self.out = open(self.temp, 'wb')
+		if self.codec == 'none' or not data: return
+		try:
+			for offset in range(0, len(data), BLOCK_SIZE):
+				out = self.stream.decompress(data[offset:offset+BLOCK_SIZE])
+				self.out.write(out)
+				self.written += len(out)
+		except ERRORS as err:
+			raise ValueError("Corrupt " + self.codec + " stream for " + self.pathname + ".") from err
+
+	def finish(self, artifact = None):
+		"""
+		Put the original file in place once the whole artifact has been fed.
+
+		Parameters
+		----------
+		str - artifact - Default: None - the artifact's own file. Renamed to pathname if it was not compressed, removed if it was.
+
+		Returns
+		-------
+		bool - True if pathname now holds the original file.
+		"""
+		if self.codec == 'none':
+			if artifact is not None: os.replace(artifact, self.pathname)
+			return artifact is not None
+		if self.out is None: return False
+		flush = getattr(self.stream, 'flush', None)
+		if flush is not None:
+			out = flush()
+			self.out.write(out)
+			self.written += len(out)
+		self.out.flush()
+		os.fsync(self.out.fileno())
+		self.out.close()
+		self.out = None
+		if self.written != self.size:
+			os.remove(self.temp)
+			return False
+		os.replace(self.temp, self.pathname)
+		if artifact is not None: os.remove(artifact)
+		return True
+
+	# Drop what was written so far, e.g. for a transfer that will be resumed and fed from the start again
+	def abandon(self):
+		if self.out is not None:
+			self.out.close()
+			self.out = None
+			os.remove(self.temp)
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# qpaceDelta.py
+# Q-Pace project, Center for Microgravity Research
+# University of Central Florida
+#
+# rsync-style delta transfer for updating files on the Pi. The Pi sends down a signature of its
+# copy of a file: a weak rolling checksum and a strong hash for every block of block_size bytes.
+# The ground finds the blocks of the new version that the Pi already has and uplinks a delta:
+# copies of those blocks plus the bytes that are new. The Pi rebuilds the new version from its
+# own blocks and the delta, checks it against the SHA-256 in the delta, and swaps it in with
+# os.replace, so the old file is there until the new one is whole. A small edit to a script
+# costs a few hundred bytes of uplink instead of the whole file.
+#
+# Usage:
+#	On the Pi:     writeSignature(pathname, sigpath)      # send sigpath down
+#	On the ground: writeDelta(sigpath, newpath, deltapath) # send deltapath up
+#	On the Pi:     patch(pathname, deltapath)
+#
+#	python3 qpaceDelta.py signature FILE SIGNATURE
+#	python3 qpaceDelta.py delta SIGNATURE NEWFILE DELTA
+#	python3 qpaceDelta.py patch FILE DELTA
+
+import os
+import sys
+import struct
+import hashlib
+
+DELTA_PATH = "/home/pi/delta/" # Signatures and deltas on their way up or down
+BLOCK_SIZE = 256
+STRONG_SIZE = 8                # Bytes of MD5 kept per block
+SIGNATURE_MAGIC = b'QPSG'
+DELTA_MAGIC = b'QPDL'
+SIGNATURE_HEADER = struct.Struct('>4sIQ')  # magic, block size, size of the file
+BLOCK = struct.Struct('>I' + str(STRONG_SIZE) + 's') # weak checksum, strong hash
+DELTA_HEADER = struct.Struct('>4sIQ32s')   # magic, block size, size of the new file, its SHA-256
+COPY = struct.Struct('>cII')               # b'C', first block, number of blocks
+LITERAL = struct.Struct('>cI')             # b'L', number of bytes, then the bytes
+READ_SIZE = 64 * 1024
+
+def weak(block):
+	"""
+	rsync's rolling checksum of a block: (b << 16) | a, a the sum of the bytes and b the sum of the running sums.
+	"""
+	length = len(block)
+	a = sum(block) & 0xFFFF
+	b = sum((length - i) * x for i, x in enumerate(block)) & 0xFFFF
+	return (b << 16) | a
+
+def strong(block):
+	return hashlib.md5(block).digest()[:STRONG_SIZE]
+
+def signature(data, block_size = BLOCK_SIZE):
+	"""
+	Signature of data: SIGNATURE_HEADER then a BLOCK for every block, the last one possibly short.
+	"""
+	out = [SIGNATURE_HEADER.pack(SIGNATURE_MAGIC, block_size, len(data))]
+	for offset in range(0, len(data), block_size):
+		block = data[offset:offset+block_size]
+		out.append(BLOCK.pack(weak(block), strong(block)))
+	return b''.join(out)
+
+def writeSignature(pathname, sigpath, block_size = BLOCK_SIZE):
+	"""
+	Write the signature of the file at pathname (empty if there is none yet) to sigpath.
+	"""
+	try:
+		with open(pathname, 'rb') as f: data = f.read()
+	except FileNotFoundError:
+		data = b''
+	with open(sigpath, 'wb') as f:
+		f.write(signature(data, block_size))
+
+def parseSignature(data):
+	"""
+	Returns
+	-------
+	int - block size.
+	int - size of the file.
+	list of (int, bytes) - weak checksum and strong hash of every block.
+
+	Raises
+	------
+	ValueError - if data is not a whole signature.
+	"""
+	if len(data) < SIGNATURE_HEADER.size:
+		raise ValueError("Signature is cut short.")
+	magic, block_size, size = SIGNATURE_HEADER.unpack_from(data)
+	count = -(-size // block_size) if block_size else 0
+	if magic != SIGNATURE_MAGIC or block_size == 0 or len(data) != SIGNATURE_HEADER.size + count * BLOCK.size:
+		raise ValueError("Not a signature, or one that is cut short.")
+	return block_size, size, list(BLOCK.iter_unpack(data[SIGNATURE_HEADER.size:]))
+
+def delta(sig, data):
+	"""
+	Delta that turns the file sig was made from into data. Done on the ground.
+
+	Parameters
+	----------
+	bytes - sig - signature of the Pi's copy, see signature().
+	bytes - data - the new version.
+
+	Returns
+	-------
+	bytes - DELTA_HEADER then COPY and LITERAL operations.
+
+	Raises
+	------
+	ValueError - if sig is not a signature.
+	"""
+	block_size, size, blocks = parseSignature(sig)
+	table = {} # weak -> [(index, strong)] of the whole blocks
+	for index, (checksum, digest) in enumerate(blocks):
+		if (index + 1) * block_size <= size: table.setdefault(checksum, []).append((index, digest))
+	ops = []
+	def literal(start, end):
+		if end > start: ops.append(LITERAL.pack(b'L', end - start) + data[start:end])
+	def copy(index):
+		if ops and ops[-1][:1] == b'C':
+			op, first, count = COPY.unpack(ops[-1])
+			if first + count == index:
+				ops[-1] = COPY.pack(b'C', first, count + 1)
+				return
+		ops.append(COPY.pack(b'C', index, 1))
+
+	n = len(data)
+	L = block_size
+	start = 0 # Where the literal bytes not sent yet start
+	i = 0
+	if n >= L:
+		checksum = weak(data[:L])
+		a, b = checksum & 0xFFFF, checksum >> 16
+	while i + L <= n:
+		match = None
+		candidates = table.get((b << 16) | a)
+		if candidates:
+			digest = strong(data[i:i+L])
+			match = next((index for index, other in candidates if other == digest), None)
+		if match is not None:
+			literal(start, i)
+			copy(match)
+			i += L
+			start = i
+			if i + L <= n:
+				checksum = weak(data[i:i+L])
+				a, b = checksum & 0xFFFF, checksum >> 16
+			continue
+		# Roll the window on by a byte
+		if i + L < n:
+			out, new = data[i], data[i+L]
+			a = (a - out + new) & 0xFFFF
+			b = (b - L * out + a) & 0xFFFF
+		i += 1
+	# The Pi's last block can be short, so it can only match at the very end
+	tail = size % L
+	if tail and blocks and n - start >= tail and weak(data[n-tail:]) == blocks[-1][0] and strong(data[n-tail:]) == blocks[-1][1]:
+		literal(start, n - tail)
+		copy(len(blocks) - 1)
+	else:
+		literal(start, n)
+	return DELTA_HEADER.pack(DELTA_MAGIC, L, n, hashlib.sha256(data).digest()) + b''.join(ops)
+
+def writeDelta(sigpath, newpath, deltapath):
+	with open(sigpath, 'rb') as f: sig = f.read()
+	with open(newpath, 'rb') as f: data = f.read()
+	with open(deltapath, 'wb') as f: f.write(delta(sig, data))
+
+def _read(f, size):
+	data = f.read(size)
+	if len(data) != size: raise ValueError("Delta is cut short.")
+	return data
+
+def patch(pathname, deltapath):
+	"""
+	Rebuild pathname from its current blocks and a delta, then swap the new version in atomically.
+	The file keeps its permissions, so a script stays executable. Memory use is bounded by READ_SIZE.
+
+	Parameters
+	----------
+	str - pathname - the file to update. If it does not exist yet the delta must be all literal.
+	str - deltapath - the delta from the ground.
+
+	Raises
+	------
+	ValueError - if the delta is corrupt, copies a block the file does not have, or the result does not match its SHA-256.
+				 pathname is left as it was.
+	"""
+	directory = os.path.dirname(os.path.abspath(pathname))
+	temp = os.path.join(directory, '.' + os.path.basename(pathname) + '.delta')
+	try:
+		basis = open(pathname, 'rb')
+	except FileNotFoundError:
+		basis = None
+	try:
+		with open(deltapath, 'rb') as d, open(temp, 'wb') as out:
+			magic, block_size, size, digest = DELTA_HEADER.unpack(_read(d, DELTA_HEADER.size))
+			if magic != DELTA_MAGIC or block_size == 0: raise ValueError(deltapath + " is not a delta.")
+			basis_size = os.fstat(basis.fileno()).st_size if basis is not None else 0
+			sha = hashlib.sha256()
+			written = 0
+			while True:
+				op = d.read(1)
+				if not op: break
+				if op == b'C':
+					first, count = COPY.unpack(op + _read(d, COPY.size - 1))[1:]
+					offset, end = first * block_size, min((first + count) * block_size, basis_size)
+					if offset >= end: raise ValueError("Delta copies blocks " + pathname + " does not have.")
+					while offset < end:
+						basis.seek(offset)
+						data = basis.read(min(READ_SIZE, end - offset))
+						offset += len(data)
+						out.write(data)
+						sha.update(data)
+						written += len(data)
+				elif op == b'L':
+					length = LITERAL.unpack(op + _read(d, LITERAL.size - 1))[1]
+					while length:
+						data = _read(d, min(READ_SIZE, length))
+						length -= len(data)
+						out.write(data)
+						sha.update(data)
+						written += len(data)
+				else:
+					raise ValueError("Unknown operation in " + deltapath + ".")
+			if written != size or sha.digest() != digest:
+				raise ValueError("Patched " + pathname + " does not match the delta's SHA-256.")
+			out.flush()
+			os.fsync(out.fileno())
+		if basis is not None: os.chmod(temp, os.fstat(basis.fileno()).st_mode & 0o7777)
+		os.replace(temp, pathname)
+	except BaseException:
+		if os.path.exists(temp): os.remove(temp)
+		raise
+	finally:
+		if basis is not None: basis.close()
+	# The rename is only safe on the card once the directory is synced
+	fd = os.open(directory, os.O_RDONLY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+def main(argv = None):
+	argv = sys.argv[1:] if argv is None else argv
+	if argv[:1] == ['signature'] and len(argv) == 3:
+		writeSignature(argv[1], argv[2])
+	elif argv[:1] == ['delta'] and len(argv) == 4:
+		writeDelta(argv[1], argv[2], argv[3])
+		print('Delta is {} bytes, the file is {}.'.format(os.path.getsize(argv[3]), os.path.getsize(argv[2])))
+	elif argv[:1] == ['patch'] and len(argv) == 3:
+		patch(argv[1], argv[2])
+	else:
+		print('Usage: qpaceDelta.py signature FILE SIGNATURE | delta SIGNATURE NEWFILE DELTA | patch FILE DELTA')
+		return 2
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# qpaceErasure.py
+# Q-Pace project, Center for Microgravity Research
+# University of Central Florida
+#
+# Reed-Solomon erasure code over GF(256) for file transfers. Every block of k payloads goes out
+# with m parity payloads, and the receiver can rebuild the whole block from any k of the k + m,
+# so a lost frame is made up for without waiting a round trip for the sender to resend it.
+#
+# The code is systematic (the data payloads are sent as they are) and the parity rows are a
+# Cauchy matrix, so every k rows of [identity; parity] are independent whichever frames are lost.
+# Arithmetic is on whole payloads at once: a multiply is bytes.translate through a 256 byte
+# table and an add is one xor of the payloads as big integers, so the loops in Python are over
+# coefficients, never over bytes. (NumPy was tried and is slower for payloads this small.)
+# The decoding matrix for each pattern of lost frames is worked out once and kept.
+#
+# Usage:
+#	code = Code(k, m)
+#	parity = code.encode(payloads)          # k payloads of the same length -> m parity payloads
+#	data = code.decode({0: p0, 2: p2, k: q0, ...})   # any k of them by index -> the missing data payloads
+#	pid = code.parityPid(block, j)          # parity frames go out with PARITY set in the pid
+
+PARITY = 0x80000000 # Set in the pid of a parity frame, see Code.parityPid
+POLYNOMIAL = 0x11D # x^8 + x^4 + x^3 + x^2 + 1
+MAX_SHARDS = 256   # k + m can't go past the field size
+
+EXP = [0] * 512 # EXP[i] = 2**i, twice over so a sum of two logs needs no modulo
+LOG = [0] * 256
+_value = 1
+for _i in range(255):
+	EXP[_i] = EXP[_i + 255] = _value
+	LOG[_value] = _i
+	_value <<= 1
+	if _value & 0x100: _value ^= POLYNOMIAL
+del _i, _value
+
+def multiply(a, b):
+	if a == 0 or b == 0: return 0
+	return EXP[LOG[a] + LOG[b]]
+
+def inverse(a):
+	if a == 0: raise ZeroDivisionError("0 has no inverse in GF(256).")
+	return EXP[255 - LOG[a]]
+
+# MULTIPLY[c] maps every byte x to c * x, for bytes.translate
+MULTIPLY = [bytes(multiply(c, x) for x in range(256)) for c in range(256)]
+
+def invert(matrix):
+	"""
+	Inverse of a square matrix over GF(256) by Gauss-Jordan elimination.
+
+	Raises
+	------
+	ValueError - if the matrix is singular.
+	"""
+	n = len(matrix)
+	rows = [list(row) + [1 if i == j else 0 for j in range(n)] for i, row in enumerate(matrix)]
+	for column in range(n):
+		pivot = next((r for r in range(column, n) if rows[r][column]), None)
+		if pivot is None: raise ValueError("Matrix is singular.")
+		rows[column], rows[pivot] = rows[pivot], rows[column]
+		scale = inverse(rows[column][column])
+		rows[column] = [multiply(scale, value) for value in rows[column]]
+		for r in range(n):
+			factor = rows[r][column]
+			if r != column and factor:
+				rows[r] = [value ^ multiply(factor, top) for value, top in zip(rows[r], rows[column])]
+	return [row[n:] for row in rows]
+
+def combine(matrix, payloads):
+	"""
+	Multiply a matrix over GF(256) by payloads, each one a row of bytes.
+
+	Parameters
+	----------
+	list of list of int - matrix - rows x len(payloads) coefficients.
+	list of bytes-like - payloads - all the same length.
+
+	Returns
+	-------
+	list of bytes - one payload per row of the matrix.
+	"""
+	size = len(payloads[0])
+	out = []
+	for row in matrix:
+		total = 0
+		for coefficient, payload in zip(row, payloads):
+			if coefficient: total ^= int.from_bytes(bytes(payload).translate(MULTIPLY[coefficient]), 'big')
+		out.append(total.to_bytes(size, 'big'))
+	return out
+
+class Code():
+	"""
+	Systematic Reed-Solomon erasure code: k data payloads (shards 0 to k-1) and m parity payloads (shards k to k+m-1).
+
+	Parameters
+	----------
+	int - k - data payloads per block.
+	int - m - parity payloads per block.
+
+	Raises
+	------
+	ValueError - if k or m is below 1 or k + m is more than MAX_SHARDS.
+	"""
+
+	def __init__(self, k, m):
+		if k < 1 or m < 1 or k + m > MAX_SHARDS:
+			raise ValueError("An erasure code of " + str(k) + " + " + str(m) + " shards is outside 1 to " + str(MAX_SHARDS) + ".")
+		self.k = k
+		self.m = m
+		# Cauchy matrix 1 / (x_j + y_i), x and y distinct, so every square submatrix is invertible
+		self.parity = [[inverse((k + j) ^ i) for i in range(k)] for j in range(m)]
+		self.decoders = {} # (shards used, data shards missing) -> rows of the inverse that rebuild them
+
+	# Pid of parity shard k + j of block, the block covering data pids block * k to block * k + k - 1
+	def parityPid(self, block, j):
+		return PARITY | (block * self.m + j)
+
+	# Block and shard index of a parity pid
+	def parityShard(self, pid):
+		block, j = divmod(pid & ~PARITY, self.m)
+		return block, self.k + j
+
+	# Coefficients of shard index in terms of the data shards
+	def row(self, index):
+		if index < self.k: return [1 if i == index else 0 for i in range(self.k)]
+		return self.parity[index - self.k]
+
+	def encode(self, payloads):
+		"""
+		Parity payloads for a block.
+
+		Parameters
+		----------
+		list of bytes-like - payloads - the k data payloads, all the same length.
+
+		Returns
+		-------
+		list of bytes - the m parity payloads, shards k to k+m-1.
+
+		Raises
+		------
+		ValueError - if there are not k payloads of the same length.
+		"""
+		if len(payloads) != self.k or len(set(len(payload) for payload in payloads)) != 1:
+			raise ValueError("Encoding needs " + str(self.k) + " payloads of the same length.")
+		return combine(self.parity, payloads)
+
+	def decode(self, shards):
+		"""
+		Rebuild the data payloads missing from a block.
+
+		Parameters
+		----------
+		dict - shards - shard index: payload, for at least k of the shards that arrived, all the same length.
+
+		Returns
+		-------
+		dict - index: payload for every data shard (below k) that was not in shards.
+
+		Raises
+		------
+		ValueError - if fewer than k shards are given.
+		"""
+		missing = [i for i in range(self.k) if i not in shards]
+		if not missing: return {}
+		if len(shards) < self.k:
+			raise ValueError("A block needs " + str(self.k) + " shards to rebuild, got " + str(len(shards)) + ".")
+		# Every data shard that arrived, then as many parity shards as are needed to make up the rest
+		use = [i for i in range(self.k) if i in shards]
+		use += sorted(i for i in shards if i >= self.k)[:len(missing)]
+		key = (tuple(use), tuple(missing))
+		decoder = self.decoders.get(key)
+		if decoder is None:
+			matrix = invert([self.row(index) for index in use])
+			decoder = self.decoders[key] = [matrix[i] for i in missing]
+		return dict(zip(missing, combine(decoder, [shards[index] for index in use])))
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# qpaceFEC.py
+# Q-Pace project, Center for Microgravity Research
+# University of Central Florida
+#
+# Triple modular redundancy (TMR) for the data field of DATA frames. The payload is sent three
+# times and the receiver takes the bitwise majority of the copies, so any bit that is wrong in
+# only one copy is corrected.
+#
+# The copies are interleaved at the full width of the field: copy k of byte i is always at
+# k * size + i, however short the payload is, and the unused end of every copy is padded the same.
+# Any two copies of a byte are size bytes apart, so a burst error of up to size bytes (a whole
+# 32 byte chunk included) can reach at most one of them. Packing the copies end to end at the
+# payload's own length, as DataPacket used to, left the copies of a short last packet only a few
+# bytes apart.
+#
+# decodeFrames() votes over a whole buffer of frames at once with NumPy if it's installed, and
+# every decode reports how many bits it corrected.
+#
+# Usage:
+#	field = encode(payload, size)                  # 3 * size bytes, size = the width of one copy
+#	payload, corrected = decode(field, size)
+#	payloads, corrected = decodeFrames(buffer, 128, 5, size)   # one row and one count per frame
+
+try:
+	import numpy
+except ImportError:
+	numpy = None # decodeFrames falls back to one frame at a time
+
+COPIES = 3
+PADDING = b' ' # Same as the DATA frame pads with
+
+# Set bits in every byte value, for counting corrected bits a byte at a time
+POPCOUNT = bytes(bin(i).count('1') for i in range(256))
+
+def width(field_size):
+	"""
+	Width of one copy when a field of field_size bytes holds all three.
+	"""
+	return field_size // COPIES
+
+def encode(data, size, padding = PADDING):
+	"""
+	The TMR field for data: the three copies, each padded to size bytes.
+
+	Parameters
+	----------
+	bytes-like - data - payload, at most size bytes.
+	int - size - width of one copy.
+	bytes - padding - Default: PADDING - single byte to pad the end of each copy with.
+
+	Returns
+	-------
+	bytes - COPIES * size bytes.
+
+	Raises
+	------
+	ValueError - if data is longer than size.
+	"""
+	if len(data) > size:
+		raise ValueError("Payload of " + str(len(data)) + " bytes does not fit a " + str(size) + " byte TMR copy.")
+	copy = bytes(data) + padding * (size - len(data))
+	return copy * COPIES
+
+def decode(field, size):
+	"""
+	Bitwise majority of the three copies in a TMR field.
+
+	Parameters
+	----------
+	bytes-like - field - at least COPIES * size bytes, as encode() lays them out.
+	int - size - width of one copy.
+
+	Returns
+	-------
+	bytes - the payload, size bytes. Trim off the padding if the payload was shorter.
+	int - bits that were corrected, that is bits where one copy disagreed with the other two.
+	"""
+	field = memoryview(field).cast('B')
+	a = int.from_bytes(field[:size], 'big')
+	b = int.from_bytes(field[size:2*size], 'big')
+	c = int.from_bytes(field[2*size:3*size], 'big')
+	majority = (a & b) | (a & c) | (b & c)
+	# Where the copies disagree exactly one of them is outvoted
+	corrected = bin((a ^ b) | (a ^ c)).count('1')
+	return majority.to_bytes(size, 'big'), corrected
+
+def decodeFrames(frames, frame_size, offset, size):
+	"""
+	Decode the TMR field of every frame in a buffer of back to back frames.
+
+	With NumPy the whole buffer is voted on in a few array operations, so the cost per frame is
+	a small fraction of what decode() costs.
+
+	Parameters
+	----------
+	bytes-like - frames - whole frames, one after the other.
+	int - frame_size - bytes per frame, e.g. qpaceCodec.FRAME_SIZE.
+	int - offset - where the TMR field starts in each frame, e.g. qpaceCodec.DATA.offset('data').
+	int - size - width of one copy.
+
+	Returns
+	-------
+	numpy.ndarray or list of bytes - the payload of each frame (a uint8 array of frames x size with NumPy).
+	numpy.ndarray or list of int - bits corrected in each frame.
+
+	Raises
+	------
+	ValueError - if the buffer is not a whole number of frames or the field does not fit in a frame.
+	"""
+	view = memoryview(frames).cast('B')
+	if len(view) % frame_size != 0:
+		raise ValueError("A buffer of " + str(len(view)) + " bytes is not a whole number of " + str(frame_size) + " byte frames.")
+	if offset + COPIES * size > frame_size:
+		raise ValueError("A TMR field of " + str(COPIES * size) + " bytes at " + str(offset) + " does not fit a " + str(frame_size) + " byte frame.")
+	if numpy is None:
+		decoded = [decode(view[start+offset:start+offset+COPIES*size], size) for start in range(0, len(view), frame_size)]
+		return [payload for payload, corrected in decoded], [corrected for payload, corrected in decoded]
+	copies = numpy.frombuffer(view, dtype=numpy.uint8).reshape(-1, frame_size)[:, offset:offset+COPIES*size].reshape(-1, COPIES, size)
+	a = copies[:, 0]
+	b = copies[:, 1]
+	c = copies[:, 2]
+	payloads = (a & b) | (a & c) | (b & c)
+	corrected = _POPCOUNT[(a ^ b) | (a ^ c)].sum(axis=1, dtype=numpy.int64)
+	return payloads, corrected
+
+if numpy is not None:
+	_POPCOUNT = numpy.frombuffer(POPCOUNT, dtype=numpy.uint8)
@@ -0,0 +1,818 @@
+#!/usr/bin/env python3
+# qpaceFakePigpio.py
+# Q-Pace project, Center for Microgravity Research
+# University of Central Florida
+#
+# Drop-in stand-in for the pigpio module with a timed model of the SC16IS750 on the I2C bus
+# and a scripted device on the far end of its UART, so the link code can be run and
+# benchmarked on any Linux machine.
+#
+# Usage:
+#	import qpaceFakePigpio as fake
+#	fake.install()                       # before anything imports pigpio
+#	chip = fake.VirtualSC16IS750()
+#	fake.attach(chip, addr = 0x4c, irq = 16)
+#	chip.connect(fake.EchoPeer())
+#
+#	dual = fake.attach(fake.VirtualSC16IS752(), addr = 0x48, irq = 17)
+#	dual.channels[1].connect(fake.Peer())
+#
+# The model follows whatever time.monotonic() says, so it runs in real time, or on simulated time
+# (deterministic, whatever the host is doing) with its time and threading from qpaceSimulation.
+
+import sys
+import time
+import random
+import threading
+import collections
+
+# pigpio constants used by the link code
+INPUT  = 0
+OUTPUT = 1
+RISING_EDGE  = 0
+FALLING_EDGE = 1
+EITHER_EDGE  = 2
+PUD_OFF  = 0
+PUD_DOWN = 1
+PUD_UP   = 2
+TIMEOUT = 2
+
+# i2c_zip commands
+ZIP_END     = 0
+ZIP_ESCAPE  = 1
+ZIP_START   = 2
+ZIP_STOP    = 3
+ZIP_ADDRESS = 4
+ZIP_FLAGS   = 5
+ZIP_READ    = 6
+ZIP_WRITE   = 7
+
+# pigpio error codes returned or raised by the fake
+PI_BAD_HANDLE   = -25
+PI_I2C_OPEN_FAILED = -71
+PI_I2C_WRITE_FAILED = -82
+PI_BAD_I2C_CMD = -97
+
+_errors = {
+	PI_BAD_HANDLE: "unknown handle",
+	PI_I2C_OPEN_FAILED: "can't open I2C device",
+	PI_I2C_WRITE_FAILED: "I2C write failed",
+	PI_BAD_I2C_CMD: "bad i2c/spi/ser command",
+}
+
+# Register addresses, as in the datasheet (subaddress = register << 3 | channel << 1)
+REG_RHR       = 0x00
+REG_IER       = 0x01
+REG_IIR       = 0x02
+REG_LCR       = 0x03
+REG_MCR       = 0x04
+REG_LSR       = 0x05
+REG_MSR       = 0x06
+REG_SPR       = 0x07
+REG_TXLVL     = 0x08
+REG_RXLVL     = 0x09
+REG_IODIR     = 0x0A
+REG_IOSTATE   = 0x0B
+REG_IOINTENA  = 0x0C
+REG_IOCONTROL = 0x0E
+REG_EFCR      = 0x0F
+
+FIFO_SIZE = 64
+
+# Relative baud rate error beyond which the receiving end sees garbage with a framing error
+LINE_TOLERANCE = 0.025
+
+# Most characters the chip sends before the peer sees them. A peer that answers (e.g. an echo) would
+# otherwise have its whole reply land in the RX FIFO at once when TX is delivered late
+TX_DELIVERY_CHARS = 8
+
+# Default I2C timing: 400 kHz bus plus the pigpio daemon round trip per transaction
+I2C_CLOCK = 400000
+I2C_OVERHEAD = 60e-6
+# Time from a GPIO edge to its callback, which pigpio delivers through the daemon's notification pipe
+CALLBACK_LATENCY = 200e-6
+
+class error(Exception):
+	"""pigpio module exception"""
+	def __init__(self, value):
+		self.value = value
+	def __str__(self):
+		return repr(self.value)
+
+def error_text(errnum):
+	return _errors.get(errnum, "unknown error (" + str(errnum) + ")")
+
+# pigpio ticks are microseconds since boot, wrapping at 32 bits
+def _tick(t = None):
+	return int((time.monotonic() if t is None else t) * 1000000) & 0xFFFFFFFF
+
+class Peer:
+	"""
+	Far end of the virtual UART. Subclasses override received() to react to bytes from the chip
+	and call send() to answer. A baudrate of None follows whatever the chip is set to, otherwise
+	a mismatch of more than LINE_TOLERANCE garbles the characters in both directions.
+	"""
+
+	def __init__(self, baudrate = None, charbits = 10, flow_control = False):
+		self.device = None
+		self.baudrate = baudrate
+		self.charbits = charbits
+		self.flow_control = flow_control # Hold off sending while the chip deasserts RTS
+		self.ready = True                # Our RTS, seen by the chip as CTS
+		self.rx = bytearray()            # Everything received from the chip
+
+	# Queue bytes to send to the chip, one character time each at the peer's baud rate
+	def send(self, data):
+		self.device.peer_send(data)
+
+	# Called by the device for every character that arrives from the chip
+	def deliver(self, byte):
+		self.rx.append(byte)
+		self.received(byte)
+
+	def received(self, byte):
+		pass
+
+	# Deassert (False) or assert (True) our RTS line, pausing the chip's TX if it uses auto CTS
+	def set_ready(self, ready):
+		if self.device is None: self.ready = ready
+		else: self.device.peer_ready(ready)
+
+class EchoPeer(Peer):
+	"""Sends every byte it receives straight back."""
+
+	def received(self, byte):
+		self.send(bytes([byte]))
+
+class ScriptedPeer(Peer):
+	"""
+	Plays a list of (expect, reply) steps in order. Each step waits until expect (bytes) has been
+	received, then sends reply. expect of None sends the reply as soon as the step is reached,
+	and reply may be a callable taking (peer, matched bytes) and returning the bytes to send.
+	done is set once every step has run.
+	"""
+
+	def __init__(self, script, **kwargs):
+		super().__init__(**kwargs)
+		self.script = collections.deque(script)
+		self.buffer = bytearray()
+		self.done = threading.Event()
+
+	def connected(self):
+		self.advance()
+
+	def received(self, byte):
+		self.buffer.append(byte)
+		self.advance()
+
+	def advance(self):
+		while self.script:
+			expect, reply = self.script[0]
+			matched = b''
+			if expect:
+				index = self.buffer.find(expect)
+				if index < 0: return
+				matched = bytes(self.buffer[index:index+len(expect)])
+				del self.buffer[:index+len(expect)]
+			self.script.popleft()
+			if callable(reply): reply = reply(self, matched)
+			if reply: self.send(reply)
+		self.done.set()
+
+class VirtualSC16IS750:
+	"""
+	Timed model of one SC16IS750 UART channel as seen over I2C.
+
+	Characters move through the 64 byte RX and TX FIFOs at the programmed baud rate, RXLVL, TXLVL,
+	LSR and IIR follow the FIFOs, and the IRQ line follows IIR including the RX timeout, FCR and TLR
+	trigger levels, and auto RTS/CTS with the TCR levels. State is advanced lazily to the time of
+	each bus access and by a ticker thread when the IRQ line is wired to a GPIO.
+	"""
+
+	def __init__(self, xtalfreq = 11059200, bit_error_rate = 0, seed = 0):
+		self.xtalfreq = xtalfreq
+		self.bit_error_rate = bit_error_rate
+		self.random = random.Random(seed)
+		self.lock = threading.RLock()
+		self.cond = threading.Condition(self.lock)
+		self.peer = None
+		self.parent = None
+		self.hardware = None
+		self.irq = None
+		self.ticker = None
+		self.running = False
+		self.stats = collections.Counter()
+		self.reset(time.monotonic())
+
+	# Power on / software reset state
+	def reset(self, now):
+		self.now = now
+		self.regs = {REG_IER: 0, REG_LCR: 0x1D, REG_MCR: 0, REG_SPR: 0xFF, REG_IODIR: 0, REG_IOSTATE: 0, REG_IOINTENA: 0, REG_IOCONTROL: 0, REG_EFCR: 0}
+		self.fcr = 0
+		self.efr = 0
+		self.dll = 0
+		self.dlh = 0
+		self.tlr = 0
+		self.tcr = 0
+		self.xon = [0, 0]
+		self.xoff = [0, 0]
+		self.rxfifo = collections.deque() # (byte, LSR error bits)
+		self.rxerrors = 0                 # Bytes in the RX FIFO with an error
+		self.overrun = False
+		self.txfifo = collections.deque() # (byte, time written)
+		self.tsr = None                   # Character in the TX shift register
+		self.tsr_done = now
+		self.tx_acked = False             # TX ready interrupt cleared by an IIR read
+		self.incoming = collections.deque() # Bytes the peer has queued for us
+		self.rx_done = None               # Time the character on the RX line completes
+		self.rx_last = now                # Last RX character or RHR read, for the RX timeout
+		self.rts = True                   # Our RTS output
+		self.irq_active = False
+		self.advancing = False
+
+	def connect(self, peer):
+		with self.lock:
+			self.peer = peer
+			peer.device = self
+		if hasattr(peer, 'connected'): peer.connected()
+		return peer
+
+	def notify(self):
+		with self.cond:
+			self.cond.notify_all()
+
+	# Baud rate programmed through DLL/DLH and the MCR[7] prescaler, None while the divisor is 0
+	def baudrate(self):
+		divisor = (self.dlh << 8) | self.dll
+		if divisor == 0: return None
+		prescaler = 4 if self.regs[REG_MCR] & 0x80 else 1
+		return self.xtalfreq / (prescaler * 16 * divisor)
+
+	def charbits(self):
+		lcr = self.regs[REG_LCR]
+		bits = 1 + 5 + (lcr & 0x03) + (2 if lcr & 0x04 else 1)
+		if lcr & 0x08: bits += 1
+		return bits
+
+	def char_time(self):
+		baudrate = self.baudrate()
+		return None if baudrate is None else self.charbits() / baudrate
+
+	def peer_char_time(self):
+		if self.peer is None or self.peer.baudrate is None: return self.char_time()
+		return self.peer.charbits / self.peer.baudrate
+
+	def enhanced(self):
+		return bool(self.efr & 0x10)
+
+	def rx_trigger(self):
+		if self.enhanced() and self.tlr >> 4: return (self.tlr >> 4) * 4
+		return (8, 16, 56, 60)[self.fcr >> 6]
+
+	def tx_trigger(self):
+		if self.enhanced() and self.tlr & 0x0F: return (self.tlr & 0x0F) * 4
+		return (8, 16, 32, 56)[(self.fcr >> 4) & 0x03]
+
+	# Character as seen by a receiver at receiver_baud when sent at sender_baud
+	def line(self, byte, sender_baud, receiver_baud):
+		if sender_baud is not None and receiver_baud is not None and abs(sender_baud - receiver_baud) > LINE_TOLERANCE * receiver_baud:
+			return ((byte * 0x9D + 0x35) & 0xFF, 0x08) # Framing error
+		if self.bit_error_rate:
+			for bit in range(8):
+				if self.random.random() < self.bit_error_rate: byte ^= 1 << bit
+		return (byte, 0)
+
+	# Queue bytes from the peer; the first starts on the line as soon as it is free
+	# A peer answering from deliver() is called mid-advance, so its reply starts at the current event time
+	def peer_send(self, data):
+		with self.cond:
+			if not self.advancing: self.advance(max(self.now, time.monotonic()))
+			self.incoming.extend(data)
+			self.start_rx(self.now)
+			self.cond.notify_all()
+
+	def peer_ready(self, ready):
+		with self.cond:
+			self.advance(max(self.now, time.monotonic()))
+			if self.tsr is None: self.tsr_done = max(self.tsr_done, self.now)
+			self.peer.ready = ready
+			self.cond.notify_all()
+
+	def peer_may_send(self):
+		if self.peer is not None and self.peer.flow_control: return self.rts
+		return True
+
+	def start_rx(self, at):
+		if self.rx_done is None and self.incoming and self.peer_may_send():
+			self.rx_done = at + self.peer_char_time()
+
+	# Bring the UART up to time now, one line event at a time
+	def advance(self, now):
+		if now <= self.now or self.advancing: return
+		self.advancing = True
+		while True:
+			# Next event on either line
+			events = []
+			if self.rx_done is not None: events.append(self.rx_done)
+			if self.tsr is not None: events.append(self.tsr_done)
+			elif self.txfifo and self.tx_may_send(): events.append(max(self.tsr_done, self.txfifo[0][1]))
+			t = min(events) if events else None
+			if t is None or t > now: break
+			self.now = t
+			if self.rx_done is not None and self.rx_done == t: self.rx_char(t)
+			elif self.tsr is not None and self.tsr_done == t: self.tx_char(t)
+			else: self.tx_start(t)
+		self.now = now
+		self.advancing = False
+
+	def tx_may_send(self):
+		if self.char_time() is None: return False
+		if self.efr & 0x80 and self.peer is not None and not self.peer.ready: return False
+		return True
+
+	def tx_start(self, t):
+		self.tsr = self.txfifo.popleft()[0]
+		self.tsr_done = t + self.char_time()
+
+	def tx_char(self, t):
+		byte = self.tsr
+		self.tsr = None
+		self.stats['tx_bytes'] += 1
+		if self.regs[REG_MCR] & 0x10: # Local loopback
+			self.rx_store(byte, 0, t)
+		elif self.peer is not None:
+			self.peer.deliver(self.line(byte, self.baudrate(), self.peer.baudrate)[0])
+
+	def rx_char(self, t):
+		byte = self.incoming.popleft()
+		self.rx_done = None
+		if self.char_time() is not None and not self.regs[REG_MCR] & 0x10:
+			peer_baud = None if self.peer is None else self.peer.baudrate
+			byte, flags = self.line(byte, peer_baud, self.baudrate())
+			self.rx_store(byte, flags, t)
+		if self.incoming: self.start_rx(t)
+
+	def rx_store(self, byte, flags, t):
+		if len(self.rxfifo) >= FIFO_SIZE:
+			self.overrun = True
+			self.stats['overruns'] += 1
+			return
+		self.rxfifo.append((byte, flags))
+		if flags: self.rxerrors += 1
+		self.rx_last = t
+		self.stats['rx_bytes'] += 1
+		self.update_rts()
+
+	# Auto RTS (EFR[6]) follows the TCR halt/resume levels, otherwise MCR[1]
+	def update_rts(self):
+		if self.efr & 0x40:
+			halt = (self.tcr & 0x0F) * 4
+			resume = (self.tcr >> 4) * 4
+			if len(self.rxfifo) >= halt: self.rts = False
+			elif len(self.rxfifo) <= resume: self.rts = True
+		else:
+			self.rts = bool(self.regs[REG_MCR] & 0x02)
+		if self.rts: self.start_rx(self.now)
+
+	def rx_timeout_at(self):
+		if not self.rxfifo or not self.regs[REG_IER] & 0x01 or self.char_time() is None: return None
+		return self.rx_last + 4 * self.char_time()
+
+	def iir(self, now):
+		ier = self.regs[REG_IER]
+		fifo_bits = 0xC0 if self.fcr & 0x01 else 0
+		if ier & 0x04 and (self.rxerrors or self.overrun): return fifo_bits | 0x06
+		timeout = self.rx_timeout_at()
+		if timeout is not None and now >= timeout: return fifo_bits | 0x0C
+		if ier & 0x01 and len(self.rxfifo) >= self.rx_trigger(): return fifo_bits | 0x04
+		if ier & 0x02 and not self.tx_acked and FIFO_SIZE - len(self.txfifo) >= self.tx_trigger(): return fifo_bits | 0x02
+		return fifo_bits | 0x01
+
+	def lsr(self):
+		lsr = 0
+		if self.rxfifo:
+			lsr |= 0x01 | self.rxfifo[0][1]
+		if self.overrun: lsr |= 0x02
+		if not self.txfifo: lsr |= 0x20
+		if not self.txfifo and self.tsr is None: lsr |= 0x40
+		if self.rxerrors: lsr |= 0x80
+		return lsr
+
+	# Which register a subaddress selects in the current bank
+	def select(self, reg):
+		lcr = self.regs[REG_LCR]
+		if lcr & 0x80 and reg in (0x00, 0x01): return ('DLL', 'DLH')[reg]
+		if lcr == 0xBF and reg == 0x02: return 'EFR'
+		if lcr == 0xBF and 0x04 <= reg <= 0x07: return ('XON1', 'XON2', 'XOFF1', 'XOFF2')[reg-4]
+		if self.enhanced() and self.regs[REG_MCR] & 0x04 and reg in (0x06, 0x07): return ('TCR', 'TLR')[reg-6]
+		return reg
+
+	def read(self, sub, now):
+		with self.cond:
+			self.advance(now)
+			reg = self.select((sub >> 3) & 0x0F)
+			if reg == 'DLL': value = self.dll
+			elif reg == 'DLH': value = self.dlh
+			elif reg == 'EFR': value = self.efr
+			elif reg == 'TCR': value = self.tcr
+			elif reg == 'TLR': value = self.tlr
+			elif reg in ('XON1', 'XON2'): value = self.xon[reg == 'XON2']
+			elif reg in ('XOFF1', 'XOFF2'): value = self.xoff[reg == 'XOFF2']
+			elif reg == REG_RHR:
+				value = 0
+				if self.rxfifo:
+					value, flags = self.rxfifo.popleft()
+					if flags: self.rxerrors -= 1
+					self.rx_last = now
+					self.update_rts()
+			elif reg == REG_IIR:
+				value = self.iir(now)
+				if value & 0x3F == 0x02: self.tx_acked = True
+			elif reg == REG_LSR:
+				value = self.lsr()
+				self.overrun = False
+			elif reg == REG_MSR:
+				value = 0x10 if self.peer is None or self.peer.ready else 0x00
+			elif reg == REG_TXLVL: value = FIFO_SIZE - len(self.txfifo)
+			elif reg == REG_RXLVL: value = len(self.rxfifo)
+			elif reg == REG_IOCONTROL: value = self.regs[reg] & 0x07
+			else: value = self.regs.get(reg, 0)
+			self.cond.notify_all()
+			return value
+
+	# Return False if the chip NACKs the write (as it does for a software reset)
+	def write(self, sub, value, now):
+		with self.cond:
+			self.advance(now)
+			reg = self.select((sub >> 3) & 0x0F)
+			ack = True
+			if reg == 'DLL': self.dll = value
+			elif reg == 'DLH': self.dlh = value
+			elif reg == 'EFR': self.efr = value
+			elif reg == 'TCR': self.tcr = value
+			elif reg == 'TLR': self.tlr = value
+			elif reg in ('XON1', 'XON2'): self.xon[reg == 'XON2'] = value
+			elif reg in ('XOFF1', 'XOFF2'): self.xoff[reg == 'XOFF2'] = value
+			elif reg == REG_RHR:
+				if len(self.txfifo) < FIFO_SIZE: self.txfifo.append((value, now))
+				self.tx_acked = False
+			elif reg == 0x02: # FCR
+				if value & 0x02:
+					self.rxfifo.clear()
+					self.rxerrors = 0
+				if value & 0x04:
+					self.txfifo.clear()
+				keep = 0x30 if not self.enhanced() else 0
+				self.fcr = (value & ~0x06 & ~keep) | (self.fcr & keep)
+			elif reg == REG_IER:
+				if not self.enhanced(): value = (value & 0x0F) | (self.regs[REG_IER] & 0xF0)
+				self.regs[REG_IER] = value
+			elif reg == REG_MCR:
+				if not self.enhanced(): value = (value & 0x1B) | (self.regs[REG_MCR] & 0xE4)
+				self.regs[REG_MCR] = value
+			elif reg == REG_IOCONTROL and value & 0x08:
+				self.reset(now)
+				ack = False
+			elif reg in (REG_LSR, REG_MSR, REG_TXLVL, REG_RXLVL):
+				pass
+			else:
+				self.regs[reg] = value
+			self.update_rts()
+			self.cond.notify_all()
+			return ack
+
+	# Drive the IRQ GPIO from IIR, queueing an edge whenever the level changes
+	def update_irq(self, now):
+		active = self.iir(now) & 0x01 == 0
+		if active != self.irq_active:
+			self.irq_active = active
+			if active: self.stats['irqs'] += 1
+			if self.parent is not None:
+				self.parent.update_irq(now)
+			elif self.hardware is not None and self.irq is not None:
+				self.hardware.set_level(self.irq, 0 if active else 1, now)
+
+	# Earliest time the IRQ line could change on its own or the peer is owed bytes, None if only a bus access can change anything
+	# Waking per character would cost the simulation more than the driver it is measuring, so TX is delivered
+	# TX_DELIVERY_CHARS at a time; the peer still sees each byte at its own simulated time
+	def next_event(self, now):
+		events = []
+		if (self.tsr is not None or self.txfifo) and self.tx_may_send():
+			start = self.tsr_done if self.tsr is not None else max(self.tsr_done, self.txfifo[0][1])
+			events.append(start + min(len(self.txfifo), TX_DELIVERY_CHARS) * self.char_time())
+		if self.irq_active: return min([t for t in events if t > now], default = None)
+		ier = self.regs[REG_IER]
+		timeout = self.rx_timeout_at()
+		if timeout is not None: events.append(timeout)
+		if self.rx_done is not None:
+			if ier & 0x04 and (self.bit_error_rate or self.peer is not None and self.peer.baudrate is not None):
+				events.append(self.rx_done) # The next character may carry an error
+			elif ier & 0x01:
+				# Wake when the trigger level is reached, or after the last queued character to start the RX timeout
+				need = min(self.rx_trigger() - len(self.rxfifo), len(self.incoming))
+				events.append(self.rx_done + (max(need, 1) - 1) * self.peer_char_time())
+		if ier & 0x02 and self.tsr is not None: events.append(self.tsr_done)
+		events = [t for t in events if t > now]
+		return min(events) if events else None
+
+	def start(self):
+		with self.lock:
+			if self.running: return
+			self.running = True
+		self.ticker = threading.Thread(target = self.tick, daemon = True)
+		self.ticker.start()
+
+	def stop(self):
+		with self.cond:
+			self.running = False
+			self.cond.notify_all()
+		if self.ticker is not None and self.ticker is not threading.current_thread(): self.ticker.join()
+
+	# Ticker thread: advance the model at each line event so the IRQ line moves on its own
+	def tick(self):
+		with self.cond:
+			while self.running:
+				now = time.monotonic()
+				self.advance(now)
+				self.update_irq(now)
+				wake = self.next_event(now)
+				self.cond.wait(None if wake is None else max(wake - now, 0))
+
+class VirtualSC16IS752:
+	"""
+	Dual UART: two VirtualSC16IS750 channels behind one I2C address, selected by subaddress bits 2:1.
+	The GPIO registers and software reset are shared, and the open drain IRQ line is low while
+	either channel needs service.
+	"""
+
+	def __init__(self, xtalfreq = 11059200, bit_error_rate = 0, seed = 0):
+		self.channels = [VirtualSC16IS750(xtalfreq, bit_error_rate, seed + n) for n in range(2)]
+		for channel in self.channels: channel.parent = self
+		self.lock = threading.Lock()
+		self.hardware = None
+		self.irq = None
+		self.irq_active = False
+		self.stats = collections.Counter()
+
+	def channel(self, sub):
+		if REG_IODIR <= (sub >> 3) & 0x0F <= REG_IOCONTROL: return self.channels[0]
+		return self.channels[(sub >> 1) & 0x01]
+
+	def read(self, sub, now):
+		return self.channel(sub).read(sub, now)
+
+	def write(self, sub, value, now):
+		if (sub >> 3) & 0x0F == REG_IOCONTROL and value & 0x08:
+			for channel in self.channels: channel.write(sub, value, now)
+			return False
+		return self.channel(sub).write(sub, value, now)
+
+	def update_irq(self, now):
+		with self.lock:
+			active = any(channel.irq_active for channel in self.channels)
+			if active == self.irq_active: return
+			self.irq_active = active
+			if active: self.stats['irqs'] += 1
+			if self.hardware is not None and self.irq is not None:
+				self.hardware.set_level(self.irq, 0 if active else 1, now)
+
+	def notify(self):
+		for channel in self.channels: channel.notify()
+
+	def start(self):
+		for channel in self.channels: channel.start()
+
+	def stop(self):
+		for channel in self.channels: channel.stop()
+
+class _FairLock:
+	"""Lock granted in request order, the way the pigpio daemon queues requests from its clients."""
+
+	def __init__(self):
+		self.cond = threading.Condition()
+		self.next = 0
+		self.serving = 0
+
+	def __enter__(self):
+		with self.cond:
+			ticket = self.next
+			self.next += 1
+			while self.serving != ticket: self.cond.wait()
+
+	def __exit__(self, *args):
+		with self.cond:
+			self.serving += 1
+			self.cond.notify_all()
+
+class _callback:
+	def __init__(self, hardware, gpio, edge, func):
+		self.hardware = hardware
+		self.gpio = gpio
+		self.edge = edge
+		self.func = func
+		self.count = 0
+
+	def cancel(self):
+		self.hardware.remove_callback(self)
+
+	def tally(self):
+		return self.count
+
+	def reset_tally(self):
+		self.count = 0
+
+class Hardware:
+	"""
+	Everything the fake pi objects share: I2C devices by (bus, address), GPIO levels and edge callbacks.
+	Transactions on the bus are serialized and take as long as they would at I2C_CLOCK.
+	Edges are queued and delivered to callbacks from one thread, as the pigpio library does, latency after the edge.
+	"""
+
+	def __init__(self, clock = I2C_CLOCK, overhead = I2C_OVERHEAD, latency = CALLBACK_LATENCY):
+		self.clock = clock
+		self.overhead = overhead
+		self.latency = latency
+		self.devices = {}
+		self.handles = {}
+		self.levels = collections.defaultdict(lambda: 1)
+		self.modes = {}
+		self.callbacks = []
+		self.buslock = _FairLock()
+		self.edges = collections.deque()
+		self.edgecond = threading.Condition()
+		self.dispatcher = None
+
+	def attach(self, device, addr = 0x48, bus = 1, irq = None):
+		self.devices[(bus, addr)] = device
+		device.hardware = self
+		device.irq = irq
+		if irq is not None:
+			self.levels[irq] = 1
+			device.start()
+		return device
+
+	def shutdown(self):
+		for device in self.devices.values(): device.stop()
+		with self.edgecond:
+			self.dispatcher = None
+			self.edgecond.notify_all()
+
+	def set_level(self, gpio, level, now):
+		if self.levels[gpio] == level: return
+		self.levels[gpio] = level
+		with self.edgecond:
+			self.edges.append((gpio, level, _tick(now), now))
+			self.edgecond.notify_all()
+
+	def add_callback(self, cb):
+		with self.edgecond:
+			self.callbacks.append(cb)
+			if self.dispatcher is None:
+				self.dispatcher = threading.Thread(target = self.dispatch, daemon = True)
+				self.dispatcher.start()
+
+	def remove_callback(self, cb):
+		with self.edgecond:
+			if cb in self.callbacks: self.callbacks.remove(cb)
+
+	def dispatch(self):
+		me = threading.current_thread()
+		while True:
+			with self.edgecond:
+				while not self.edges and self.dispatcher is me: self.edgecond.wait()
+				if self.dispatcher is not me: return
+				gpio, level, tick, at = self.edges.popleft()
+				callbacks = [cb for cb in self.callbacks if cb.gpio == gpio and (cb.edge == EITHER_EDGE or cb.edge == (FALLING_EDGE if level == 0 else RISING_EDGE))]
+			self.sleep_until(at + self.latency)
+			for cb in callbacks:
+				cb.count += 1
+				if cb.func is not None: cb.func(gpio, level, tick)
+
+	def zip(self, handle, data):
+		if handle not in self.handles: return (PI_BAD_HANDLE, bytearray())
+		device = self.handles[handle]
+		out = bytearray()
+		ops = []
+		i = 0
+		escape = False
+		while i < len(data):
+			cmd = data[i]
+			if cmd == ZIP_END: break
+			elif cmd == ZIP_ESCAPE: escape = True; i += 1; continue
+			elif cmd in (ZIP_START, ZIP_STOP): i += 1
+			elif cmd == ZIP_ADDRESS: i += 2
+			elif cmd == ZIP_FLAGS: i += 3
+			elif cmd in (ZIP_READ, ZIP_WRITE):
+				if escape: count = data[i+1] | (data[i+2] << 8); i += 3
+				else: count = data[i+1]; i += 2
+				if cmd == ZIP_WRITE:
+					ops.append((cmd, list(data[i:i+count])))
+					i += count
+				else:
+					ops.append((cmd, count))
+			else:
+				return (PI_BAD_I2C_CMD, bytearray())
+			escape = False
+
+		with self.buslock:
+			t = time.monotonic() + self.overhead
+			start = t
+			sub = 0
+			for cmd, arg in ops:
+				# One address byte per segment plus the data, 9 clocks per byte
+				if cmd == ZIP_WRITE:
+					t += 9 * (1 + len(arg)) / self.clock
+					if arg: sub = arg[0]
+					for value in arg[1:]:
+						if not device.write(sub, value, t):
+							self.sleep_until(t)
+							raise error(error_text(PI_I2C_WRITE_FAILED))
+				else:
+					t += 9 * (1 + arg) / self.clock
+					for _ in range(arg): out.append(device.read(sub, t))
+			device.stats['transactions'] += 1
+			device.stats['i2c_time'] += t - start + self.overhead
+			self.sleep_until(t)
+		device.notify()
+		return (len(out), out)
+
+	def sleep_until(self, t):
+		delay = t - time.monotonic()
+		if delay > 0: time.sleep(delay)
+
+hardware = Hardware()
+
+class pi:
+	"""Fake of pigpio.pi backed by the shared Hardware."""
+
+	def __init__(self, host = None, port = None, show_errors = True):
+		self.hardware = hardware
+		self.connected = True
+
+	def stop(self):
+		self.connected = False
+
+	def get_current_tick(self):
+		return _tick()
+
+	def set_mode(self, gpio, mode):
+		self.hardware.modes[gpio] = mode
+		return 0
+
+	def get_mode(self, gpio):
+		return self.hardware.modes.get(gpio, INPUT)
+
+	def set_pull_up_down(self, gpio, pud):
+		return 0
+
+	def read(self, gpio):
+		return self.hardware.levels[gpio]
+
+	def write(self, gpio, level):
+		self.hardware.set_level(gpio, level, time.monotonic())
+		return 0
+
+	def callback(self, user_gpio, edge = RISING_EDGE, func = None):
+		cb = _callback(self.hardware, user_gpio, edge, func)
+		self.hardware.add_callback(cb)
+		return cb
+
+	def i2c_open(self, i2c_bus, i2c_address, i2c_flags = 0):
+		device = self.hardware.devices.get((i2c_bus, i2c_address))
+		if device is None: raise error(error_text(PI_I2C_OPEN_FAILED))
+		handle = len(self.hardware.handles)
+		self.hardware.handles[handle] = device
+		return handle
+
+	def i2c_close(self, handle):
+		if handle not in self.hardware.handles: raise error(error_text(PI_BAD_HANDLE))
+		del self.hardware.handles[handle]
+		return 0
+
+	def i2c_zip(self, handle, data):
+		count, out = self.hardware.zip(handle, data)
+		if count < 0: raise error(error_text(count))
+		return (count, out)
+
+	def i2c_read_byte_data(self, handle, reg):
+		count, out = self.i2c_zip(handle, [ZIP_WRITE, 1, reg, ZIP_READ, 1, ZIP_END])
+		return out[0]
+
+	def i2c_write_byte_data(self, handle, reg, byte_val):
+		self.i2c_zip(handle, [ZIP_WRITE, 2, reg, byte_val, ZIP_END])
+		return 0
+
+# Make "import pigpio" resolve to this module, replacing the real library if it was already imported
+def install():
+	sys.modules['pigpio'] = sys.modules[__name__]
+	return sys.modules[__name__]
+
+def attach(device, addr = 0x48, bus = 1, irq = None):
+	return hardware.attach(device, addr, bus, irq)
+
+# Stop all devices and start over with an empty bus (between benchmark runs)
+def reset(clock = I2C_CLOCK, overhead = I2C_OVERHEAD, latency = CALLBACK_LATENCY):
+	global hardware
+	hardware.shutdown()
+	hardware = Hardware(clock, overhead, latency)
+	return hardware
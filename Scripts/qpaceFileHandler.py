@@ -12,6 +12,15 @@ import qpaceLogger as logger
 from qpaceInterpreter import ROUTES
 from qpacePiCommands import CMDPacket
 from math import ceil
+import os
+import mmap
+import qpaceCodec as codec
+import qpaceARQ
+import qpaceFEC
+import qpaceErasure
+import qpaceJournal
+import qpaceCompression
+import time
 
 class Corrupted(Exception):
 	def __init__(self, message):
@@ -71,7 +80,7 @@ class DataPacket():
 
 		headerSize = DataPacket.xtea_header_size if xtea else DataPacket.header_size
 		if useFEC:
-			DataPacket.data_size = (DataPacket.max_size - headerSize) // 3
+			DataPacket.data_size = qpaceFEC.width(DataPacket.max_size - headerSize)
 		else:
 			DataPacket.data_size = DataPacket.max_size - headerSize
 		# Is the data size set yet or is it valid?
@@ -94,7 +103,6 @@ class DataPacket():
 			self.bytes = data_in_bytes
 			self.useFEC = useFEC
 			self.rid = rid
-			self.lastPacket = lastPacket
 			self.xtea = xtea
 		else:
 			raise ValueError("Packet size is too large for the current header information ("+str(len(data))+"). Data input restricted to " + str(DataPacket.data_size) + " Bytes.")
@@ -106,22 +114,18 @@ class DataPacket():
 
 			Returns
 			-------
-			int - the whole packet. if converted to binary/hex it will be the packet.
+			memoryview - the whole packet, packed into the reused buffer of qpaceCodec.DATA.
+						 Send or copy it before the next packet is built.
 		"""
-		# Construct the packet's data
-
-        # Do a TMR expansion where the data is replicated 3 times but not next to each other
-		# to avoid burst errors.
-        if self.useFEC:
-			data = self.data * 3
+		# Do a TMR expansion where the data is replicated 3 times but not next to each other
+		# to avoid burst errors. See qpaceFEC for the layout.
+		if self.useFEC:
+			data = qpaceFEC.encode(self.data, DataPacket.data_size)
 		else:
 			data = self.data
 
-		packet = self.rid.to_bytes(1,byteorder='big') + self.pid.to_bytes(4,byteorder='big') + data
-		# After constructing the packet's contents, pad the end of the packet until we reach the max size.
-		padding = DataPacket.max_size - len(packet)
-		packet += DataPacket.padding_byte * padding
-		return packet
+		# The layout pads the end of the data field with padding_byte until we reach the max size.
+		return codec.DATA.encode(self.rid, self.pid, data)
 
 	@staticmethod
 	def getParity(info):
@@ -134,198 +138,747 @@ class DataPacket():
 		return parity
 
 	def send(self,chip):
-		chip.block_write(chip.REG_THR, self.build())
+		return chip.write_all(self.build())
 
 class XTEAPacket():
 	pass
 
-class ChunkPacket():
-	chunks = []
-	complete = False
-
-	def __init__(self, chip):
-		self.chip = chip
+class Reassembler():
+	"""
+	Builds 128 byte packets out of the 32 byte chunks the WTC sends them in.
+
+	Each packet being assembled gets a slot from a pool allocated up front, and every chunk is
+	copied straight into its place in the slot through a memoryview, so nothing is allocated per chunk.
+	Partial packets are kept per key (normally the route the chunks arrived on), so two transfers
+	in flight at once can't mix. A chunk may carry its index, in which case chunks can arrive in any
+	order and a repeated chunk just overwrites itself. Without an index data is appended where the
+	last chunk left off, which also copes with a chunk arriving in more than one piece.
+	A partial packet that sees no data for timeout seconds is dropped and its slot reused.
+
+	Usage:
+		reassembler = Reassembler(onChunk = ack)
+		packet = reassembler.push('WTCROUTE', data)
+		if packet is not None:
+			... # packet is a memoryview into the pool
+			reassembler.release(packet)
+	"""
+	packet_size = 128
+	chunk_size = 32
+
+	class Partial():
+		def __init__(self, slot, view):
+			self.slot = slot
+			self.view = view
+			self.received = 0  # Bitmask of chunks filled in
+			self.offset = 0    # Where the next chunk without an index goes
+			self.deadline = time.monotonic()
+
+	def __init__(self, slots = 8, timeout = 5, onChunk = None):
+		"""
+		Parameters
+		----------
+		int - slots - Default: 8 - packets that can be assembled or held by the caller at once.
+		float - timeout - Default: 5 - seconds a partial packet is kept without receiving anything.
+		callable - onChunk - Default: None - called with (key, chunk index) each time a chunk is completed,
+								e.g. to acknowledge it to the WTC.
+		"""
+		self.chunks = self.packet_size // self.chunk_size
+		self.complete = (1 << self.chunks) - 1
+		self.timeout = timeout
+		self.onChunk = onChunk
+		self.pool = bytearray(slots * self.packet_size)
+		self.views = [memoryview(self.pool)[n*self.packet_size:(n+1)*self.packet_size] for n in range(slots)]
+		self.free = list(range(slots))
+		self.partials = {}  # key -> Partial, oldest first
+		self.stats = {'packets': 0, 'duplicates': 0, 'expired': 0, 'evicted': 0}
+
+	def push(self, key, data, index = None):
+		"""
+		Add a chunk to the packet being assembled for key.
 
-	def push(self,data):
-		if not self.complete:
-			self.chunks.append(data)
-			#Acknowledge WTC with chunk number
-			sendBytesToCCDR(self.chip,0x60 + len(self.chunks)) # Defined by WTC state machine
-			print('Chunk:' ,len(self.chunks))
-			if len(self.chunks) == 4: # We are doing 4 chunks!
-				self.complete = True
+		Parameters
+		----------
+		key - any hashable, normally the route the data came in on.
+		bytes-like - data - a whole chunk if index is given, otherwise any number of bytes.
+		int - index - Default: None - position of the chunk in the packet (0 to 3).
+
+		Returns
+		-------
+		memoryview - the packet once all of its chunks are in, otherwise None.
+					 It stays valid until it is given back with release().
+
+		Raises
+		------
+		ValueError - if an indexed chunk is the wrong size or out of range.
+		"""
+		self.expire()
+		data = memoryview(data).cast('B')
+		partial = self.partials.get(key)
+		if partial is None:
+			partial = self.start(key)
+		if index is not None:
+			if index < 0 or index >= self.chunks or len(data) != self.chunk_size:
+				raise ValueError("Chunk " + str(index) + " of " + str(len(data)) + " bytes does not fit a " + str(self.packet_size) + " byte packet.")
+			if partial.received & (1 << index):
+				self.stats['duplicates'] += 1
+			start = index * self.chunk_size
+			partial.view[start:start+self.chunk_size] = data
+			self.filled(key, partial, index)
 		else:
-			print('Chunk is complete')
-			self.complete = True
-
-	def build(self):
-		print('Building a packet!')
-		packet = b''
-		for chunk in self.chunks:
-			packet += chunk
-		if len(packet) != 128: print("Packet is not 128 bytes!") #TODO what should we actually do here.
-		self.chunks[:] = []
-		self.complete = False
-		return packet
-
-class TransmitCompletePacket(Packet):
-    def __init__(self, pathname, checksum, pid,rid,useFEC = False):
-            data = b'\x04\x04' + checksum + b'\x00' + pathname
-            data += (116 - len(data)) * b'\x04' if len(data) < 116 else b''
-            data = data[:116] # only get the first 116 chars. Defined by the packet document
-            data += CMDPacket.generateChecksum(data)
-        super(Packet,self).__init__(data,pid,rid,useFEC)
+			while len(data) > 0:
+				take = min(len(data), self.packet_size - partial.offset)
+				partial.view[partial.offset:partial.offset+take] = data[:take]
+				before = partial.offset // self.chunk_size
+				partial.offset += take
+				data = data[take:]
+				for chunk in range(before, partial.offset // self.chunk_size):
+					self.filled(key, partial, chunk)
+				if partial.offset == self.packet_size and len(data) > 0:
+					# The rest belongs to the next packet, which can only start once this one is handed over
+					logger.logError("Reassembler: " + str(len(data)) + " bytes past the end of a packet from " + str(key) + " were dropped.")
+					break
+		partial.deadline = time.monotonic() + self.timeout
+		if partial.received != self.complete:
+			return None
+		del self.partials[key]
+		self.stats['packets'] += 1
+		return partial.view
+
+	def start(self, key):
+		if not self.free:
+			# Every slot is taken, so the partial packet that has been around longest gives its slot up
+			for oldest, partial in self.partials.items():
+				self.drop(oldest)
+				self.stats['evicted'] += 1
+				break
+			if not self.free: raise BufferError("Every reassembly slot is held by a finished packet.")
+		slot = self.free.pop()
+		partial = self.Partial(slot, self.views[slot])
+		self.partials[key] = partial
+		return partial
+
+	def filled(self, key, partial, index):
+		partial.received |= 1 << index
+		if self.onChunk is not None: self.onChunk(key, index)
+
+	# Give a finished packet's slot back to the pool
+	def release(self, packet):
+		self.free.append(next(n for n, view in enumerate(self.views) if view is packet))
+
+	def drop(self, key):
+		partial = self.partials.pop(key)
+		self.free.append(partial.slot)
+
+	# Drop partial packets that have not seen data within the timeout
+	def expire(self, now = None):
+		now = time.monotonic() if now is None else now
+		for key in [key for key, partial in self.partials.items() if partial.deadline < now]:
+			logger.logSystem([["Reassembler: Dropped a partial packet from " + str(key) + " that timed out."]])
+			self.drop(key)
+			self.stats['expired'] += 1
+
+	def pending(self, key):
+		partial = self.partials.get(key)
+		return 0 if partial is None else bin(partial.received).count('1')
+
+def readFrame(chip, view, timeout, chunkTimeout):
+	"""
+	Read one 128 byte frame from the chip into view, as the 4 chunks of 32 bytes the WTC sends it in.
+
+	Parameters
+	----------
+	SC16IS750 - chip - the chip to read from.
+	memoryview - view - 128 bytes to read into.
+	float - timeout - time (s) to wait for the first chunk to arrive, None to wait for ever. With 0 a frame is
+	only read if its first chunk is already in. Either way the rest of the frame is waited for with chunkTimeout.
+	float - chunkTimeout - time (s) to wait for each chunk once the frame has started.
+
+	Returns
+	-------
+	bool - True once the frame is in view, False if it did not arrive in time.
+	"""
+	discard = bytearray(1)
+	count = 0
+	# Nothing is taken off the chip until the first chunk is in, so a frame that starts late is read whole next time
+	if not chip.wait(32, timeout):
+		return False
+
+	for i in range(0,4): #We will receive 4, 32 byte chunks to make a 128 packet
+		try:
+			# Wait for the rest of this chunk, reading straight into the packet buffer.
+			count += chip.read_into(view[count:(i+1)*32], chunkTimeout)
+			if count < (i+1)*32:
+				raise BlockingIOError("Timeout has occurred...")
+		except BlockingIOError:
+			# TODO Alert WTC?
+			logger.logSystem([["readFrame: Timeout occurred while waiting for a chunk."]])
+			return False
+		except BufferError as err:
+			logger.logError("A BufferError was thrown.",err)
+			raise BufferError("A BufferError was thrown.") from err
+		chip.read_into(discard, chunkTimeout)# Clear the buffer. WTC will send ERRNONE
+	return True
+
+class TransmitCompletePacket(DataPacket):
+	def __init__(self, pathname, checksum, pid,rid,useFEC = False):
+		layout = codec.TRANSMIT_COMPLETE
+		data = bytearray(layout.size)
+		# Pathname is cut to fit and padded with 0x04. Defined by the packet document
+		layout.encode_into(data, 0, codec.TRANSMIT_COMPLETE_MARKER, checksum, pathname, b'')
+		body = layout.offset('checksum')
+		data[body:] = CMDPacket.generateChecksum(data[:body])
+		super(TransmitCompletePacket,self).__init__(data,pid,rid,useFEC)
 
 class DownloadRequest():
 	pass
 
+class Packetizer():
+	"""
+	A file split into payloads of data_size bytes, the payload for pid starting at byte pid * data_size.
+
+	The file is memory mapped rather than read, so a payload is only read from the card when it is
+	asked for and the pages already sent can be dropped again: memory use is the same for a status
+	file as for a GoPro video, and the first packet can go out without reading the rest of the file.
+	Any pid can be fetched directly, for resends or a firstPacket to lastPacket range.
+
+	Usage:
+		with Packetizer(pathname, data_size) as packets:
+			for pid, data in packets.iterate(first, last):
+				...
+			data = packets[pid]
+	"""
+
+	def __init__(self, pathname, data_size):
+		self.pathname = pathname
+		self.data_size = data_size
+		self.file = open(pathname, 'rb')
+		self.size = os.fstat(self.file.fileno()).st_size
+		if self.size == 0:
+			self.map = b'' # mmap can't map an empty file
+		else:
+			self.map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+			if hasattr(self.map, 'madvise'): self.map.madvise(mmap.MADV_SEQUENTIAL) # Read ahead, drop behind
+		self.count = ceil(self.size / data_size)
+
+	def __len__(self):
+		return self.count
+
+	def __getitem__(self, pid):
+		"""
+		Return the payload for pid as bytes, data_size bytes long except for the last one.
+
+		Raises
+		------
+		IndexError - if the file has no packet pid.
+		"""
+		if pid < 0 or pid >= self.count:
+			raise IndexError("Packet " + str(pid) + " is outside " + self.pathname + " (" + str(self.count) + " packets).")
+		start = pid * self.data_size
+		return self.map[start:start+self.data_size]
+
+	def iterate(self, first = 0, last = None):
+		"""
+		Yield (pid, payload) from first to last (inclusive, default the last packet), one at a time as they are asked for.
+		"""
+		last = self.count - 1 if last is None else min(last, self.count - 1)
+		for pid in range(max(first, 0), last + 1):
+			yield pid, self[pid]
+
+	def close(self):
+		if not isinstance(self.map, bytes): self.map.close()
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
 class Transmitter():
-    def __init__(self, chip, pathname, route, useFEC=False, packetsPerAck = 1, delayPerTransmit = 135, firstPacket = 1, lastPacket = None, xtea = False):
-        self.chip = chip
-        self.pathname = pathname
-        self.useFEC = useFEC
-        self.packetsPerAck = packetsPerAck
-        self.delayPerTransmit = delayperTransmit
-        self.firstPacket = firstPacket if firstPacket > 1 else 1
-        self.lastPacket = lastPacket if lastPacket > lastPacket else None
-        self.route = route
-        self.checksum = b' ' #TODO figure out the checksum stuff
+	"""
+	Sends a file over a route as DATA packets, pid 0 first, followed by a TransmitCompletePacket.
+	Payloads come from a Packetizer, so sending starts straight away and memory use does not grow with the file.
+
+	Packets go out with selective-repeat ARQ (qpaceARQ): up to window pids are outstanding at once,
+	the receiver's ACK frames say which have arrived and which are missing, and only the missing
+	ones are sent again. The TransmitCompletePacket is sent once every pid has been acknowledged, and
+	sent again on the ARQ's timeout until the receiver's final ACK for it (base past its pid) comes back,
+	at most complete_tries times.
+
+	With erasure set, m parity packets (qpaceErasure) follow every block of k data packets the first
+	time it goes out, and the receiver can rebuild up to m lost packets of the block from them
+	without waiting for a resend.
+
+	With journal set, every pid acknowledged is recorded in a qpaceJournal, and a Transmitter for the
+	same file and parameters on a later pass only sends the pids that were never acknowledged.
+
+	With compression set, what is packetized is the file's compressed artifact (qpaceCompression),
+	made once and cached, or the file itself if it does not compress. expected_packets and
+	packets.size are then those of the artifact, which is what the receiver has to be told.
+
+	Parameters
+	----------
+	SC16IS750 - chip - the chip to send on.
+	str - pathname - the file to send.
+	int - route - routing ID for the packets, see qpaceInterpreter.ROUTES.
+	bool - useFEC - Default: False - send every payload three times over in its packet.
+	int - window - Default: qpaceARQ.WINDOW - packets sent but not yet acknowledged at once.
+	float - delayPerTransmit - Default: 0 - time (s) to wait after each packet.
+	int - firstPacket - Default: 0 - first pid to send.
+	int - lastPacket - Default: None - last pid to send, the end of the file if None.
+	bool - xtea - Default: False - leave room in each packet for the XTEA header.
+	tuple - erasure - Default: None - (k, m) to send m parity packets after every k data packets. The receiver must use the same.
+	bool - journal - Default: False - keep a journal and resume from it, see qpaceJournal.
+	str - compression - Default: None - codec from qpaceCompression.CODECS, or 'auto' to pick one for the file.
+	"""
+	time_to_wait = 5 # Time (s) to wait for each chunk of an ACK once it has started
+	complete_tries = 4 # Times the TransmitCompletePacket is sent without a final ACK before giving up on one
+
+	def __init__(self, chip, pathname, route, useFEC=False, window = qpaceARQ.WINDOW, delayPerTransmit = 0, firstPacket = 0, lastPacket = None, xtea = False, erasure = None, journal = False, compression = None):
+		self.chip = chip
+		self.pathname = pathname
+		self.useFEC = useFEC
+		self.window = window
+		self.delayPerTransmit = delayPerTransmit
+		self.route = route
+		self.checksum = b' ' #TODO figure out the checksum stuff
 
 		headerSize = DataPacket.xtea_header_size if xtea else DataPacket.header_size
-        if useFEC:
-			self.data_size = (DataPacket.max_size - headerSize) // 3
+		if useFEC:
+			self.data_size = qpaceFEC.width(DataPacket.max_size - headerSize)
 		else:
 			self.data_size = DataPacket.max_size - headerSize
-		self.expected_packets = ceil(self.filesize / DataPacket.data_size)
-
-    def run(self):
-        packetData = getPacketData()
-		# Get the length of all the packets if NONE was supplied as the last packet.
-		if self.lastPacket == None:
-            self.lastPacket = len(packetData)
-        totalAcks = ceil((self.lastPacket - self.firstPacket + 1)/self.packetsPerAck)
-        for ackCount in range(totalAcks):
-            sessionPackets = []
-            for i in range(packetsPerAck):
-                pid = (ackCount * self.packetsPerAck + i) + self.firstPacket
-                packet = DataPacket(packetData[pid], pid, self.route ,useFEC = self.useFEC)
-                packet.send()
-            #TODO work out handshake with packets
-			#TODO this is where the handshake will go.
-			#TODO we will WAIT here for the acknowledgement. Once we get it, continue on.
-
-        #When it's done it needs to send a DONE packet
-        allDone = TransmitCompletePacket(self.pathname,self.checksum,self.expected_packets,self.route,useFEC=self.useFEC)
-		allDone.send(self.chip)
-
-    def getPacketData():
-        packetData = []
-        with open(pathname,'rb') as f:
-            while(True):
-                data = f.read(DataPacket.max_size - self.data_size)
-                if data:
-                    packetData.append(data)
-                else:
-                    break
-        return packetData
+		self.source, self.codec = qpaceCompression.prepare(pathname, compression) if compression else (pathname, 'none')
+		self.packets = Packetizer(self.source, self.data_size)
+		self.expected_packets = len(self.packets)
+		self.firstPacket = max(firstPacket, 0)
+		self.lastPacket = self.expected_packets - 1 if lastPacket is None else min(lastPacket, self.expected_packets - 1)
+		self.journal = None
+		if journal:
+			stat = os.fstat(self.packets.file.fileno())
+			identity = {'pathname': os.path.abspath(pathname), 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'inode': stat.st_ino,
+						'route': route, 'data_size': self.data_size, 'useFEC': useFEC, 'xtea': xtea, 'erasure': erasure, 'compression': self.codec}
+			self.journal = qpaceJournal.Journal(qpaceJournal.path('send', pathname), identity, self.expected_packets)
+			self.arq = qpaceARQ.SendWindow(self.firstPacket, self.lastPacket, window, skip = self.journal.have, onAck = self.journal.add)
+		else:
+			self.arq = qpaceARQ.SendWindow(self.firstPacket, self.lastPacket, window)
+		self.code = qpaceErasure.Code(*erasure) if erasure else None
+		self.buf = bytearray(DataPacket.max_size) # ACKs are read into here
+		self.view = memoryview(self.buf)
+
+	# Build and send the packet for pid, straight from the codec's buffer
+	def send(self, pid, data = None):
+		if data is None: data = self.packets[pid]
+		if self.useFEC:
+			# TMR: the data three times over, a full copy apart, so a burst error can't hit two copies of a byte
+			data = qpaceFEC.encode(data, self.data_size)
+		return self.chip.write_all(codec.DATA.encode(self.route, pid, data))
+
+	def resend(self, pids, first = False):
+		for pid in pids:
+			self.send(pid)
+			self.arq.sent(pid, time.monotonic())
+			if self.delayPerTransmit: time.sleep(self.delayPerTransmit)
+			# Parity goes out once, after the last packet of its block is sent for the first time
+			if first and self.code is not None and (pid % self.code.k == self.code.k - 1 or pid == self.lastPacket):
+				self.sendParity(pid // self.code.k)
+
+	# Payload of pid as it is in the packet, padded to data_size. Pids past the end of the file are all padding
+	def payload(self, pid):
+		data = self.packets[pid] if pid < self.expected_packets else b''
+		return data + DataPacket.padding_byte * (self.data_size - len(data))
+
+	def sendParity(self, block):
+		first = block * self.code.k
+		payloads = [self.payload(pid) for pid in range(first, first + self.code.k)]
+		for j, parity in enumerate(self.code.encode(payloads)):
+			self.send(self.code.parityPid(block, j), parity)
+			if self.delayPerTransmit: time.sleep(self.delayPerTransmit)
+		# The receiver may rebuild the block from this parity, so a NAK sent before it arrived is no reason to resend
+		self.arq.hold(range(first, first + self.code.k), time.monotonic())
+
+	def getAck(self, timeout):
+		"""
+		Wait up to timeout seconds for an ACK.
+
+		Returns
+		-------
+		tuple - (base, count, bitmap), see qpaceARQ.decodeAck.
+		None - if nothing arrived in time or what did was not a valid ACK.
+		"""
+		if not readFrame(self.chip, self.view, timeout, self.time_to_wait):
+			return None
+		return qpaceARQ.decodeAck(self.view)
+
+	# Wait up to timeout seconds for the receiver's final ACK, passing over late ACKs for the data
+	# Return True once it is in
+	def getFinalAck(self, timeout):
+		deadline = time.monotonic() + timeout
+		while True:
+			ack = self.getAck(max(deadline - time.monotonic(), 0))
+			if ack is None: return False
+			if ack[0] > self.expected_packets: return True
+
+	def run(self):
+		"""
+		Send the file and wait for it all to be acknowledged.
+
+		Returns
+		-------
+		bool - True if the whole file was acknowledged, False if the transfer was given up.
+		"""
+		arq = self.arq
+		try:
+			while not arq.done():
+				self.resend(arq.ready(), first = True)
+				deadline = arq.deadline()
+				ack = self.getAck(max(deadline - time.monotonic(), 0) if deadline is not None else self.time_to_wait)
+				resend = []
+				while ack is not None: # Take every ACK that is already in before deciding what to resend
+					resend += arq.ack(*ack, time.monotonic())
+					ack = self.getAck(0)
+				# Only what the ACKs say is missing and the timers that ran out while waiting go again
+				resend += [pid for pid in arq.expired(time.monotonic()) if pid not in resend]
+				self.resend(sorted(set(resend)))
+
+			#When it's done it needs to send a DONE packet
+			# The data packets did not go through DataPacket, so bring its pid sequence up to date first
+			DataPacket.last_id = self.expected_packets - 1
+			# Never with FEC: three copies of the completion data don't fit in a packet
+			allDone = TransmitCompletePacket(os.fsencode(self.pathname),self.checksum,self.expected_packets,self.route)
+			for attempt in range(self.complete_tries):
+				allDone.send(self.chip)
+				if self.getFinalAck(arq.rto()): break
+				arq.rtt.backoff()
+			else:
+				# Every pid is acknowledged, so the file is there; the receiver just waits out its idle timeout
+				logger.logSystem([["Transmitter: No final ACK for " + self.pathname + " after " + str(self.complete_tries) + " tries."]])
+			if self.journal is not None and self.journal.complete(): self.journal.remove() # Kept if only part of the file was sent
+			return True
+		except TimeoutError as err:
+			logger.logError("Transmitter: Gave up sending " + self.pathname + ".", err)
+			return False
+		finally:
+			if self.journal is not None: self.journal.close()
+			self.packets.close()
 
 class Receiver():
+	"""
+	Receives a file sent as DATA packets and writes each payload straight to its place in the file.
+
+	The file is preallocated to its full size up front (sparse if the filesystem can't allocate), and
+	each payload is written with os.pwrite at pid * data_size, so receiving costs one write per packet
+	no matter how big the file is or what order the packets come in. Which pids have arrived is kept
+	in a bitmap, one bit per packet, and the file is only synced every fsync_packets packets.
+
+	The bitmap is also what the ACK frames for the sender's selective-repeat ARQ (qpaceARQ) are built
+	from: one goes back every packetsPerAck packets, as soon as a gap shows a packet was lost, and
+	whenever the link goes quiet for ack_delay, so the sender only has to resend what is missing
+	and never sits on a full window waiting for packetsPerAck packets that can't come. The
+	TransmitCompletePacket is answered with a final ACK whose base is past its pid, so the sender
+	knows the receiver has stopped listening and doesn't send it again.
+
+	With erasure set, parity packets are kept until their block is whole, and as soon as any k of
+	the block's k + m packets are in, the missing data packets are rebuilt (qpaceErasure) and written.
+	Data packets of the block that are already written are read back from the file for this.
+
+	With journal set, pids are recorded in a qpaceJournal each time the file is synced, and a Receiver
+	for the same file and parameters on a later pass starts with them already in the bitmap.
+
+	With decompress set, packets are written to pathname + PARTIAL_SUFFIX, and as soon as the start
+	of it has arrived without gaps it is decompressed (qpaceCompression) into pathname, so the file is
+	ready as soon as the last packet is in. A file the sender did not compress is just renamed.
+
+	Parameters
+	----------
+	SC16IS750 - chip - the chip the packets arrive on.
+	str - pathname - the file to write.
+	int - filesize - size of the file being sent, in bytes.
+	str - prepend - Default: '' - put in front of pathname, e.g. a directory.
+	int - route - Default: None - routing ID the transfer uses.
+	bool - useFEC - Default: False - packets carry their payload three times over.
+	int - packetsPerAck - Default: 1 - packets received between ACKs.
+	int - firstPacket - Default: 0 - first pid expected.
+	int - lastPacket - Default: None - last pid expected, the end of the file if None.
+	bool - xtea - Default: False - packets have room for the XTEA header.
+	tuple - erasure - Default: None - (k, m) the sender's Transmitter uses.
+	bool - journal - Default: False - keep a journal and resume from it, see qpaceJournal.
+	bool - decompress - Default: False - the sender used compression. filesize is then the size the sender's Transmitter sends.
+	"""
+	PARTIAL_SUFFIX = '.qpz'
+	fsync_packets = 256 # Packets written between syncs to the card
+	time_to_wait = 5    # Time (s) to wait for each chunk of a packet
+	idle_acks = 6       # ACKs sent in a row with nothing arriving before the transfer is given up
+	ack_delay = .1      # Time (s) to wait for the next packet before packets received so far are acknowledged anyway
+
 	class ReceivedPacket():
 		def __init__(self, rid, pid, data):
 			self.rid = rid
 			self.pid = pid
 			self.data = data
 
-    def __init__(self, chip, pathname, prepend='',route=None, useFEC=False, packetsPerAck = 1, delayPerTransmit = 135, firstPacket = 1, lastPacket = None, xtea = False):
-        self.chip = chip
+	def __init__(self, chip, pathname, filesize, prepend='',route=None, useFEC=False, packetsPerAck = 1, delayPerTransmit = 0, firstPacket = 0, lastPacket = None, xtea = False, erasure = None, journal = False, decompress = False):
+		self.chip = chip
 		self.prepend = prepend
-        self.pathname = pathname
-        self.useFEC = useFEC
-        self.packetsPerAck = packetsPerAck
-        self.delayPerTransmit = delayperTransmit
-        self.firstPacket = firstPacket if firstPacket > 1 else 1
-        self.lastPacket = lastPacket if lastPacket > firstPacket else None
-        self.route = route
-        self.checksum = b' ' #TODO figure out the checksum stuff
-
-        headerSize = DataPacket.xtea_header_size if xtea else DataPacket.header_size
-        if useFEC:
-			self.data_size = (DataPacket.max_size - headerSize) // 3
-		else:
-			self.data_size = Packet.max_size - headerSize
-		self.expected_packets = ceil(self.filesize / DataPacket.data_size)
-
-	def run(self):
-
-		with open(self.prepend+self.pathname,'rb+') as scaffold:
-			packetCount = 0
-			while(True): # Continue to accept packets until we break and are done
-				packetsReceived = 0
-				acceptingPackets = True
-				while(acceptingPackets):
-					packet = getPacket()
-					packetsReceived += 1
-					packetCount += 1
-					if packet.rid == ROUTES['PI1ROUTE'] or packet.rid == ROUTES['PI2ROUTE']:
-						data = scaffold.read()
-						scaffold.seek(0)
-						offset = packet.pid*self.data_size
-						data = data[:offset] + packet.data + data[offset:]
-						scaffold.write(data)
-					if packetsReceived >= self.packetsPerAck or packetCount >= self.expected_packets:
-						acceptingPackets = False
-
-				#TODO do the acknoledgement process
-				# If the acknkoledgement fails or we get a STOP, stop accepting packets.
-				# If the acknoledgeement is successful then continue on accepting more packets
-				if acknowledgement_fail or stop_code:
-					break
-
-				# If we've receieved all the packets, then break. We are done.
-				if packetCount >= self.expected_packets:
-					break
-
-
-
-
-
+		self.pathname = pathname
+		self.filesize = filesize
+		self.useFEC = useFEC
+		self.packetsPerAck = packetsPerAck
+		self.delayPerTransmit = delayPerTransmit
+		self.route = route
+		self.checksum = b' ' #TODO figure out the checksum stuff
 
+		headerSize = DataPacket.xtea_header_size if xtea else DataPacket.header_size
+		if useFEC:
+			self.data_size = qpaceFEC.width(DataPacket.max_size - headerSize)
+		else:
+			self.data_size = DataPacket.max_size - headerSize
+		self.expected_packets = ceil(self.filesize / self.data_size)
+		self.firstPacket = max(firstPacket, 0)
+		self.lastPacket = self.expected_packets - 1 if lastPacket is None else min(lastPacket, self.expected_packets - 1)
+
+		self.received = bytearray(ceil(self.expected_packets / 8)) # Bit pid % 8 of byte pid // 8 is set once pid is written
+		self.count = 0     # Distinct pids written
+		self.pending = self.lastPacket - self.firstPacket + 1 # Pids from firstPacket to lastPacket not written yet
+		self.base = self.firstPacket  # Every pid from firstPacket up to here has been written
+		self.highest = self.firstPacket - 1 # Highest pid written
+		self.unsynced = 0  # Packets written since the last sync
+		self.corrected = 0 # Bits TMR has corrected so far
+		self.code = qpaceErasure.Code(*erasure) if erasure else None
+		self.parity = {}   # block -> {shard index: payload} of parity packets for blocks that are not whole yet
+		self.rebuilt = 0   # Packets rebuilt from parity
+		self.buf = bytearray(DataPacket.max_size) # Every packet is read into here
+		self.view = memoryview(self.buf)
+
+		self.target = self.prepend+self.pathname
+		self.filepath = self.target + self.PARTIAL_SUFFIX if decompress else self.target # Where the packets are written
+		self.inflater = qpaceCompression.Decompressor(self.target) if decompress else None
+		self.fd = os.open(self.filepath, os.O_RDWR | os.O_CREAT, 0o644)
+		try:
+			os.posix_fallocate(self.fd, 0, self.filesize)
+		except (AttributeError, OSError):
+			pass # No fallocate here (or a size of 0), so the file is left sparse and blocks are allocated as packets land
+		if os.fstat(self.fd).st_size != self.filesize:
+			os.ftruncate(self.fd, self.filesize)
+
+		self.journal = None
+		self.unjournaled = [] # Pids written since the last sync, recorded in the journal once they are on the card
+		if journal:
+			identity = {'pathname': os.path.abspath(self.filepath), 'size': filesize,
+						'data_size': self.data_size, 'useFEC': useFEC, 'xtea': xtea, 'erasure': erasure}
+			self.journal = qpaceJournal.Journal(qpaceJournal.path('receive', self.filepath), identity, self.expected_packets)
+			if self.journal.resumed:
+				self.resume(self.journal.bitmap)
+				if self.inflater is not None: self.inflate()
+
+	# Start from a bitmap of pids that are already in the file
+	def resume(self, bitmap):
+		self.received[:] = bitmap
+		self.count = bin(int.from_bytes(self.received, 'big')).count('1')
+		self.pending = sum(1 for pid in self.missing())
+		while self.base <= self.lastPacket and self.have(self.base): self.base += 1
+		used = self.received.rstrip(b'\x00')
+		if used: self.highest = max(self.highest, (len(used) - 1) * 8 + used[-1].bit_length() - 1)
+
+	def have(self, pid):
+		return bool(self.received[pid >> 3] & (1 << (pid & 7)))
+
+	# Pids from firstPacket to lastPacket that have not arrived yet, for asking the sender to resend them
+	def missing(self):
+		for pid in range(self.firstPacket, self.lastPacket + 1):
+			if not self.have(pid): yield pid
+
+	def complete(self):
+		return self.pending <= 0
+
+	def write(self, pid, data):
+		"""
+		Write the payload of packet pid to its place in the file. A repeated pid is written again.
 
-	def getPacket(self):
-		buf = b''
-		time_to_wait = 5#s
-		time_to_sleep = .4#s
-		numOfAttempts = (time_to_wait//time_to_sleep) + 1
+		Parameters
+		----------
+		int - pid - the packet ID.
+		bytes-like - data - the DATA field of the packet. Padding past the end of the file is dropped.
 
-		for i in range(0,4): #We will receive 4, 32 byte chunks to make a 128 packet
-			attempt = 0
-			while(True):
-				waiting = chip.byte_read(SC16IS750.REG_RXLVL)
-				if waiting >= 32: # wait until we have a full chunk
-					try:
-						logger.logSystem([["Reading in "+ str(waiting) +" bytes from the CCDR"]])
-						for i in range(32):
-							# Read from the chip and write to the buffer.
-							buf += bytes([chip.byte_read(SC16IS750.REG_RHR)])
-						if attempt == numOfAttempts:
-							raise BlockingIOError("Timeout has occurred...")
+		Returns
+		-------
+		int - bits TMR corrected in the packet, 0 without FEC.
 
-					except BlockingIOError:
-						# TODO Write the start over methods.
-						# TODO Alert WTC?
-						# TODO log it!
-						pass
-					except BufferError as err:
-						logger.logError("A BufferError was thrown.",err)
-						raise BufferError("A BufferError was thrown.") from err
-				sleep(time_to_sleep)
-				attempt += 1
-			chip.byte_read(SC16IS750.REG_RHR)# Clear the buffer. WTC will send ERRNONE
+		Raises
+		------
+		IndexError - if the file has no packet pid.
+		"""
+		if pid < 0 or pid >= self.expected_packets:
+			raise IndexError("Packet " + str(pid) + " is outside " + self.pathname + " (" + str(self.expected_packets) + " packets).")
+		data, corrected = self.decode(data)
+		self.place(pid, data)
+		if self.code is not None and pid // self.code.k in self.parity:
+			self.rebuild(pid // self.code.k)
+		return corrected
+
+	# The payload in a DATA field, with TMR undone. Returns the payload and the bits corrected
+	def decode(self, data):
+		if not self.useFEC: return data, 0
+		data, corrected = qpaceFEC.decode(data, self.data_size)
+		self.corrected += corrected
+		return data, corrected
+
+	# Write a payload to the file and mark pid as arrived
+	def place(self, pid, data):
+		offset = pid * self.data_size
+		length = min(self.data_size, self.filesize - offset)
+		os.pwrite(self.fd, data[:length], offset)
+		if self.journal is not None: self.unjournaled.append(pid)
+		if not self.have(pid):
+			self.received[pid >> 3] |= 1 << (pid & 7)
+			self.count += 1
+			if self.firstPacket <= pid <= self.lastPacket: self.pending -= 1
+			if pid > self.highest: self.highest = pid
+			if pid == self.base:
+				while self.base <= self.lastPacket and self.have(self.base): self.base += 1
+				if self.inflater is not None: self.inflate()
+		self.unsynced += 1
+		if self.unsynced >= self.fsync_packets: self.sync()
+
+	def writeParity(self, pid, data):
+		"""
+		Keep the payload of parity packet pid for its block, and rebuild the block if it can be.
 
-		return ReceivedPacket(buf[0],buf[1:4],buf[5:])
+		Returns
+		-------
+		int - bits TMR corrected in the packet, 0 without FEC.
+		"""
+		block, index = self.code.parityShard(pid)
+		first = block * self.code.k
+		if first >= self.expected_packets: return 0
+		data, corrected = self.decode(data)
+		self.parity.setdefault(block, {})[index] = bytes(data[:self.data_size])
+		self.rebuild(block)
+		return corrected
+
+	# Payload of pid read back from the file, padded to data_size the way it was in its packet
+	def payload(self, pid):
+		offset = pid * self.data_size
+		data = os.pread(self.fd, max(min(self.data_size, self.filesize - offset), 0), offset) if pid < self.expected_packets else b''
+		return data + DataPacket.padding_byte * (self.data_size - len(data))
+
+	def rebuild(self, block):
+		k = self.code.k
+		first = block * k
+		# Pids past the end of the file are known, they are all padding
+		present = [i for i in range(k) if first + i >= self.expected_packets or self.have(first + i)]
+		if len(present) == k:
+			del self.parity[block]
+			return
+		shards = self.parity[block]
+		if len(present) + len(shards) < k: return
+		for i in present: shards[i] = self.payload(first + i)
+		for i, data in self.code.decode(shards).items():
+			self.place(first + i, data)
+			self.rebuilt += 1
+		del self.parity[block]
+
+	def inflate(self):
+		# Decompress whatever has arrived without gaps from the start of the file and has not been yet
+		if self.firstPacket != 0: return # Only a whole file can be decompressed
+		end = min(self.base * self.data_size, self.filesize)
+		try:
+			while self.inflater.fed < end:
+				self.inflater.feed(os.pread(self.fd, min(end - self.inflater.fed, qpaceCompression.BLOCK_SIZE), self.inflater.fed))
+		except ValueError as err:
+			logger.logError("Receiver: Could not decompress " + self.filepath + ", it is kept as it arrived.", err)
+			self.inflater.abandon()
+			self.inflater = None
+
+	def sync(self):
+		os.fsync(self.fd)
+		self.unsynced = 0
+		if self.journal is not None:
+			for pid in self.unjournaled: self.journal.add(pid)
+			self.unjournaled = []
+			self.journal.flush()
+
+	def close(self):
+		if self.fd is None: return
+		self.sync()
+		os.close(self.fd)
+		self.fd = None
+		if self.inflater is not None:
+			if self.count == self.expected_packets:
+				if not self.inflater.finish(self.filepath):
+					logger.logError("Receiver: " + self.filepath + " did not decompress to the size in its header, it is kept as it arrived.")
+			else: self.inflater.abandon() # Fed from the start again when the transfer resumes
+		if self.journal is not None:
+			if self.journal.complete(): self.journal.remove()
+			else: self.journal.close()
+
+	# Tell the sender which pids have arrived: everything below base, and a NAK for each one missing up to the highest
+	def acknowledge(self):
+		if self.route is None: return # Nothing has arrived to take the route from
+		self.chip.write_all(qpaceARQ.encodeAck(self.route, self.base, self.highest + 1 - self.base, self.have))
 
+	def run(self):
+		"""
+		Receive packets until the sender's TransmitCompletePacket arrives, or until nothing has arrived for idle_acks ACKs in a row.
 
+		Returns
+		-------
+		bool - True if every pid from firstPacket to lastPacket was written.
+		"""
+		try:
+			packetsReceived = 0
+			idle = 0
+			while True: # Continue to accept packets until we break and are done
+				packet = self.getPacket(self.ack_delay if packetsReceived else self.time_to_wait)
+				if packet is None and packetsReceived:
+					packetsReceived = 0
+					self.acknowledge() # The sender has stopped, maybe on a full window
+					continue
+				if packet is None:
+					idle += 1
+					if idle > self.idle_acks:
+						logger.logSystem([["Receiver: Nothing from the sender, stopped with " + str(self.pending) + " packets missing."]])
+						break
+					self.acknowledge() # The sender may be waiting on an ACK that was lost
+					continue
+				idle = 0
+				if packet.rid != ROUTES['PI1ROUTE'] and packet.rid != ROUTES['PI2ROUTE']:
+					continue
+				if self.route is None: self.route = packet.rid
+				if packet.pid == self.expected_packets and bytes(packet.data[:2]) == codec.TRANSMIT_COMPLETE_MARKER:
+					# Only sent once every pid has been acknowledged. The sender keeps resending it until this arrives
+					self.chip.write_all(qpaceARQ.encodeAck(self.route, self.expected_packets + 1, 0, self.have))
+					break
+				if self.code is not None and packet.pid & qpaceErasure.PARITY:
+					gap = False
+					self.writeParity(packet.pid, packet.data)
+				elif packet.pid < self.expected_packets:
+					gap = packet.pid > self.highest + 1 # Packets in between were lost, NAK them now
+					self.write(packet.pid, packet.data)
+				else:
+					continue
+				packetsReceived += 1
+				if packetsReceived >= self.packetsPerAck or gap or self.complete():
+					packetsReceived = 0
+					self.acknowledge()
+			return self.complete()
+		finally:
+			self.close()
+
+	def getPacket(self, timeout = None):
+		"""
+		Read one packet from the chip into the receiver's buffer.
 
+		Parameters
+		----------
+		float - timeout - Default: None - time (s) to wait for the packet to start, time_to_wait if None.
 
-	def writeFile(self):
-		pass
+		Returns
+		-------
+		ReceivedPacket - rid, pid and data, a memoryview into the buffer that is valid until the next getPacket.
+		None - if a chunk did not arrive in time.
+		"""
+		if not readFrame(self.chip, self.view, self.time_to_wait if timeout is None else timeout, self.time_to_wait):
+			return None
+		frame = codec.DATA.view(self.view)
+		return Receiver.ReceivedPacket(frame['rid'], frame['pid'], frame['data'])
@@ -15,19 +15,24 @@ import time
 import SC16IS750
 import pigpio
 import datetime
-from qpaceWTCHandler import initWTCConnection
+from qpaceWTCHandler import initWTCConnection, negotiateBaudrate, negotiateChecksum
 from  qpacePiCommands import *
 import qpaceLogger as logger
 import surfsatStates as ss
 import qpaceFileHandler as fh
+import qpaceCodec as codec
+import qpaceLatency as latency
+import qpaceClock as clock
 
 INTERP_PACKETS_PATH = "temp/packets/"
+RX_RING_SLOTS = 128 # 32 byte slots the CCDR IRQ fills, room for 32 packets of 4 chunks
+SHUTDOWN_POLL = .5 # Longest time (s) the loop sleeps with nothing received before checking for shutdown
 # Routing ID defined in packet structure document
-ROUTES{
-	'PI1ROUTE' = 0X01
-	'PI2ROUTE' = 0X02
-	'GNDROUTE' = 0X00
-	'WTCROUTE' = 0XFF
+ROUTES = {
+	'PI1ROUTE': 0X01,
+	'PI2ROUTE': 0X02,
+	'GNDROUTE': 0X00,
+	'WTCROUTE': 0XFF
 }
 ssStates = ss.SSCOMMAND
 ssErrors = ss.SSERRORS
@@ -44,7 +49,10 @@ COMMANDS = {
 	b'DWNLD': 		Command.dlFile,
 	b'up': 			Command.upReq,
 	b'Upload File': Command.upFile, #TODO ????
-	b'MANUL': 		Command.manual
+	b'MANUL': 		Command.manual,
+	b'LATNC': 		Command.latency,
+	b'DSIGN': 		Command.deltaSignature,
+	b'DPTCH': 		Command.deltaApply
 }
 
 class LastCommand():
@@ -56,19 +64,10 @@ class LastCommand():
 	timestamp = "Never"
 	fromWhom = "N/A"
 
-def waitForBytesFromCCDR(chip,n,timeout = 2.5,interval = 0.25):
-	if timeout:
-		total_attempts = timeout//interval
-		attempts = 0
-		while(attempts < total_attempts and chip.byte_read(SC16IS750.REG_RXLVL) is not n):
-			time.sleep(interval)
-			attempts += 1
-
-		if attempts >= total_attempts:
-			logger.logSystem([["WaitForBytesFromCCDR: Timeout occurred. Moving on."]])
-	else:
-		while(chip.byte_read(SC16IS750.REG_RXLVL) < n):
-			time.sleep(interval)
+def waitForBytesFromCCDR(chip,n,timeout = 2.5):
+	# chip.wait blocks on the RX stream when an RXEngine is attached instead of polling RXLVL
+	if not chip.wait(n, timeout or None):
+		logger.logSystem([["WaitForBytesFromCCDR: Timeout occurred. Moving on."]])
 
 def sendBytesToCCDR(chip,sendData):
 	"""
@@ -92,19 +91,21 @@ def sendBytesToCCDR(chip,sendData):
 		logger.logSystem([['Data will not be sent to the WTC: not string or bytes.']])
 		raise TypeError("Data to the WTC must be in the form of bytes or string")
 	try:
-		chip.block_write(SC16IS750.REG_THR, sendData)
+		sent = chip.write_all(sendData)
+		if sent != len(sendData):
+			raise BufferError("Only " + str(sent) + " of " + str(len(sendData)) + " bytes were sent")
 	except Exception as err:
 		#TODO do we actually handle the case where it just doesn't work?
 		print(err)
 		logger.logError('sendBytesToCCDR: An error has occured when attempting to send data to the WTC. Data to send:' + str(sendData),err)
 		pass
 	else:
+		latency.recorder.mark(latency.RESPONSE) # The last write for a frame is its response
 		return True
 	return False
 
 def flushRxReg(chip):
-	while(chip.byte_read(SC16IS750.REG_RXLVL) > 0):
-		chip.byte_read(SC16IS750.REG_RHR)
+	while(len(chip.drain()) > 0): pass
 
 def readDataFromCCDR(chip):
 	"""
@@ -122,55 +123,37 @@ def readDataFromCCDR(chip):
 	------
 	BufferError - If we can't read from the CCDR for some reason.
 	"""
-	buf = b''
 	time_to_wait = 5#s
-	time_to_sleep = .4#s
-	numOfAttempts = (time_to_wait//time_to_sleep) + 1
 	while(True):
-		waiting = chip.byte_read(SC16IS750.REG_RXLVL)
+		chip.wait(1, time_to_wait)
+		waiting = chip.inWaiting()
 		print('Waiting: ', waiting)
 		if waiting <= 4 and waiting > 0:
-			for i in range(waiting):
-				buf += bytes([chip.byte_read(SC16IS750.REG_RHR)])
-			byte = int.from_bytes(buf,byteorder='little')
-			break
+			return bytes(chip.read_some())
 		elif waiting > 4:
 			print('Assuming a packet...')
 			#We'll assume if it's not 1 byte, that it's going to be a 128 byte packet.
+			buf = bytearray(128)
+			view = memoryview(buf)
+			discard = bytearray(1)
+			count = 0
 			for i in range(0,4): #We will receive 4, 32 byte chunks to make a 128 packet
-				attempt = 0
-				while(True):
-					waiting = chip.byte_read(SC16IS750.REG_RXLVL)
-					print('Packet Waiting: ', waiting)
-					try:
-						sleep(time_to_sleep)
-						attempt += 1
-						# See how much we want to read.
-						if waiting > 32:   # If we have 32 bytes in the level register
-							logger.logSystem([["Reading in "+ str(waiting) +" bytes from the CCDR"]])
-							for i in range(waiting):
-								# Read from the chip and write to the buffer.
-								buf += bytes([chip.byte_read(SC16IS750.REG_RHR)])
-
-
-
-
-						if attempt == numOfAttempts:
-							raise BlockingIOError("Timeout has occurred...")
-
-					except BlockingIOError:
-						# TODO Write the start over methods.
-						# TODO Alert WTC?
-						# TODO log it!
-						pass
-					except BufferError as err:
-						logger.logError("A BufferError was thrown.",err)
-						raise BufferError("A BufferError was thrown.") from err
-				chip.byte_read(SC16IS750.REG_RHR)# Clear the buffer. WTC will send ERRNONE
-			break
-		time.sleep(.75)
-
-	return buf
+				try:
+					# Wait for the rest of this chunk, reading straight into the packet buffer.
+					count += chip.read_into(view[count:(i+1)*32], time_to_wait)
+					if count < (i+1)*32:
+						raise BlockingIOError("Timeout has occurred...")
+					logger.logSystem([["Read in chunk "+ str(i+1) +" from the CCDR"]])
+				except BlockingIOError:
+					# TODO Write the start over methods.
+					# TODO Alert WTC?
+					logger.logSystem([["readDataFromCCDR: Timeout occurred while waiting for a chunk."]])
+					return bytes(buf[:count])
+				except BufferError as err:
+					logger.logError("A BufferError was thrown.",err)
+					raise BufferError("A BufferError was thrown.") from err
+				chip.read_into(discard, time_to_wait)# Clear the buffer. WTC will send ERRNONE
+			return bytes(buf)
 
 
 
@@ -194,8 +177,8 @@ def processCommand(chip, fieldData, fromWhom = 'CCDR'):
 		raise ConnectionError("Connection to the CCDR not established.")
 	if fieldData:
 		try:
-			command = fieldData['opcode'].decode('ascii')
-			arguments = fieldData['information'].decode('ascii')
+			command = fieldData.opcode.decode('ascii')
+			arguments = fieldData.information.decode('ascii')
 		except UnicodeError:
 			#TODO Alert ground of problem decoding command!
 			raise BufferError("Could not decode ASCII bytes to string for command query.")
@@ -203,9 +186,9 @@ def processCommand(chip, fieldData, fromWhom = 'CCDR'):
 			arguments = arguments.split(' ')
 			logger.logSystem([["Command Received:",command,str(arguments)]])
 			LastCommand.type = command
-			LastCommand.timestamp = str(datetime.datetime.now())
+			LastCommand.timestamp = str(datetime.datetime.fromtimestamp(clock.now()))
 			LastCommand.fromWhom = fromWhom
-			COMMANDS[fieldData['opcode']](chip,command,arguments) # Run the command
+			COMMANDS[fieldData.opcode](chip,command,arguments) # Run the command
 
 def run(chip,experimentEvent, runEvent, shutdownEvent):
 	"""
@@ -236,47 +219,36 @@ def run(chip,experimentEvent, runEvent, shutdownEvent):
 
 	# Initialize the pins
 	gpio = pigpio.pi()
-	gpio.set_mode(CCDR_IRQ, pigpio.INPUT)
 
 	configureTimestamp = False
-	packetBuffer = []
+	linkNegotiated = False
 
 	def splitPacket(packetData):
-		packet = {
-			"route":       packetData[0],
-			"opcode":      packetData[1:6],
-			"information": packetData[6:124],
-			"checksum":    packetData[124:]
-		}
-		return packet #based on packet definition document
+		return codec.COMMAND.decode(packetData) # Fields by name, based on packet definition document
 
 	def checkCyclicTag(tag):
 		return True
 
-	def checkValidity(fieldData):
+	def checkValidity(packetData):
 		# return True,fieldData
-		packetString = bytes([fieldData['route']]) + fieldData['opcode'] + fieldData['information']
-		isValid = fieldData['route'] in (ROUTES['P1ROUTE'], ROUTES['P2ROUTE']) and fieldData['checksum'] == CMDPacket.generateChecksum(packetString)
-		if isValid and (fieldData['opcode'] == b'NOOP*' or fieldData['opcode'] == b'NOOP<'):
-			returnVal = PrivledgedPacket.decodeXTEA(fieldData['information'])
-			fieldData['opcode'] = returnVal[4:6] # 4:6 as defined in the packet structure document for XTEA packets
-			fieldData['information'] = returnVal[6:98] # 6:98 as defined in the packet structure document for XTEA packets
-			 # 98:100 and 106:118 as defined in the packet structure document for XTEA packets
-			isValid = True# (returnVal[106:118] == b'\x00'*12) and checkCyclicTag(retVal[98:100])
+		fieldData = splitPacket(packetData)
+		packetString = packetData[:codec.COMMAND.offset('checksum')]
+		isValid = fieldData.route in (ROUTES['PI1ROUTE'], ROUTES['PI2ROUTE']) and fieldData.checksum == CMDPacket.generateChecksum(packetString)
+		if isValid and (fieldData.opcode == b'NOOP*' or fieldData.opcode == b'NOOP<'):
+			try:
+				returnVal = PrivledgedPacket.decodeXTEA(fieldData.information)
+			except (OSError, ValueError) as err:
+				logger.logError("Interpreter: Could not load the XTEA key.", err)
+				return False, fieldData
+			fieldData = codec.XTEA.decode(returnVal) # Opcode, information, tag and padding as defined in the packet structure document for XTEA packets
+			isValid = True# (fieldData.padding == b'\x00'*12) and checkCyclicTag(fieldData.tag)
 		return isValid, fieldData
 
-	def WTCRXBufferHandler(gpio,level,tick):
-		packetData = chip.block_read(SC16IS750.REG_RHR,chip.byte_read(SC16IS750.REG_RXLVL))#readDataFromCCDR(chip)
-		packetBuffer.append(packetData)
-		print("Data came in: ", packetData)
-		# Manual testing. Remove for real test.
-		#testData = b'\x01MANUL====\x00' + b'Q'*93 +b'EE======' + b'\x00'*12
-		#packetData = testData + CMDPacket.generateChecksum(testData)
-
 	def wtc_respond(response):
 		chip.byte_write(SC16IS750.REG_THR,ss.SSCOMMAND[response])
 
 	def surfSatPseudoStateMachine(packetData,configureTimestamp):
+		nonlocal linkNegotiated
 		# Start looking at a pseduo state machine so WTC code doesn't need to change
 		if len(packetData) == 1 or (len(packetData) == 4 and configureTimestamp):
 			byte = int.from_bytes(packetData,byteorder='little')
@@ -286,9 +258,11 @@ def run(chip,experimentEvent, runEvent, shutdownEvent):
 			if len(packetData) == 4:
 				print('configuring timestamp')
 				#timestamp = int.from_bytes(timestampBytes, byteorder="little")
-				os.system("sudo date -s '@" + str(byte) +"'")
+				# Only the offset is taken here. The system clock is set on a thread of its own, so no shell or sudo runs while chunks arrive
+				clock.setEpoch(byte)
+				clock.setSystemClock()
 				print('Sending back: ', packetData)
-				chip.block_write(SC16IS750.REG_THR,packetData)
+				chip.write_all(packetData)
 				print('Configuration is complete! :D')
 				configureTimestamp = False
 			if byte in ssStates.values() or byte in ssErrors.values():
@@ -311,6 +285,13 @@ def run(chip,experimentEvent, runEvent, shutdownEvent):
 					# Then we are done?
 					# response = readDataFromCCDR(chip)
 					# wtc_respond('CONFIGURATION')
+				elif byte == ssStates['LINKSETUP']:
+					# A WTC that knows BAUDCHANGE and CHECKSUMCHANGE says so once it is idle and waiting for them.
+					# Only the first is acted on: the link stays as negotiated until the next boot
+					if not linkNegotiated:
+						linkNegotiated = True
+						negotiateBaudrate(chip)
+						negotiateChecksum(chip)
 				elif byte == ssErrors['ERRNONE']:
 					print('ERRNONE recv')
 					pass
@@ -328,39 +309,72 @@ def run(chip,experimentEvent, runEvent, shutdownEvent):
 		return b'',configureTimestamp # Return nothing if the packetData was handled as a WTC command
 
 
-	callback = gpio.callback(CCDR_IRQ, pigpio.FALLING_EDGE, WTCRXBufferHandler)
+	# The RX engine's IRQ thread services the CCDR IRQ and reads each chunk from the WTC straight into a slot of the ring.
+	# Memory is fixed at RX_RING_SLOTS chunks, and the WTC is asked to hold off when it is nearly full.
+	packetBuffer = SC16IS750.RXRing(RX_RING_SLOTS)
+	engine = SC16IS750.RXEngine(gpio, chip, CCDR_IRQ, packetBuffer)
+	overflows = 0
+	def ackChunk(route, index):
+		sendBytesToCCDR(chip, 0x61 + index) # Defined by WTC state machine
+	# Chunks are copied straight from the ring into a packet slot. Everything on the CCDR comes in on the WTC's link.
+	reassembler = fh.Reassembler(onChunk = ackChunk)
 	while True:
 		try:
-			packet = fh.ChunkPacket(chip)
-			while(len(packetBuffer)>0):
-				packetData = packetBuffer.pop(0)
-				packetData, configureTimestamp = surfSatPseudoStateMachine(packetData,configureTimestamp)
-				if len(packetData) != 0:
-					# Otherwise input is an actual packet
-					# We'll just assume that the chunk is 32 bytes always. That's the WTC's job.
-					packet.push(packetData)
-					if packet.complete:
-						packetData = packet.build()
-						fieldData = splitPacket(packetData) # Return a nice dictionary for the packets
-						# Check if the packet is valid. If it's XTEA, decode it.
-						isValid,fieldData = checkValidity(fieldData)
-						if isValid:
-							print('Input is valid')
-							print('OPCODE: ', fieldData['opcode'])
-							if fieldData["opcode"] in COMMANDS: # Double check to see if it's a command
-								processCommand(chip,fieldData,fromWhom = 'CCDR')
-							else:
-								packetBuffer.append(packetData)
+			while(len(chip.rxpending)>0 or packetBuffer.available()>0):
+				packet = None
+				if len(chip.rxpending) > 0:
+					# Bytes a handshake read that were not part of it are handed back ahead of the ring, since they arrived first
+					packetData = bytes(chip.rxpending)
+					chip.rxpending = bytearray()
+					edge = received = time.monotonic()
+				else:
+					chunk = packetBuffer.peek(0)
+					edge, received = packetBuffer.times()
+					if len(chunk) == SC16IS750.CHUNK_SIZE:
+						# A whole chunk goes straight from its ring slot into the packet's slot
+						packet = reassembler.push('WTCROUTE', chunk)
+						packetBuffer.release()
+						packetData = None
+					else:
+						# WTC states are copied out and the slot handed back first, since handling one can read from the ring
+						packetData = bytes(chunk)
+						packetBuffer.release()
+				if packetData is not None:
+					packetData, configureTimestamp = surfSatPseudoStateMachine(packetData,configureTimestamp)
+					if len(packetData) != 0:
+						# Not a state, so part of a chunk that arrived in pieces
+						packet = reassembler.push('WTCROUTE', packetData)
+				if packet is not None:
+					latency.recorder.start(edge, received)
+					latency.recorder.mark(latency.FRAME)
+					# Check if the packet is valid. If it's XTEA, decode it.
+					# The fields are unpacked straight out of the reassembly slot, which can then go back to the pool
+					isValid,fieldData = checkValidity(packet)
+					reassembler.release(packet)
+					latency.recorder.mark(latency.VALID)
+					if isValid:
+						print('Input is valid')
+						print('OPCODE: ', fieldData.opcode)
+						if fieldData.opcode in COMMANDS: # Double check to see if it's a command
+							processCommand(chip,fieldData,fromWhom = 'CCDR')
 						else:
-							#TODO Alert the WTC? Send OKAY back to ground?
-							print('Input is NOT valid!')
+							logger.logSystem([["Interpreter: No command for opcode", str(fieldData.opcode)]])
+					else:
+						#TODO Alert the WTC? Send OKAY back to ground?
+						print('Input is NOT valid!')
+					latency.recorder.finish(fieldData.opcode if isValid else None)
+
+				if packetBuffer.overflows != overflows:
+					logger.logError("Interpreter: RX ring was full, " + str(packetBuffer.overflows - overflows) + " bytes from the WTC were dropped.")
+					overflows = packetBuffer.overflows
 
-				if shutdownEvent.is_set():
-					logger.logSystem([["Shutdown flag was set."]])
-					raise StopIteration("It's time to shutdown!")
+			if shutdownEvent.is_set():
+				logger.logSystem([["Shutdown flag was set."]])
+				raise StopIteration("It's time to shutdown!")
 
 			runEvent.wait() #Mutex for the run
-			time.sleep(.5) # wait for a moment
+			# The IRQ thread wakes us as soon as it publishes a slot, so nothing waits on a polling interval
+			packetBuffer.wait(1, SHUTDOWN_POLL)
 
 		except KeyboardInterrupt:
 			shutdownEvent.set()
@@ -371,7 +385,7 @@ def run(chip,experimentEvent, runEvent, shutdownEvent):
 	#decoder = Decoder(file_location,TEMP_PACKET_LOCATION,suppress=True,rush=True)
 	#decoder.run(True)
 
-	callback.cancel()
+	engine.stop()
 	chip.close()
 	gpio.stop()
 	logger.logSystem([["Interpreter: Shutting down..."]])
\ No newline at end of file
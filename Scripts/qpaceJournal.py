@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# qpaceJournal.py
+# Q-Pace project, Center for Microgravity Research
+# University of Central Florida
+#
+# On-disk journal of a file transfer, so a transfer cut off by SHUTDOWN or a reboot picks up on
+# the next pass where the link dropped instead of starting over. The journal holds what the
+# transfer is (file identity and the frame parameters) and which pids are done: acknowledged
+# for a Transmitter, written and synced for a Receiver. The identity is up to the caller; for a
+# file being sent it is its size, mtime and inode rather than a hash, so opening a journal never
+# costs a pass over a file that may be hundreds of MB.
+#
+# The file is a series of records, each a kind byte, a length and a CRC-32 of the payload,
+# followed by the payload. Records are only ever appended and each batch is fsynced, so a crash
+# can at worst leave a torn record at the end, which is dropped when the journal is next opened.
+# A journal that is resumed is rewritten compactly first (header and a bitmap) and swapped in with
+# os.replace, so it does not grow from pass to pass.
+#
+# Usage:
+#	journal = Journal(path('send', pathname), identity, packets)
+#	if journal.resumed: ...           # journal.have(pid) for every pid already done
+#	journal.add(pid)                  # appended and synced in batches of sync_every pids
+#	journal.close()                   # or journal.remove() once the transfer is complete
+
+import os
+import json
+import zlib
+import struct
+import hashlib
+
+JOURNAL_PATH = "/home/pi/journal/"
+RECORD = struct.Struct('>BII') # kind, payload length, CRC-32 of the payload
+RANGE = struct.Struct('>II')   # first pid, number of pids
+HEADER = 1 # JSON: identity
+BITMAP = 2 # zlib compressed bitmap of done pids, bit pid % 8 of byte pid // 8
+PIDS = 3   # RANGEs of pids done since the last record
+SYNC_EVERY = 256 # Pids added between appends
+
+def path(role, pathname):
+	"""
+	Where the journal for sending or receiving ('send' or 'receive') pathname is kept.
+	"""
+	name = hashlib.sha1(os.fsencode(os.path.abspath(pathname))).hexdigest()[:16]
+	return os.path.join(JOURNAL_PATH, role + '-' + name + '.journal')
+
+def fileCRC(pathname, blocksize = 1 << 20):
+	"""
+	CRC-32 of a whole file, read blocksize bytes at a time.
+	"""
+	crc = 0
+	with open(pathname, 'rb') as f:
+		for block in iter(lambda: f.read(blocksize), b''):
+			crc = zlib.crc32(block, crc)
+	return crc
+
+def ranges(pids):
+	# Sorted pids as (first, count) runs
+	out = []
+	for pid in sorted(pids):
+		if out and out[-1][0] + out[-1][1] == pid:
+			out[-1][1] += 1
+		elif not out or out[-1][0] + out[-1][1] < pid:
+			out.append([pid, 1])
+	return out
+
+def records(data):
+	# (kind, payload) of every whole record in data, and where the last whole record ends
+	found = []
+	offset = 0
+	while offset + RECORD.size <= len(data):
+		kind, length, crc = RECORD.unpack_from(data, offset)
+		payload = data[offset+RECORD.size:offset+RECORD.size+length]
+		if len(payload) < length or zlib.crc32(payload) != crc: break
+		found.append((kind, payload))
+		offset += RECORD.size + length
+	return found, offset
+
+class Journal():
+	"""
+	Journal of one transfer. Opening it reads the journal at path if there is one. If its identity
+	matches, the pids it records are done and the transfer resumes, otherwise it is started over.
+
+	Parameters
+	----------
+	str - path - the journal file, see path().
+	dict - identity - JSON-able description of the transfer. A journal only resumes if this is the same.
+	int - packets - pids in the transfer, 0 to packets - 1.
+	int - sync_every - Default: SYNC_EVERY - pids added between appends.
+
+	Raises
+	------
+	OSError - if the journal can't be written.
+	"""
+
+	def __init__(self, path, identity, packets, sync_every = SYNC_EVERY):
+		self.path = path
+		self.identity = identity
+		self.packets = packets
+		self.sync_every = sync_every
+		self.bitmap = bytearray((packets + 7) // 8)
+		self.unsaved = [] # Pids added since the last append
+		self.resumed = self.load()
+		self.rewrite()
+
+	def load(self):
+		# Read the journal at path. Returns True if it is for this transfer and its pids are now in bitmap
+		try:
+			with open(self.path, 'rb') as f:
+				data = f.read()
+		except FileNotFoundError:
+			return False
+		found = records(data)[0] # A torn record at the end is left out, and gone once rewrite() runs
+		if not found or found[0][0] != HEADER: return False
+		try:
+			header = json.loads(found[0][1].decode())
+		except ValueError:
+			return False
+		if header.get('identity') != json.loads(json.dumps(self.identity)): return False # As it would read back
+		for kind, payload in found[1:]:
+			if kind == BITMAP:
+				try:
+					bitmap = zlib.decompress(payload)
+				except zlib.error:
+					return False
+				if len(bitmap) != len(self.bitmap): return False
+				self.bitmap[:] = bitmap
+			elif kind == PIDS:
+				for first, count in RANGE.iter_unpack(payload):
+					for pid in range(first, min(first + count, self.packets)): self.mark(pid)
+		return True
+
+	def rewrite(self):
+		# Write the header and bitmap to a new file, then swap it in
+		header = json.dumps({'identity': self.identity}).encode()
+		temp = self.path + '.new'
+		os.makedirs(os.path.dirname(self.path) or '.', exist_ok = True)
+		fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+		try:
+			os.write(fd, self.record(HEADER, header) + self.record(BITMAP, zlib.compress(bytes(self.bitmap))))
+			os.fsync(fd)
+		finally:
+			os.close(fd)
+		os.replace(temp, self.path)
+		self.syncDirectory()
+		self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+
+	def syncDirectory(self):
+		# The rename is only safe once the directory is synced too
+		try:
+			fd = os.open(os.path.dirname(self.path) or '.', os.O_RDONLY)
+		except OSError:
+			return
+		try:
+			os.fsync(fd)
+		except OSError:
+			pass
+		finally:
+			os.close(fd)
+
+	@staticmethod
+	def record(kind, payload):
+		return RECORD.pack(kind, len(payload), zlib.crc32(payload)) + payload
+
+	def mark(self, pid):
+		self.bitmap[pid >> 3] |= 1 << (pid & 7)
+
+	def have(self, pid):
+		return bool(self.bitmap[pid >> 3] & (1 << (pid & 7)))
+
+	# Every pid of the transfer is done
+	def complete(self):
+		whole, extra = divmod(self.packets, 8)
+		if self.bitmap[:whole].count(0xFF) != whole: return False
+		return extra == 0 or self.bitmap[whole] == (1 << extra) - 1
+
+	def add(self, pid):
+		"""
+		Record pid as done. It is on disk after the next flush(), which happens every sync_every pids.
+		"""
+		if self.have(pid): return
+		self.mark(pid)
+		self.unsaved.append(pid)
+		if len(self.unsaved) >= self.sync_every: self.flush()
+
+	def flush(self):
+		"""
+		Append the pids added since the last flush and fsync the journal.
+		"""
+		if not self.unsaved or self.fd is None: return
+		payload = b''.join(RANGE.pack(first, count) for first, count in ranges(self.unsaved))
+		os.write(self.fd, self.record(PIDS, payload))
+		os.fsync(self.fd)
+		self.unsaved = []
+
+	def close(self):
+		if self.fd is None: return
+		self.flush()
+		os.close(self.fd)
+		self.fd = None
+
+	def remove(self):
+		"""
+		Delete the journal, for a transfer that is complete.
+		"""
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+		try:
+			os.remove(self.path)
+		except FileNotFoundError:
+			pass
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# qpaceLatency.py
+# Q-Pace project, Center for Microgravity Research
+# University of Central Florida
+#
+# Per frame timing of the interpreter pipeline. Each frame gets a monotonic timestamp at every stage
+# it passes (IRQ edge, chunk in RAM, frame reassembled, checked, response written, command done),
+# kept in a list allocated once, and when the frame is done the time spent in each stage is folded
+# into a log-linear (HDR-style) histogram for the frame's opcode. Nothing is allocated per frame.
+#
+# Usage:
+#	recorder.start(edge, received)   # times of the IRQ edge and of the frame's last chunk landing in the ring
+#	recorder.mark(FRAME)
+#	...
+#	recorder.finish(fieldData.opcode)
+#	recorder.summary()               # compact binary summary, what LATNC sends down as a file
+
+import time
+import struct
+
+# Stages in pipeline order. Each histogram holds the time from the stage before (the last one marked) to this one.
+# TOTAL takes the place of EDGE, which has no stage before it, and holds the time from the edge to DONE.
+EDGE, CHUNK, FRAME, VALID, RESPONSE, DONE = range(6)
+TOTAL = EDGE
+STAGES = ('total', 'chunk', 'frame', 'valid', 'response', 'done')
+
+SUB_BUCKET_BITS = 6   # 32 buckets per power of two, so values are kept to within about 3%
+HIGHEST = 0xFFFFFFFF  # Microseconds, over an hour. Anything longer is counted here.
+UNKNOWN = b'?????'    # Opcode for frames that failed checkValidity
+
+# LATNC reply: version and number of entries, then one entry per opcode and stage that saw a frame.
+# Times are microseconds.
+SUMMARY_VERSION = 1
+SUMMARY_HEADER = struct.Struct('>BH')
+SUMMARY_ENTRY = struct.Struct('>5sBIIIIII') # opcode, stage, count, min, p50, p90, p99, max
+BUCKET = struct.Struct('>HI')              # index, count, for Histogram.encode
+
+class Histogram():
+	"""
+	Counts of values (microseconds) in log-linear buckets: one per microsecond up to 2**bits, then
+	2**(bits-1) buckets for every power of two above that, so the relative error stays the same
+	from microseconds to minutes. All the buckets are allocated up front.
+
+	Parameters
+	----------
+	int - bits - Default: SUB_BUCKET_BITS - sets the precision, 2**-(bits-1).
+	int - highest - Default: HIGHEST - largest value kept. Larger values count as this.
+	"""
+
+	def __init__(self, bits = SUB_BUCKET_BITS, highest = HIGHEST):
+		self.bits = bits
+		self.highest = highest
+		self.counts = [0] * (self.bucket(highest) + 1)
+		self.reset()
+
+	def reset(self):
+		for i in range(len(self.counts)): self.counts[i] = 0
+		self.count = 0
+		self.min = None
+		self.max = 0
+
+	def bucket(self, value):
+		size = 1 << self.bits
+		if value < size: return value
+		shift = value.bit_length() - self.bits
+		return size + (shift - 1) * (size >> 1) + (value >> shift) - (size >> 1)
+
+	# Smallest value that falls in bucket index
+	def lowest(self, index):
+		size = 1 << self.bits
+		if index < size: return index
+		shift, offset = divmod(index - size, size >> 1)
+		return ((size >> 1) + offset) << (shift + 1)
+
+	def record(self, value):
+		value = min(max(int(value), 0), self.highest)
+		self.counts[self.bucket(value)] += 1
+		self.count += 1
+		if self.min is None or value < self.min: self.min = value
+		if value > self.max: self.max = value
+
+	# Value at or below which fraction of the recorded values fall, 0 if nothing was recorded
+	# Given as the top of its bucket, so it errs on the slow side
+	def percentile(self, fraction):
+		if self.count == 0: return 0
+		target = max(1, int(fraction * self.count + .5))
+		seen = 0
+		for index, count in enumerate(self.counts):
+			seen += count
+			if seen >= target: return max(min(self.lowest(index + 1) - 1, self.max), self.min)
+		return self.max
+
+	def encode(self):
+		"""
+		Every bucket that has counts, as (index, count) pairs. Enough to rebuild the histogram on the ground with decode().
+		"""
+		return b''.join(BUCKET.pack(index, count) for index, count in enumerate(self.counts) if count)
+
+	@classmethod
+	def decode(cls, data, bits = SUB_BUCKET_BITS, highest = HIGHEST):
+		histogram = cls(bits, highest)
+		for index, count in BUCKET.iter_unpack(data):
+			histogram.counts[index] += count
+			histogram.count += count
+			value = histogram.lowest(index)
+			if histogram.min is None or value < histogram.min: histogram.min = value
+			histogram.max = max(histogram.max, value)
+		return histogram
+
+class Recorder():
+	"""
+	Timeline of the frame going through the interpreter plus the histograms, by opcode, of every frame
+	finished so far. Only the interpreter's thread may call start, mark and finish.
+	"""
+
+	def __init__(self):
+		self.stamps = [0.0] * len(STAGES)
+		self.histograms = {} # opcode -> one Histogram per stage
+		self.frames = 0
+
+	# A new frame whose last chunk was read after the IRQ edge at edge and landed in the ring at received
+	def start(self, edge, received):
+		for i in range(len(self.stamps)): self.stamps[i] = 0.0
+		self.stamps[EDGE] = edge
+		self.stamps[CHUNK] = received
+
+	def mark(self, stage):
+		self.stamps[stage] = time.monotonic()
+
+	def finish(self, opcode = None):
+		"""
+		Mark the frame DONE and fold its stage times into the histograms for opcode (UNKNOWN if None).
+		Stages that were never marked are skipped, and the next one counts from the last that was.
+		"""
+		self.stamps[DONE] = time.monotonic()
+		opcode = UNKNOWN if opcode is None else bytes(opcode[:5]).ljust(5)
+		histograms = self.histograms.get(opcode)
+		if histograms is None:
+			histograms = self.histograms[opcode] = [Histogram() for stage in STAGES]
+		last = self.stamps[EDGE]
+		for stage in range(CHUNK, len(STAGES)):
+			stamp = self.stamps[stage]
+			if not stamp: continue
+			if last: histograms[stage].record((stamp - last) * 1000000)
+			last = stamp
+		first = self.stamps[EDGE] or self.stamps[CHUNK]
+		if first: histograms[TOTAL].record((self.stamps[DONE] - first) * 1000000)
+		self.frames += 1
+
+	def summary(self):
+		"""
+		Compact binary summary of every histogram: SUMMARY_HEADER then one SUMMARY_ENTRY per opcode and stage with counts.
+		"""
+		entries = []
+		for opcode, histograms in sorted(self.histograms.items()):
+			for stage, histogram in enumerate(histograms):
+				if histogram.count == 0: continue
+				entries.append(SUMMARY_ENTRY.pack(opcode, stage, histogram.count, histogram.min,
+					histogram.percentile(.5), histogram.percentile(.9), histogram.percentile(.99), histogram.max))
+		return SUMMARY_HEADER.pack(SUMMARY_VERSION, len(entries)) + b''.join(entries)
+
+	def reset(self):
+		for histograms in self.histograms.values():
+			for histogram in histograms: histogram.reset()
+		self.frames = 0
+
+def parseSummary(data):
+	"""
+	Unpack a summary() on the ground.
+
+	Returns
+	-------
+	list of dict - opcode, stage (name from STAGES), count, min, p50, p90, p99 and max (microseconds).
+
+	Raises
+	------
+	ValueError - if the version is unknown or the data is cut short.
+	"""
+	version, count = SUMMARY_HEADER.unpack_from(data)
+	if version != SUMMARY_VERSION:
+		raise ValueError("Unknown latency summary version " + str(version) + ".")
+	if len(data) < SUMMARY_HEADER.size + count * SUMMARY_ENTRY.size:
+		raise ValueError("Latency summary is cut short.")
+	out = []
+	for i in range(count):
+		opcode, stage, n, low, p50, p90, p99, high = SUMMARY_ENTRY.unpack_from(data, SUMMARY_HEADER.size + i * SUMMARY_ENTRY.size)
+		out.append({'opcode': opcode, 'stage': STAGES[stage], 'count': n, 'min': low, 'p50': p50, 'p90': p90, 'p99': p99, 'max': high})
+	return out
+
+# The interpreter's recorder
+recorder = Recorder()
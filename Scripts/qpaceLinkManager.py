@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# qpaceLinkManager.py
+# Q-Pace project, Center for Microgravity Research
+# University of Central Florida
+#
+# Runs several UART links side by side, one per route, each on its own SC16IS750 or on one
+# channel of an SC16IS752, so traffic for different routes is not serialized through one FIFO.
+# Nothing opens one at runtime yet, see qpaceWTCHandler.initLinks.
+#
+# Usage:
+#	manager = LinkManager(gpio)
+#	manager.open('WTCROUTE', 0x4c, irq = 16, config = {...})
+#	manager.open('GNDROUTE', 0x48, irq = 17, channel = 0)
+#	manager.open('PI2ROUTE', 0x48, irq = 17, channel = 1)
+#	manager.send('GNDROUTE', packet)          # returns at once
+#	for route in manager.select(timeout = 1):
+#		data = manager.recv(route)
+
+import threading
+import queue
+import SC16IS750
+import qpaceLogger as logger
+
+# RHR reads a link gets per turn on a shared IRQ, so one busy channel can't starve the other
+DRAIN_PASSES = 2
+
+class Link():
+	"""
+	One route's UART: the chip (or SC16IS752 channel), its RX engine and stream, and a TX queue
+	that a thread of its own writes out, so send() never blocks the caller on the bus.
+	"""
+
+	def __init__(self, route, chip, engine):
+		self.route = route
+		self.chip = chip
+		self.engine = engine
+		self.stream = engine.stream
+		self.txqueue = queue.Queue()
+		self.txcond = threading.Condition()
+		self.txpending = 0 # Bytes queued but not yet in the TX FIFO
+		self.thread = threading.Thread(target = self._transmit, name = 'link-' + str(route), daemon = True)
+		self.thread.start()
+
+	def send(self, data, callback = None):
+		"""
+		Queue data for this route and return immediately.
+
+		Parameters
+		----------
+		bytes - data - what to send.
+		callable - callback - Default: None - called with (link, bytes sent) once the data is in the TX FIFO.
+		"""
+		data = bytes(data)
+		with self.txcond:
+			self.txpending += len(data)
+		self.txqueue.put((data, callback))
+
+	# Return the oldest received burst, or None if nothing arrives within timeout (0 does not wait)
+	def recv(self, timeout = 0):
+		return self.stream.readsegment(timeout)
+
+	def read_into(self, buf, timeout = None):
+		return self.chip.read_into(buf, timeout)
+
+	def available(self):
+		return self.stream.available()
+
+	def pending(self):
+		return self.txpending
+
+	# Block until everything queued is in the TX FIFO
+	# Return False if the timeout expired first
+	def flush(self, timeout = None):
+		with self.txcond:
+			return self.txcond.wait_for(lambda: self.txpending == 0, timeout)
+
+	def _transmit(self):
+		while True:
+			item = self.txqueue.get()
+			if item is None: return
+			data, callback = item
+			try:
+				sent = self.chip.write_all(data)
+			except Exception as err:
+				logger.logError("Link " + str(self.route) + ": Transmit failed.", err)
+				sent = 0
+			with self.txcond:
+				self.txpending -= len(data)
+				self.txcond.notify_all()
+			if callback is not None: callback(self, sent)
+
+	def close(self):
+		self.txqueue.put(None)
+		self.thread.join()
+		self.engine.stop()
+		self.chip.close()
+
+class LinkManager():
+	"""
+	Opens a Link per route and an SC16IS750.IRQLine per IRQ GPIO, and gives one non-blocking API over all of them.
+	"""
+
+	def __init__(self, pi, i2cbus = 1):
+		self.pi = pi
+		self.i2cbus = i2cbus
+		self.links = {}
+		self.irqs = {}      # gpio -> SC16IS750.IRQLine
+		self.chips = set()  # (address) of chips that have been reset
+		self.lock = threading.Lock()
+		self.ready = threading.Condition()
+
+	def open(self, route, i2caddr, irq, channel = 0, **uart):
+		"""
+		Bring up a UART and attach it to a route.
+
+		Parameters
+		----------
+		route - any key, normally a name from qpaceInterpreter.ROUTES.
+		int - i2caddr - I2C address of the chip.
+		int - irq - GPIO the chip's IRQ output is wired to.
+		int - channel - Default: 0 - UART A (0) or B (1) on an SC16IS752.
+		uart - passed to SC16IS750.SC16IS750 (xtalfreq, baudrate, databits, stopbits, parity, config).
+
+		Returns
+		-------
+		Link - the new link.
+
+		Raises
+		------
+		KeyError - if the route is already open.
+		Any exceptions from the chip are passed up the call stack.
+		"""
+		with self.lock:
+			if route in self.links: raise KeyError("Route " + str(route) + " is already open.")
+			# The software reset hits both channels of an SC16IS752, so only the first one opened resets the chip
+			reset = i2caddr not in self.chips
+			self.chips.add(i2caddr)
+		chip = SC16IS750.SC16IS750(self.pi, self.i2cbus, i2caddr, channel = channel, reset = reset, **uart)
+		engine = SC16IS750.RXEngine(self.pi, chip, None, SC16IS750.RXStream(self._received), DRAIN_PASSES)
+		link = Link(route, chip, engine)
+		with self.lock:
+			self.links[route] = link
+			if irq not in self.irqs: self.irqs[irq] = SC16IS750.IRQLine(self.pi, irq)
+			line = self.irqs[irq]
+		line.add(engine)
+		return link
+
+	def __getitem__(self, route):
+		return self.links[route]
+
+	def send(self, route, data, callback = None):
+		self.links[route].send(data, callback)
+
+	def recv(self, route, timeout = 0):
+		return self.links[route].recv(timeout)
+
+	def select(self, timeout = None):
+		"""
+		Wait until at least one route has received data.
+
+		Returns
+		-------
+		list - the routes with data waiting, empty if the timeout expired.
+		"""
+		with self.ready:
+			self.ready.wait_for(lambda: any(link.available() > 0 for link in list(self.links.values())), timeout)
+		return [route for route, link in list(self.links.items()) if link.available() > 0]
+
+	def close(self):
+		with self.lock:
+			lines = list(self.irqs.values())
+			links = list(self.links.values())
+			self.irqs.clear()
+			self.links.clear()
+			self.chips.clear()
+		for line in lines: line.close()
+		for link in links: link.close()
+
+	def _received(self, stream):
+		with self.ready:
+			self.ready.notify_all()
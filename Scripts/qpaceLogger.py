@@ -9,7 +9,8 @@
 import csv
 import os.path
 import datetime
-from time import strftime,gmtime
+from time import strftime
+import qpaceClock # Log times follow the WTC's clock once it has sent TIMESTAMP
 
 # Defined Paths.
 LOG_PATH = "/home/pi/logs/"
@@ -71,7 +72,7 @@ def logError(description, exception = None):
 
     """
     try:
-        timestamp = strftime("%Y%m%d-%H%M%S",gmtime())
+        timestamp = strftime("%Y%m%d-%H%M%S",qpaceClock.gmtime())
         errorData = [timestamp, description]
         if exception is not None:
             errorData.append(str(exception.args))
@@ -100,7 +101,7 @@ def logSystem(data):
 
     """
     try:
-        timestamp = strftime("%Y%m%d-%H%M%S",gmtime())
+        timestamp = strftime("%Y%m%d-%H%M%S",qpaceClock.gmtime())
         for row in data:
             row.insert(0,timestamp)
         return _logData(data, 'system_')
@@ -18,12 +18,19 @@ import random
 #import qpaceLogger as logger
 #import qpaceQUIP as quip
 import surfsatStates as ss
+import qpaceChecksum
+import qpaceXTEA
+import qpaceLatency
+import qpaceClock
+import qpaceDelta
+import qpaceCodec as codec
 
 
 CMD_DEFAULT_TIMEOUT = 5 #seconds
 CMD_POLL_DELAY = .35 #seconds
 STATUSPATH = ''
 WHO_FILEPATH = ''
+LATENCY_PATH = "/home/pi/latency/" # LATNC summaries on their way down
 #SOCKET_PORT = 8675 #Jenny, who can I turn to?
 #ETHERNET_BUFFER = 2048
 
@@ -99,17 +106,32 @@ class CMDPacket():
 		else:
 			return sendBytesToCCDR(self.chip,UNAUTHORIZED)
 
+	def send(self):
+		"""
+		Send packetData down as COMMAND frames: routing, opcode, a piece of packetData padded with spaces
+		to fill the information field, and the checksum. Short replies fit in one frame.
+
+		Returns
+		-------
+		bool - True if every frame was written to the WTC.
+		"""
+		layout = codec.COMMAND
+		size = layout.fields['information'][1]
+		end = layout.offset('checksum')
+		data = self.packetData or UNAUTHORIZED
+		frame = bytearray(layout.size)
+		for start in range(0, len(data), size):
+			layout.encode_into(frame, 0, self.routing, self.opcode.encode('ascii'), data[start:start+size].ljust(size, b' '), b'')
+			frame[end:] = CMDPacket.generateChecksum(memoryview(frame)[:end])
+			if self.chip.write_all(frame) != len(frame): return False
+		return True
+
 	def confirmIntegrity(self): #TODO Make sure the packet is not corrupted
 		pass
 
 	@classmethod
 	def generateChecksum(self,data):
-		checksum = 0x811C9DC5 # 32-Bit FNV Offset Basis
-		for byte in data:
-			checksum ^= byte
-			checksum *= 0x1000193 # 32-Bit FNV Prime
-		checksum &= 0xFFFFFFFF
-		return checksum.to_bytes(4,byteorder='big')
+		return qpaceChecksum.checksum(data) # FNV-1a unless the WTC agreed on another algorithm
 
 class PrivledgedPacket(CMDPacket):
 	def __init__(self,tag,optype, encodedData = None):
@@ -122,15 +144,15 @@ class PrivledgedPacket(CMDPacket):
 			self.packetData = None
 
 	@classmethod
-	def encodeXTEA(encodedData):
-		pass
+	def encodeXTEA(self,data):
+		return qpaceXTEA.cipher().encrypt(data) # Same length as data, see qpaceXTEA
 
 	@classmethod
-	def decodeXTEA(encodedData):
-		pass
+	def decodeXTEA(self,encodedData):
+		return qpaceXTEA.cipher().decrypt(encodedData)
 
 	@classmethod
-	def returnRandom(n):
+	def returnRandom(self,n):
 		retval = []
 		for i in range(0,n):
 			# Get ascii characters from '0' to 'Z'
@@ -143,7 +165,7 @@ class PrivledgedPacket(CMDPacket):
 class StatusPacket(CMDPacket):
 	def __init__(self,chip):
 		CMDPacket.__init__(self,'STATS',chip)
-		timestamp = datetime.datetime.now()
+		timestamp = datetime.datetime.fromtimestamp(qpaceClock.now())
 		retval =  str(timestamp.month)
 		retval += str(timestamp.day)
 		retval += str(timestamp.year-2000)
@@ -158,6 +180,11 @@ class StatusPacket(CMDPacket):
 		retval += str(status[:111])
 		self.packetData = retval.encode('ascii')
 
+class DeltaPacket(CMDPacket):
+	def __init__(self,chip,result):
+		CMDPacket.__init__(self,'DPTCH',chip)
+		self.packetData = result
+
 class DirectoryListingPacket(PrivledgedPacket):
 	def __init__(self,pathname, tag):
 		self.pathname = pathname
@@ -183,7 +210,7 @@ class SendDirectoryList(PrivledgedPacket):
 
 		from subprocess import run
 		pathList = run(['ls','-al',self.pathname],stdout=subprocess.PIPE).stdout.split(b'\n')
-		pathList = b"\n".join([PrivledgedPacket.encodeXTEA(line) for line in pathList])
+		pathList = b"\n".join([PrivledgedPacket.encodeXTEA(line) for line in pathList]) # Key schedule is worked out once, not per line
 		self.packetData = pathList
 
 	def respond():
@@ -198,8 +225,8 @@ class SendDirectoryList(PrivledgedPacket):
 			for line in lines:
 				#dataSize defined for packet Structure
 				line = line.encode('ascii')[:self.dataSize] + CMDPacket.generateChecksum(line[:self.dataSize])
+				# sendBytesToCCDR paces itself on the TX FIFO level, so no delay is needed between lines
 				sendBytesToCCDR(self.chip,line)
-				time.sleep(self.delay)
 		else:
 			return sendBytesToCCDR(self.chip,UNAUTHORIZED)
 
@@ -255,6 +282,77 @@ class Command():
 		pass
 	def upFile(chip,cmd,args):
 		pass
+	def latency(chip,cmd,args):
+		"""
+		Send down the latency summary (qpaceLatency.parseSummary) as a file. It is 30 bytes per opcode and stage,
+		more than one frame holds, so it goes with a Transmitter. With RESET the histograms start again, but only
+		once the ground has acknowledged the whole summary.
+
+		Parameters
+		----------
+		chip - SC16IS750 - an SC16IS750 object which handles the WTC Connection
+		cmd,args - string, array of args (seperated by ' ') - the command, then RESET to clear the histograms
+		"""
+		import qpaceFileHandler # Imports this module, so not at the top
+		args = [arg for arg in args if arg] # The information field is padded with spaces
+		os.makedirs(LATENCY_PATH, exist_ok = True)
+		summarypath = os.path.join(LATENCY_PATH, 'summary')
+		with open(summarypath, 'wb') as f:
+			f.write(qpaceLatency.recorder.summary())
+		if qpaceFileHandler.Transmitter(chip, summarypath, qpaceFileHandler.ROUTES['GNDROUTE']).run() and args[:1] == ['RESET']:
+			qpaceLatency.recorder.reset()
+	def deltaSignature(chip,cmd,args):
+		"""
+		Send down the signature of a file for the ground to build a delta against, see qpaceDelta.
+		Bad arguments or a file that cannot be read are answered with FAILED and why in a DeltaPacket.
+
+		Parameters
+		----------
+		chip - SC16IS750 - an SC16IS750 object which handles the WTC Connection
+		cmd,args - string, array of args (seperated by ' ') - the command, then the file and optionally the block size
+		"""
+		import qpaceFileHandler # Imports this module, so not at the top
+		args = [arg for arg in args if arg] # The information field is padded with spaces
+		if len(args) not in (1, 2) or (len(args) == 2 and (not args[1].isdigit() or int(args[1]) == 0)):
+			DeltaPacket(chip, b'FAILED Expected the file and optionally a block size above 0.').send()
+			return
+		blockSize = int(args[1]) if len(args) > 1 else qpaceDelta.BLOCK_SIZE
+		sigpath = os.path.join(qpaceDelta.DELTA_PATH, 'signature')
+		try:
+			os.makedirs(qpaceDelta.DELTA_PATH, exist_ok = True)
+			qpaceDelta.writeSignature(args[0], sigpath, blockSize)
+			qpaceFileHandler.Transmitter(chip, sigpath, qpaceFileHandler.ROUTES['GNDROUTE']).run()
+		except (ValueError, OSError) as err:
+			DeltaPacket(chip, b'FAILED ' + str(err).encode('ascii', 'replace')).send()
+	def deltaApply(chip,cmd,args):
+		"""
+		Receive a delta from the ground and patch a file with it. The file is only replaced if the
+		patched version matches the delta's SHA-256. The result, PATCHED, INCOMPLETE or FAILED and why,
+		is sent down in a DeltaPacket.
+
+		Parameters
+		----------
+		chip - SC16IS750 - an SC16IS750 object which handles the WTC Connection
+		cmd,args - string, array of args (seperated by ' ') - the command, then the file and the size of the delta in bytes
+		"""
+		import qpaceFileHandler # Imports this module, so not at the top
+		args = [arg for arg in args if arg] # The information field is padded with spaces
+		if len(args) != 2 or not args[1].isdigit():
+			DeltaPacket(chip, b'FAILED Expected the file and the size of the delta.').send()
+			return
+		deltapath = os.path.join(qpaceDelta.DELTA_PATH, 'delta')
+		try:
+			os.makedirs(qpaceDelta.DELTA_PATH, exist_ok = True)
+			if not qpaceFileHandler.Receiver(chip, deltapath, int(args[1])).run():
+				DeltaPacket(chip, b'INCOMPLETE').send()
+				return
+			qpaceDelta.patch(args[0], deltapath)
+		except (ValueError, OSError) as err:
+			DeltaPacket(chip, b'FAILED ' + str(err).encode('ascii', 'replace')).send()
+		else:
+			DeltaPacket(chip, b'PATCHED').send()
+		finally:
+			if os.path.exists(deltapath): os.remove(deltapath)
 	def manual(chip,cmd,args):
 		import qpaceExperiment as exp
 		import surfsatStates as ss
@@ -476,7 +574,7 @@ class Command():
 
 		text_to_write = getStatus()
 		logger.logSystem([["Status finished."] + text_to_write.split('\n')])
-		timestamp = strftime("%Y%m%d-%H%M%S",gmtime())
+		timestamp = strftime("%Y%m%d-%H%M%S",qpaceClock.gmtime())
 		try:
 			with open(STATUSPATH+'status_'+timestamp+'.txt','w') as statFile:
 				statFile.write(text_to_write)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# qpaceReplay.py
+# Q-Pace project, Center for Microgravity Research
+# University of Central Florida
+#
+# Plays a link capture (qpaceCapture) back into qpaceInterpreter.run through the virtual SC16IS750
+# in qpaceFakePigpio, so a pass can be reproduced and profiled on any Linux machine. Everything the
+# WTC sent is fed in at the times it was recorded, N times faster, or as fast as the link allows,
+# and every command the interpreter dispatches is timed.
+#
+# Latency is measured from the last byte to reach the chip's RX FIFO before a dispatch to the
+# dispatch itself. At real or N times speed the WTC waits for each frame to be handled, so that
+# byte is the end of the frame; with --speed 0 later frames can already be arriving and the
+# percentiles are only a lower bound, so watch the throughput instead.
+#
+# Usage:
+#	python3 qpaceReplay.py pass.qpcap                   # at the speed it was recorded
+#	python3 qpaceReplay.py pass.qpcap --speed 10        # 10 times faster
+#	python3 qpaceReplay.py pass.qpcap --speed 0         # as fast as possible
+#	python3 qpaceReplay.py pass.qpcap --save replay.json
+#	python3 qpaceReplay.py pass.qpcap --compare replay.json   # exit 1 on a regression
+
+import qpaceFakePigpio as fake
+fake.install()
+
+import sys
+import time
+import argparse
+import threading
+import qpaceCapture
+import qpaceWTCHandler
+import qpaceInterpreter
+import qpaceClock
+from qpaceBenchmark import Results, percentile
+
+I2C_BUS = 1
+I2C_ADDR_WTC = 0x4c
+CCDR_IRQ = 16
+TICK_WRAP = 1 << 32
+
+class ReplayDevice(fake.VirtualSC16IS750):
+	"""VirtualSC16IS750 that remembers when the last byte from the WTC reached the RX FIFO."""
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.arrived = None
+
+	def rx_store(self, byte, flags, t):
+		super().rx_store(byte, flags, t)
+		self.arrived = t
+
+class ReplayPeer(fake.Peer):
+	"""
+	The WTC, sending the RX records of a capture.
+
+	Parameters
+	----------
+	list of (int, bytes) - records - (pigpio tick, data) of every RX record, in order.
+	float - speed - 1 replays at the recorded times, N is N times faster, 0 sends every record as soon as the last one is on the line.
+	"""
+
+	def __init__(self, records, speed):
+		super().__init__(flow_control = qpaceWTCHandler.HW_FLOW_CONTROL)
+		self.records = records
+		self.speed = speed
+		self.done = threading.Event()
+		self.started = None
+
+	def play(self):
+		self.started = time.monotonic()
+		elapsed = 0
+		last = self.records[0][0] if self.records else 0
+		for tick, data in self.records:
+			elapsed += ((tick - last) % TICK_WRAP) / 1000000
+			last = tick
+			if self.speed:
+				delay = self.started + elapsed / self.speed - time.monotonic()
+				if delay > 0: time.sleep(delay)
+			else:
+				# Keep at most one record queued, so flow control still holds the rest back
+				while self.device.incoming: time.sleep(self.device.peer_char_time() or .001)
+			self.send(data)
+		self.done.set()
+
+def replay(path, speed = 1, execute = False, settle = 1.0):
+	"""
+	Replay a capture into a fresh interpreter and time its dispatches.
+
+	Parameters
+	----------
+	str - path - the capture file.
+	float - speed - Default: 1 - see ReplayPeer.
+	bool - execute - Default: False - run the commands that are dispatched. Off, they are only timed,
+						so a replay can't move files about on the machine running it.
+	float - settle - Default: 1.0 - time (s) without a dispatch after the last record before the interpreter is stopped.
+
+	Returns
+	-------
+	dict - records, rx_bytes, tx_bytes (sent by the interpreter), captured_tx_bytes, dispatched,
+		   elapsed (s) and latencies (s, one per dispatch).
+
+	Raises
+	------
+	ValueError - if the file is not a capture.
+	"""
+	records = list(qpaceCapture.read(path))
+	rx = [(tick, data) for direction, tick, data in records if direction == qpaceCapture.RX]
+	captured_tx = sum(len(data) for direction, tick, data in records if direction == qpaceCapture.TX)
+
+	device = fake.attach(ReplayDevice(), I2C_ADDR_WTC, I2C_BUS, CCDR_IRQ)
+	peer = device.connect(ReplayPeer(rx, speed))
+
+	# The capture's TIMESTAMP must not set the clock of the machine running the replay
+	qpaceClock.SET_SYSTEM_CLOCK = False
+
+	latencies = []
+	dispatched = []
+	command = qpaceInterpreter.processCommand
+	def timed(chip, fieldData, fromWhom = 'CCDR'):
+		now = time.monotonic()
+		if device.arrived is not None: latencies.append(now - device.arrived)
+		dispatched.append(now)
+		if execute: command(chip, fieldData, fromWhom)
+	qpaceInterpreter.processCommand = timed
+
+	chip = qpaceWTCHandler.initWTCConnection()
+	experimentEvent = threading.Event()
+	runEvent = threading.Event()
+	shutdownEvent = threading.Event()
+	runEvent.set()
+	interpreter = threading.Thread(target = qpaceInterpreter.run, args = (chip, experimentEvent, runEvent, shutdownEvent), daemon = True)
+	interpreter.start()
+	player = threading.Thread(target = peer.play, daemon = True)
+	player.start()
+
+	peer.done.wait()
+	while True:
+		last = max(dispatched[-1] if dispatched else 0, device.arrived or 0)
+		if time.monotonic() - last >= settle: break
+		time.sleep(settle / 10)
+	shutdownEvent.set()
+	interpreter.join()
+	qpaceInterpreter.processCommand = command
+
+	return {
+		'records': len(records),
+		'rx_bytes': sum(len(data) for tick, data in rx),
+		'tx_bytes': len(peer.rx),
+		'captured_tx_bytes': captured_tx,
+		'dispatched': len(dispatched),
+		'elapsed': (dispatched[-1] if dispatched else time.monotonic()) - peer.started,
+		'latencies': latencies,
+	}
+
+def main(argv = None):
+	parser = argparse.ArgumentParser(description = 'Replay a WTC link capture into the interpreter.')
+	parser.add_argument('capture', help = 'capture file written by qpaceCapture')
+	parser.add_argument('--speed', type = float, default = 1, help = 'replay speed, 1 as recorded, 0 as fast as possible')
+	parser.add_argument('--execute', action = 'store_true', help = 'run dispatched commands instead of only timing them')
+	parser.add_argument('--settle', type = float, default = 1.0, help = 'seconds without a dispatch before stopping')
+	parser.add_argument('--save', metavar = 'FILE', help = 'write the results as JSON')
+	parser.add_argument('--compare', metavar = 'FILE', help = 'compare against saved results, exit 1 on a regression')
+	parser.add_argument('--tolerance', type = float, default = .2, help = 'allowed fractional regression for --compare')
+	args = parser.parse_args(argv)
+
+	run = replay(args.capture, args.speed, args.execute, args.settle)
+	results = Results()
+	bench = 'replay'
+	results.add(bench, 'dispatched', run['dispatched'], 'commands')
+	results.add(bench, 'throughput', run['dispatched'] / run['elapsed'] if run['elapsed'] > 0 else 0, 'commands/s')
+	if run['latencies']:
+		for name, fraction in (('p50', .5), ('p90', .9), ('p99', .99), ('max', 1)):
+			results.add(bench, 'latency_' + name, percentile(run['latencies'], fraction) * 1000, 'ms', higher = False)
+	if run['tx_bytes'] != run['captured_tx_bytes']:
+		print('The interpreter sent {} bytes, the capture has {}.'.format(run['tx_bytes'], run['captured_tx_bytes']))
+	if args.save: results.save(args.save)
+	if args.compare:
+		regressions = results.compare(args.compare, args.tolerance)
+		for bench, name, old, new, unit in regressions:
+			print('REGRESSION {} {}: {:.3f} -> {:.3f} {}'.format(bench, name, old, new, unit))
+		return 1 if regressions else 0
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
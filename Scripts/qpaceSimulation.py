@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+# qpaceSimulation.py
+# Q-Pace project, Center for Microgravity Research
+# University of Central Florida
+#
+# Simulated time for the virtual hardware in qpaceFakePigpio. Code run under a Simulation sees
+# stand-ins for the time and threading modules: time.monotonic() is the simulated clock, and
+# time.sleep() and every timeout move it forward without waiting. Threads are real, but only one
+# runs at a time and they only switch where one blocks (a sleep, a lock, a condition, an event or
+# a join). The clock only moves once every thread is blocked, straight to the earliest timeout.
+#
+# Running the code itself takes no simulated time, so what a run measures is the time modelled
+# by the fake (I2C transactions, characters on the line, callback latency), and the same run
+# gives the same numbers on any host under any load.
+#
+# Usage:
+#	import qpaceSimulation
+#	result = qpaceSimulation.run(func, arg, modules = [qpaceFakePigpio, SC16IS750])
+
+import heapq
+import itertools
+import threading
+import time
+import collections
+
+class Deadlock(RuntimeError):
+	"""Every thread of the simulation is blocked with no timeout to wake one."""
+
+class _Task():
+	# A thread taking part in the simulation, with the semaphore it waits on for its turn
+	def __init__(self, thread):
+		self.thread = thread
+		self.go = threading.Semaphore(0)
+		self.token = None     # Identifies the current wait, so a timer from an earlier one is ignored
+		self.waiting = False
+		self.timedout = False
+		self.waitlist = None  # The deque of waiters this task is queued on
+		self.finished = False
+		self.joiners = collections.deque()
+		self.error = None
+
+class Simulation():
+	"""
+	Clock and scheduler for one simulated run. See the module comment.
+
+	Parameters
+	----------
+	float - start - Default: 1000.0 - simulated time.monotonic() when the run starts.
+	"""
+
+	def __init__(self, start = 1000.0):
+		self.now = start
+		self.seq = itertools.count()
+		self.timers = []                  # heap of (time, token, task)
+		self.ready = collections.deque()  # tasks to run, in the order they were woken
+		self.current = None               # task holding the turn
+		self.main = None
+		self.time = SimulatedTime(self)
+		self.threading = SimulatedThreading(self)
+
+	def run(self, func, *args):
+		"""
+		Run func(*args) in the calling thread as the simulation's first thread.
+
+		Returns
+		-------
+		whatever func returns. Threads it started and did not stop stay blocked for good.
+		"""
+		self.main = _Task(threading.current_thread())
+		self.current = self.main
+		try:
+			return func(*args)
+		finally:
+			self.main.finished = True
+
+	def block(self, task, waitlist, timeout):
+		"""
+		Give up the turn until task is woken or timeout (s, None for ever) has passed on the simulated clock.
+		task must already be on waitlist, if it has one.
+
+		Returns
+		-------
+		bool - False if the timeout ran out.
+		"""
+		task.token = next(self.seq)
+		task.waiting = True
+		task.timedout = False
+		task.waitlist = waitlist
+		if timeout is not None:
+			heapq.heappush(self.timers, (self.now + max(timeout, 0), task.token, task))
+		self.switch(task)
+		if task.error is not None:
+			error, task.error = task.error, None
+			raise error
+		return not task.timedout
+
+	def wake(self, task):
+		if task.waiting:
+			task.waiting = False
+			self.ready.append(task)
+
+	# Next task to run: the longest woken, otherwise the one whose timeout runs out first. None if there is neither
+	def next(self):
+		while self.ready or self.timers:
+			if self.ready: return self.ready.popleft()
+			t, token, task = heapq.heappop(self.timers)
+			if token != task.token or not task.waiting: continue # Woken before its timeout
+			self.now = max(self.now, t)
+			task.waiting = False
+			task.timedout = True
+			if task.waitlist is not None and task in task.waitlist: task.waitlist.remove(task)
+			return task
+		return None
+
+	def switch(self, task):
+		following = self.next()
+		if following is None:
+			task.waiting = False
+			raise Deadlock("Every simulated thread is blocked at " + str(self.now) + ".")
+		if following is task: return
+		self.current = following
+		following.go.release()
+		task.go.acquire()
+
+	def start(self, task, func):
+		self.ready.append(task)
+		real = threading.Thread(target = self.bootstrap, args = (task, func), name = task.thread.name, daemon = True)
+		real.start()
+
+	def bootstrap(self, task, func):
+		task.go.acquire()
+		try:
+			func()
+		finally:
+			self.exit(task)
+
+	def exit(self, task):
+		task.finished = True
+		while task.joiners: self.wake(task.joiners.popleft())
+		following = self.next()
+		if following is None and self.main is not None and not self.main.finished:
+			# The main thread is blocked for good: wake it with the error rather than hang
+			self.main.error = Deadlock("Every simulated thread is blocked at " + str(self.now) + ".")
+			self.main.waiting = False
+			following = self.main
+		if following is not None:
+			self.current = following
+			following.go.release()
+
+class SimulatedTime():
+	"""Stands in for the time module. Anything but monotonic and sleep is the real one."""
+
+	def __init__(self, sim):
+		self.sim = sim
+
+	def monotonic(self):
+		return self.sim.now
+
+	def sleep(self, seconds):
+		self.sim.block(self.sim.current, None, seconds)
+
+	def __getattr__(self, name):
+		return getattr(time, name)
+
+class SimulatedThreading():
+	"""Stands in for the threading module, with primitives that block on the simulated clock."""
+
+	def __init__(self, sim):
+		self.sim = sim
+
+	def Lock(self):
+		return Lock(self.sim)
+
+	def RLock(self):
+		return RLock(self.sim)
+
+	def Condition(self, lock = None):
+		return Condition(self.sim, lock)
+
+	def Event(self):
+		return Event(self.sim)
+
+	def Thread(self, group = None, target = None, name = None, args = (), kwargs = None, daemon = None):
+		return Thread(self.sim, target, name, args, kwargs, daemon)
+
+	def current_thread(self):
+		task = self.sim.current
+		return threading.current_thread() if task is None else task.thread
+
+	def __getattr__(self, name):
+		return getattr(threading, name)
+
+class Lock():
+	def __init__(self, sim):
+		self.sim = sim
+		self.owner = None
+		self.waiters = collections.deque()
+
+	def acquire(self, blocking = True, timeout = -1):
+		me = self.sim.current
+		if self.owner is None:
+			self.owner = me
+			return True
+		if not blocking: return False
+		self.waiters.append(me)
+		# release() hands the lock straight to the first waiter
+		return self.sim.block(me, self.waiters, None if timeout < 0 else timeout)
+
+	def release(self):
+		if self.owner is None: raise RuntimeError("release unlocked lock")
+		self.owner = None
+		if self.waiters:
+			self.owner = self.waiters.popleft()
+			self.sim.wake(self.owner)
+
+	def locked(self):
+		return self.owner is not None
+
+	# For Condition: release completely, then put back as it was
+	def _release_save(self):
+		self.release()
+		return None
+
+	def _acquire_restore(self, saved):
+		self.acquire()
+
+	def __enter__(self):
+		self.acquire()
+		return self
+
+	def __exit__(self, *args):
+		self.release()
+
+class RLock(Lock):
+	def __init__(self, sim):
+		super().__init__(sim)
+		self.count = 0
+
+	def acquire(self, blocking = True, timeout = -1):
+		if self.owner is self.sim.current and self.owner is not None:
+			self.count += 1
+			return True
+		if not super().acquire(blocking, timeout): return False
+		self.count = 1
+		return True
+
+	def release(self):
+		if self.owner is not self.sim.current: raise RuntimeError("cannot release un-acquired lock")
+		self.count -= 1
+		if self.count == 0: super().release()
+
+	def _release_save(self):
+		count = self.count
+		self.count = 1
+		self.release()
+		return count
+
+	def _acquire_restore(self, count):
+		self.acquire()
+		self.count = count
+
+class Condition():
+	def __init__(self, sim, lock = None):
+		self.sim = sim
+		self.lock = lock if lock is not None else RLock(sim)
+		self.waiters = collections.deque()
+
+	def acquire(self, *args):
+		return self.lock.acquire(*args)
+
+	def release(self):
+		self.lock.release()
+
+	def __enter__(self):
+		self.lock.acquire()
+		return self
+
+	def __exit__(self, *args):
+		self.lock.release()
+
+	def wait(self, timeout = None):
+		me = self.sim.current
+		saved = self.lock._release_save()
+		self.waiters.append(me)
+		try:
+			return self.sim.block(me, self.waiters, timeout)
+		finally:
+			self.lock._acquire_restore(saved)
+
+	def wait_for(self, predicate, timeout = None):
+		deadline = None if timeout is None else self.sim.now + timeout
+		result = predicate()
+		while not result:
+			remaining = None
+			if deadline is not None:
+				remaining = deadline - self.sim.now
+				if remaining <= 0: break
+			self.wait(remaining)
+			result = predicate()
+		return result
+
+	def notify(self, n = 1):
+		for i in range(min(n, len(self.waiters))):
+			self.sim.wake(self.waiters.popleft())
+
+	def notify_all(self):
+		self.notify(len(self.waiters))
+
+class Event():
+	def __init__(self, sim):
+		self.sim = sim
+		self.flag = False
+		self.waiters = collections.deque()
+
+	def is_set(self):
+		return self.flag
+
+	def set(self):
+		self.flag = True
+		while self.waiters: self.sim.wake(self.waiters.popleft())
+
+	def clear(self):
+		self.flag = False
+
+	def wait(self, timeout = None):
+		if self.flag: return True
+		me = self.sim.current
+		self.waiters.append(me)
+		self.sim.block(me, self.waiters, timeout)
+		return self.flag
+
+class Thread():
+	def __init__(self, sim, target = None, name = None, args = (), kwargs = None, daemon = None):
+		self.sim = sim
+		self.target = target
+		self.name = name or 'sim-' + str(next(sim.seq))
+		self.args = args
+		self.kwargs = kwargs or {}
+		self.daemon = daemon
+		self.task = None
+
+	def start(self):
+		if self.task is not None: raise RuntimeError("threads can only be started once")
+		self.task = _Task(self)
+		self.sim.start(self.task, lambda: self.target(*self.args, **self.kwargs) if self.target is not None else None)
+
+	def is_alive(self):
+		return self.task is not None and not self.task.finished
+
+	def join(self, timeout = None):
+		if self.task is None: raise RuntimeError("cannot join thread before it is started")
+		if self.task.finished: return
+		me = self.sim.current
+		self.task.joiners.append(me)
+		self.sim.block(me, self.task.joiners, timeout)
+
+def run(func, *args, modules = ()):
+	"""
+	Run func(*args) on a new Simulation, with the time and threading of each module in modules
+	replaced by the simulation's while it runs. Objects those modules create during the run are
+	only good for the run.
+
+	Returns
+	-------
+	whatever func returns.
+	"""
+	sim = Simulation()
+	saved = []
+	for module in modules:
+		saved.append((module, module.__dict__.get('time'), module.__dict__.get('threading')))
+		if 'time' in module.__dict__: module.time = sim.time
+		if 'threading' in module.__dict__: module.threading = sim.threading
+	try:
+		return sim.run(func, *args)
+	finally:
+		for module, oldtime, oldthreading in saved:
+			if oldtime is not None: module.time = oldtime
+			if oldthreading is not None: module.threading = oldthreading
@@ -16,6 +16,7 @@ from datetime import datetime, date, timedelta
 from shutil import copy
 import threading
 import qpaceLogger as logger
+import qpaceClock
 import qpaceExperimentParser as exp
 import qpacePiCommands as cmd
 
@@ -194,7 +195,7 @@ def executeTodoList(chip,todo_list, experimentEvent = None):
 		while todo_list:
 			# How many seconds until our next task?
 			try:
-				wait_time = (todo_list[0][0] - datetime.now()).total_seconds() # Determine how long to wait.
+				wait_time = (todo_list[0][0] - datetime.fromtimestamp(qpaceClock.now())).total_seconds() # Determine how long to wait.
 			except:
 				todo_list = todo_list[1:] # IF there is a problem determining when to execute, remove it from the list.
 			else:
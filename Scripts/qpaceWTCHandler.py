@@ -14,6 +14,10 @@ import qpaceTODOParser as todo
 import os
 import threading
 import SC16IS750 as SC16IS750
+import surfsatStates as ss
+import qpaceChecksum
+import qpaceCapture
+from qpaceLinkManager import LinkManager
 import pigpio
 import time
 
@@ -22,6 +26,93 @@ time.sleep(2)
 gpio = pigpio.pi()
 WHO_FILEPATH = '/home/pi/WHO'
 CCDR_IRQ = 16 #BCM 16, board 36
+I2C_BAUD_WTC = 115200 # UART baudrate the WTC link comes up at and falls back to
+BAUD_REPLY_TIMEOUT = .5 # Time (s) to wait for the WTC to answer during baud negotiation
+BAUD_SWITCH_SETTLE = .01 # Time (s) the WTC gets to reprogram its UART after echoing a baud change
+BAUD_TEST_PATTERN = bytes([0x55, 0xAA, 0x00, 0xFF, 0x0F, 0xF0, 0x33, 0xCC]) # Alternating bits show up sampling errors at the new rate
+IRQ_LATENCY = .002 # Expected time (s) to service the CCDR IRQ while the Pi is busy, e.g. with GoPro offload
+# Link settings, read from LINK_FILEPATH at boot by loadLinkSettings so they can be changed without editing code.
+# The file holds words separated by whitespace: RTSCTS once the WTC honours RTS/CTS on this link,
+# and baudrates to offer the WTC in place of the defaults. Missing or empty, the defaults below stay
+LINK_FILEPATH = '/home/pi/LINK'
+HW_FLOW_CONTROL = False
+# Faster rates offered to the WTC with RTS/CTS, fastest first. Exact divisors of the 11.0592 MHz crystal
+# Without RTS/CTS nothing can stop the WTC while the Pi is late to the IRQ. On simulated time qpaceBenchmark.py rx
+# overruns the FIFO from 345600 up, and at 230400 once the IRQ callback takes 1.5 ms, where 115200 stays clean
+# to about IRQ_LATENCY. So without flow control none are offered unless listed
+FLOW_CONTROL_BAUD_CANDIDATES = (691200, 345600, 230400)
+WTC_BAUD_CANDIDATES = ()
+# Set to a file path to record everything sent and received on the WTC link, for qpaceReplay.py
+CAPTURE_PATH = None
+# Frame checksums offered to the WTC, preferred first. FNV-1a is always the fallback
+CHECKSUM_CANDIDATES = ('crc32',)
+# UART carrying each route as (I2C address, SC16IS752 channel, IRQ GPIO). Routes on different UARTs run in parallel.
+# Only the WTC link is fitted today; both channels of an SC16IS752 would share an address and IRQ.
+ROUTE_LINKS = {
+	'WTCROUTE': (0x4c, 0, CCDR_IRQ),
+}
+
+def uartConfig(baudrate = I2C_BAUD_WTC):
+	"""
+	Register values to program along with the line settings of a UART facing the WTC.
+
+	Reset and enable the FIFOs, set the RX FIFO trigger level through TLR and enable RX error and RX ready interrupts.
+	The trigger level leaves room for the bytes that arrive during IRQ_LATENCY plus one TX burst
+	holding the bus (SC16IS750.tx_hold_time), 24 bytes at 115200.
+	These go out in the same I2C transaction as the divisor latch and line settings.
+
+	Parameters
+	----------
+	int - baudrate - Default: I2C_BAUD_WTC - the UART baudrate the levels are worked out for.
+
+	Returns
+	-------
+	dict - register name: value, for the config argument of SC16IS750.SC16IS750.
+	"""
+	trigger, halt, resume = SC16IS750.flow_control_levels(baudrate, IRQ_LATENCY)
+	fcr = SC16IS750.FCR_TX_FIFO_RESET | SC16IS750.FCR_RX_FIFO_RESET | SC16IS750.FCR_FIFO_ENABLE
+	ier = SC16IS750.IER_RX_ERROR | SC16IS750.IER_RX_READY
+	config = {'fcr': fcr, 'ier': ier, 'tlr': SC16IS750.tlr_value(rx = trigger)}
+	if HW_FLOW_CONTROL:
+		config['tcr'] = SC16IS750.tcr_value(halt, resume)
+		config['efr'] = SC16IS750.EFR_ENHANCED_FUNCTIONS_ENABLE | SC16IS750.EFR_FLOW_CONTROL_RTS_ENABLE | SC16IS750.EFR_FLOW_CONTROL_CTS_ENABLE
+	return config
+
+def loadLinkSettings(path = LINK_FILEPATH):
+	"""
+	Set HW_FLOW_CONTROL and WTC_BAUD_CANDIDATES from the link settings file. Call before the link is opened.
+
+	Parameters
+	----------
+	str - path - Default: LINK_FILEPATH - the settings file, see LINK_FILEPATH.
+
+	Returns
+	-------
+	tuple - (bool - RTS/CTS in use, tuple of int - baudrates negotiateBaudrate offers, fastest first).
+	"""
+	global HW_FLOW_CONTROL, WTC_BAUD_CANDIDATES
+	try:
+		with open(path,'r') as f:
+			words = f.read().split()
+	except OSError:
+		words = []
+	rates = []
+	flowControl = False
+	for word in words:
+		if word.upper() == 'RTSCTS':
+			flowControl = True
+		elif word.isdigit():
+			rates.append(int(word))
+		else:
+			logger.logSystem([["LinkSettings: Ignoring '" + word + "' in " + path + "."]])
+	HW_FLOW_CONTROL = flowControl
+	if rates:
+		WTC_BAUD_CANDIDATES = tuple(sorted(set(rates), reverse = True))
+	else:
+		WTC_BAUD_CANDIDATES = FLOW_CONTROL_BAUD_CANDIDATES if flowControl else ()
+	logger.logSystem([["LinkSettings: RTS/CTS " + ("on" if HW_FLOW_CONTROL else "off") + ", offering " + (", ".join(str(rate) for rate in WTC_BAUD_CANDIDATES) or "no faster baudrate") + "."]])
+	return (HW_FLOW_CONTROL, WTC_BAUD_CANDIDATES)
+
 def initWTCConnection():
 	"""
 	This function Initializes and returns the SC16IS750 object to interact with the registers.
@@ -42,29 +133,190 @@ def initWTCConnection():
 	I2C_BUS = 1 # I2C bus identifier
 	CCDR_IRQ = 16 #BCM 16, board 36
 	I2C_ADDR_WTC = 0x4c#0x48 # I2C addresses for WTC comm chips
-	I2C_BAUD_WTC = 115200 # UART baudrates for WTC comm chips
 	XTAL_FREQ = 11059200#1843200 # Crystal frequency for comm chips
 	DATA_BITS = SC16IS750.LCR_DATABITS_8
 	STOP_BITS = SC16IS750.LCR_STOPBITS_1
 	PARITY_BITS = SC16IS750.LCR_PARITY_NONE
 
 	# init the chip
-	chip = SC16IS750.SC16IS750(gpio,I2C_BUS,I2C_ADDR_WTC, XTAL_FREQ, I2C_BAUD_WTC, DATA_BITS, STOP_BITS, PARITY_BITS)
+	chip = SC16IS750.SC16IS750(gpio,I2C_BUS,I2C_ADDR_WTC, XTAL_FREQ, I2C_BAUD_WTC, DATA_BITS, STOP_BITS, PARITY_BITS, config = uartConfig(I2C_BAUD_WTC))
 
-	# Reset TX and RX FIFOs
-	fcr = SC16IS750.FCR_TX_FIFO_RESET | SC16IS750.FCR_RX_FIFO_RESET
-	chip.byte_write(SC16IS750.REG_FCR, fcr)
-	time.sleep(2.0/XTAL_FREQ)
+	return chip
 
-	# Enable FIFOs and set RX FIFO trigger level
-	fcr = SC16IS750.FCR_FIFO_ENABLE | SC16IS750.FCR_RX_TRIGGER_56_BYTES
-	chip.byte_write(SC16IS750.REG_FCR, fcr)
+def initLinks(links = ROUTE_LINKS):
+	"""
+	Open a UART link for every route in links, each with its own RX engine, RX stream and TX queue.
 
-	# Enable RX error and RX ready interrupts
-	ier = SC16IS750.IER_RX_ERROR | SC16IS750.IER_RX_READY
-	chip.byte_write_verify(SC16IS750.REG_IER, ier)
+	run() does not call this yet. The WTC is the only UART fitted, and qpaceInterpreter.run receives on it
+	through an RXRing engine of its own (chunks read straight into ring slots, the WTC held off when the
+	ring fills). A Link would attach a second engine to the same FIFO, so the two can't share the chip.
+	Switch run() over once a second UART is fitted and the interpreter can take its route's Link.
 
-	return chip
+	Parameters
+	----------
+	dict - links - Default: ROUTE_LINKS - route name: (I2C address, SC16IS752 channel, IRQ GPIO).
+
+	Returns
+	-------
+	LinkManager - send, recv and select by route name.
+
+	Raises
+	------
+	Any exceptions are passed up the call stack.
+	"""
+	manager = LinkManager(gpio)
+	for route, (address, channel, irq) in links.items():
+		manager.open(route, address, irq, channel, baudrate = I2C_BAUD_WTC, config = uartConfig(I2C_BAUD_WTC))
+	return manager
+
+def readHandshake(chip, request, timeout = BAUD_REPLY_TIMEOUT):
+	"""
+	Read the WTC's answer to a handshake request: len(request) bytes, starting at the first copy of
+	the request's command byte. Bytes before that are not part of the handshake (a WTC state byte sent
+	while the request was on its way, say), nor are any after the answer. They are returned separately
+	so the caller can hand them back with chip.unread once it is done switching the link.
+
+	Parameters
+	----------
+	SC16IS750 - chip - the chip connected to the WTC.
+	bytes - request - what was sent. Its first byte is the command the answer starts with.
+	float - timeout - time (s) to wait for the whole answer.
+
+	Returns
+	-------
+	bytearray - the answer, short (empty if the WTC never started one) when the timeout expired.
+	bytearray - every other byte received, in order.
+	"""
+	deadline = time.monotonic() + timeout
+	reply = bytearray()
+	stray = bytearray()
+	while len(reply) < len(request):
+		remaining = deadline - time.monotonic()
+		if remaining <= 0: break
+		data = chip.read_some(remaining)
+		if len(reply) == 0:
+			start = data.find(request[:1])
+			if start < 0:
+				stray += data
+				continue
+			stray += data[:start]
+			data = data[start:]
+		reply += data
+	stray += reply[len(request):]
+	del reply[len(request):]
+	return reply, stray
+
+def negotiateBaudrate(chip, candidates = None, timeout = BAUD_REPLY_TIMEOUT):
+	"""
+	Offer the WTC faster UART baudrates and switch the link to the fastest one that works.
+
+	For each candidate the Pi sends BAUDCHANGE followed by the baudrate (4 bytes, big endian).
+	The WTC echoes those 5 bytes to accept, anything else declines that rate. After the echo both
+	sides switch, and the Pi sends BAUDCONFIRM and BAUD_TEST_PATTERN at the new rate, which the WTC
+	must echo back unchanged. If the echo is wrong or late, both sides drop back to the rate they
+	started at (the WTC on its own, once it has not seen a good BAUDCONFIRM within the timeout).
+	No answer at all means the WTC does not know BAUDCHANGE, so negotiation stops there.
+	Bytes that arrive but are not part of an answer (see readHandshake) are handed back with chip.unread
+	when this returns, for the interpreter to handle as usual.
+
+	Parameters
+	----------
+	SC16IS750 - chip - the chip connected to the WTC. Nothing else may read from it while this runs.
+	tuple of int - candidates - Default: None - baudrates to offer, fastest first, WTC_BAUD_CANDIDATES if None.
+							 Rates that are no faster than the current one, or that the crystal can not generate, are skipped.
+	float - timeout - time (s) to wait for each answer from the WTC.
+
+	Returns
+	-------
+	int - the baudrate the link is running at.
+
+	Raises
+	------
+	Any exceptions are passed up the call stack.
+	"""
+	if candidates is None: candidates = WTC_BAUD_CANDIDATES
+	original = chip.baudrate
+	stray = bytearray()
+	for baudrate in candidates:
+		error = chip.baud_error(baudrate)
+		if baudrate <= original or error is None or error > SC16IS750.BAUD_TOLERANCE:
+			continue
+		request = bytes([ss.SSCOMMAND['BAUDCHANGE']]) + baudrate.to_bytes(4, byteorder='big')
+		chip.write_all(request)
+		reply, other = readHandshake(chip, request, timeout)
+		stray += other
+		if len(reply) == 0:
+			logger.logSystem([["BaudRate: WTC did not answer BAUDCHANGE, staying at " + str(original) + "."]])
+			break
+		if reply != request:
+			logger.logSystem([["BaudRate: WTC declined " + str(baudrate) + "."]])
+			continue
+		# The request has to finish shifting out at the old rate before the divisor changes
+		chip.wait_tx_empty(timeout)
+		chip.set_baudrate(baudrate)
+		time.sleep(BAUD_SWITCH_SETTLE)
+
+		confirm = bytes([ss.SSCOMMAND['BAUDCONFIRM']]) + BAUD_TEST_PATTERN
+		chip.write_all(confirm)
+		echo, other = readHandshake(chip, confirm, timeout)
+		if echo == confirm:
+			stray += other
+			# The RX trigger level depends on how fast bytes arrive, so retune it for the new rate
+			if HW_FLOW_CONTROL:
+				chip.enable_flow_control(IRQ_LATENCY)
+			else:
+				trigger, halt, resume = SC16IS750.flow_control_levels(baudrate, IRQ_LATENCY, chip.char_bits())
+				chip.set_trigger_levels(rx = trigger)
+			logger.logSystem([["BaudRate: WTC link is now running at " + str(baudrate) + "."]])
+			chip.unread(stray)
+			return baudrate
+
+		logger.logError("BaudRate: Echo check failed at " + str(baudrate) + ", falling back to " + str(original) + ".")
+		# Give the WTC time to fall back too, then discard whatever arrived at the wrong rate (other included)
+		time.sleep(timeout)
+		chip.set_baudrate(original)
+	chip.unread(stray)
+	return chip.baudrate
+
+def negotiateChecksum(chip, candidates = CHECKSUM_CANDIDATES, timeout = BAUD_REPLY_TIMEOUT):
+	"""
+	Offer the WTC other frame checksums and switch to the first one it accepts.
+
+	For each candidate the Pi sends CHECKSUMCHANGE followed by the algorithm ID from qpaceChecksum.ALGORITHMS.
+	The WTC echoes those 2 bytes to accept, anything else declines. No answer at all means the WTC
+	does not know CHECKSUMCHANGE, so negotiation stops there and FNV-1a stays.
+	Bytes that are not part of an answer are handed back with chip.unread, as in negotiateBaudrate.
+
+	Parameters
+	----------
+	SC16IS750 - chip - the chip connected to the WTC. Nothing else may read from it while this runs.
+	tuple of str - candidates - algorithm names to offer, preferred first.
+	float - timeout - time (s) to wait for each answer from the WTC.
+
+	Returns
+	-------
+	str - the algorithm the link uses from now on.
+
+	Raises
+	------
+	Any exceptions are passed up the call stack.
+	"""
+	stray = bytearray()
+	for name in candidates:
+		request = bytes([ss.SSCOMMAND['CHECKSUMCHANGE'], qpaceChecksum.ALGORITHMS[name]])
+		chip.write_all(request)
+		reply, other = readHandshake(chip, request, timeout)
+		stray += other
+		if len(reply) == 0:
+			logger.logSystem([["Checksum: WTC did not answer CHECKSUMCHANGE, staying with " + qpaceChecksum.algorithm + "."]])
+			break
+		if reply == request:
+			qpaceChecksum.setAlgorithm(name)
+			logger.logSystem([["Checksum: Frames now use " + name + "."]])
+			break
+		logger.logSystem([["Checksum: WTC declined " + name + "."]])
+	chip.unread(stray)
+	return qpaceChecksum.algorithm
 
 def run():
 	try:
@@ -87,7 +339,11 @@ def run():
 	except OSError:
 		identity = '0'
 	logger.logSystem([["Identity determined as Pi: " + str(identity)]])
+	loadLinkSettings()
 	chip = initWTCConnection()
+	if chip and CAPTURE_PATH:
+		chip.capture = qpaceCapture.Capture(CAPTURE_PATH, gpio)
+		logger.logSystem([["Capturing the WTC link to " + CAPTURE_PATH]])
 	if chip:
 		#chip.byte_write(SC16IS750.REG_THR, ord(identity)) # Send the identity to the WTC
 		#TODO Implement identity on the WTC
@@ -148,6 +404,7 @@ def run():
 		shutdownEvent.set()
 		interpreter.join()
 		#todoParser.join()
+		if chip.capture is not None: chip.capture.close()
 		#os.system('sudo halt') # Shutdown.
 
 if __name__ == '__main__':
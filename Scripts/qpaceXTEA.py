@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# qpaceXTEA.py
+# Q-Pace project, Center for Microgravity Research
+# University of Central Florida
+#
+# XTEA (64 bit blocks, 128 bit key, 32 cycles) for the privileged NOOP* and NOOP< commands.
+# Blocks are big endian and enciphered independently (ECB), so any number of blocks from any
+# number of frames can be done in one pass. Data that is not a whole number of blocks, like the
+# 118 byte information field, keeps its length through ciphertext stealing.
+#
+# Usage:
+#	xtea = Cipher(key)                      # the round keys are worked out once, here
+#	information = xtea.decrypt(fieldData.information)
+#	frames = xtea.encrypt_frames(buffer, 118)   # every frame in buffer, NumPy if it's installed
+#	cipher().encrypt(data)                  # with the key in KEY_PATH
+
+import struct
+
+try:
+	import numpy
+except ImportError:
+	numpy = None # The batch functions fall back to one block at a time
+
+KEY_PATH = "/home/pi/XTEAKEY" # 16 bytes, never sent over the link
+BLOCK_SIZE = 8
+KEY_SIZE = 16
+CYCLES = 32
+DELTA = 0x9E3779B9
+MASK = 0xFFFFFFFF
+
+class Cipher():
+	"""
+	XTEA with the key schedule worked out up front.
+
+	Every round adds one of four key words to a running sum, and which word it is only depends on
+	the sum. Both are the same for every block, so each round's (sum + key word) is computed once
+	here and the per-block loops only do the Feistel arithmetic.
+
+	Parameters
+	----------
+	bytes - key - 16 bytes, read as four big endian words.
+	int - cycles - Default: 32 - XTEA cycles (two Feistel rounds each).
+
+	Raises
+	------
+	ValueError - if the key is not 16 bytes.
+	"""
+
+	def __init__(self, key, cycles = CYCLES):
+		if len(key) != KEY_SIZE:
+			raise ValueError("An XTEA key is " + str(KEY_SIZE) + " bytes, got " + str(len(key)) + ".")
+		words = struct.unpack('>4I', key)
+		self.cycles = cycles
+		self.schedule = [] # (round key for v0, round key for v1) per cycle, in encryption order
+		total = 0
+		for i in range(cycles):
+			first = (total + words[total & 3]) & MASK
+			total = (total + DELTA) & MASK
+			self.schedule.append((first, (total + words[(total >> 11) & 3]) & MASK))
+		self.reverse = self.schedule[::-1]
+		if numpy is not None:
+			self.keys = numpy.array(self.schedule, dtype=numpy.uint32)
+
+	def encrypt_block(self, v0, v1):
+		for first, second in self.schedule:
+			v0 = (v0 + ((((v1 << 4) ^ (v1 >> 5)) + v1) ^ first)) & MASK
+			v1 = (v1 + ((((v0 << 4) ^ (v0 >> 5)) + v0) ^ second)) & MASK
+		return v0, v1
+
+	def decrypt_block(self, v0, v1):
+		for first, second in self.reverse:
+			v1 = (v1 - ((((v0 << 4) ^ (v0 >> 5)) + v0) ^ second)) & MASK
+			v0 = (v0 - ((((v1 << 4) ^ (v1 >> 5)) + v1) ^ first)) & MASK
+		return v0, v1
+
+	def _blocks(self, data, function):
+		# Run function over every block of data, a whole number of blocks
+		count = len(data) // 4
+		words = list(struct.unpack('>' + str(count) + 'I', data))
+		for i in range(0, count, 2):
+			words[i], words[i+1] = function(words[i], words[i+1])
+		return struct.pack('>' + str(count) + 'I', *words)
+
+	def encrypt(self, data):
+		"""
+		Encrypt one frame's worth of data (e.g. an information field) without NumPy.
+
+		Whole blocks are enciphered as they are. A short last block steals the end of the block
+		before it, so the ciphertext is exactly as long as the data. Data shorter than one block
+		is padded with zeros up to a block first.
+
+		Returns
+		-------
+		bytes - the ciphertext.
+		"""
+		data = bytes(data)
+		if len(data) < BLOCK_SIZE: data = data + bytes(BLOCK_SIZE - len(data))
+		extra = len(data) % BLOCK_SIZE
+		if extra == 0: return self._blocks(data, self.encrypt_block)
+		whole = len(data) - extra
+		head = self._blocks(data[:whole], self.encrypt_block)
+		last = head[-BLOCK_SIZE:]
+		stolen = self._blocks(data[whole:] + last[extra:], self.encrypt_block)
+		return head[:-BLOCK_SIZE] + stolen + last[:extra]
+
+	def decrypt(self, data):
+		"""
+		Decrypt what encrypt() produced.
+
+		Raises
+		------
+		ValueError - if the data is shorter than one block.
+		"""
+		data = bytes(data)
+		if len(data) < BLOCK_SIZE:
+			raise ValueError("XTEA ciphertext is at least " + str(BLOCK_SIZE) + " bytes, got " + str(len(data)) + ".")
+		extra = len(data) % BLOCK_SIZE
+		if extra == 0: return self._blocks(data, self.decrypt_block)
+		whole = len(data) - extra
+		stolen = self._blocks(data[whole-BLOCK_SIZE:whole], self.decrypt_block)
+		last = self._blocks(data[whole:] + stolen[extra:], self.decrypt_block)
+		return self._blocks(data[:whole-BLOCK_SIZE], self.decrypt_block) + last + stolen[:extra]
+
+	def _lanes(self, v0, v1, decrypt):
+		# v0 and v1 are uint32 arrays, one lane per block. uint32 arithmetic wraps, which is the mask.
+		if decrypt:
+			for first, second in self.keys[::-1]:
+				v1 -= (((v0 << 4) ^ (v0 >> 5)) + v0) ^ second
+				v0 -= (((v1 << 4) ^ (v1 >> 5)) + v1) ^ first
+		else:
+			for first, second in self.keys:
+				v0 += (((v1 << 4) ^ (v1 >> 5)) + v1) ^ first
+				v1 += (((v0 << 4) ^ (v0 >> 5)) + v0) ^ second
+
+	def _lanes_bytes(self, blocks, decrypt):
+		# blocks is a (n, 8) uint8 array. Returns a new (n, 8) uint8 array.
+		words = blocks.reshape(-1).view('>u4').astype(numpy.uint32).reshape(-1, 2)
+		v0 = words[:, 0].copy()
+		v1 = words[:, 1].copy()
+		self._lanes(v0, v1, decrypt)
+		out = numpy.empty((len(v0), 2), dtype='>u4')
+		out[:, 0] = v0
+		out[:, 1] = v1
+		return out.view(numpy.uint8).reshape(-1, BLOCK_SIZE)
+
+	def _frames(self, frames, size, decrypt):
+		view = memoryview(frames).cast('B')
+		if len(view) % size != 0:
+			raise ValueError("A buffer of " + str(len(view)) + " bytes is not a whole number of " + str(size) + " byte frames.")
+		if size < BLOCK_SIZE:
+			raise ValueError("Frames of " + str(size) + " bytes are shorter than an XTEA block.")
+		if numpy is None:
+			function = self.decrypt if decrypt else self.encrypt
+			return b''.join(function(view[offset:offset+size]) for offset in range(0, len(view), size))
+		data = numpy.frombuffer(view, dtype=numpy.uint8).reshape(-1, size)
+		extra = size % BLOCK_SIZE
+		whole = size - extra
+		out = numpy.empty_like(data)
+		if extra == 0:
+			out[:] = self._lanes_bytes(data, decrypt).reshape(-1, size)
+			return out.tobytes()
+		body = data[:, :whole].copy()
+		tail = data[:, whole:]
+		if decrypt:
+			# Undo the stealing first: the second to last block holds the short block and the end of the last whole one
+			stolen = self._lanes_bytes(body[:, whole-BLOCK_SIZE:], True)
+			body[:, whole-BLOCK_SIZE:whole-BLOCK_SIZE+extra] = tail
+			body[:, whole-BLOCK_SIZE+extra:] = stolen[:, extra:]
+			out[:, :whole] = self._lanes_bytes(body, True).reshape(-1, whole)
+			out[:, whole:] = stolen[:, :extra]
+		else:
+			body = self._lanes_bytes(body, False).reshape(-1, whole)
+			last = body[:, whole-BLOCK_SIZE:]
+			stolen = numpy.concatenate((tail, last[:, extra:]), axis=1)
+			out[:, :whole-BLOCK_SIZE] = body[:, :whole-BLOCK_SIZE]
+			out[:, whole:] = last[:, :extra]
+			out[:, whole-BLOCK_SIZE:whole] = self._lanes_bytes(stolen, False)
+		return out.tobytes()
+
+	def encrypt_frames(self, frames, size):
+		"""
+		Encrypt every frame in a buffer of back to back frames, each exactly as encrypt() would.
+
+		With NumPy every block of every frame goes through the 32 cycles together, one lane per block,
+		so the Python loop is over the cycles rather than over the blocks. This is what bulk privileged
+		transfers (a whole directory listing or file) should use.
+
+		Parameters
+		----------
+		bytes-like - frames - frames of size bytes each, back to back.
+		int - size - bytes per frame, at least one block.
+
+		Returns
+		-------
+		bytes - the encrypted frames, in the same order.
+
+		Raises
+		------
+		ValueError - if the buffer is not a whole number of frames or the frames are shorter than a block.
+		"""
+		return self._frames(frames, size, False)
+
+	def decrypt_frames(self, frames, size):
+		"""
+		Decrypt every frame in a buffer of back to back frames. See encrypt_frames.
+		"""
+		return self._frames(frames, size, True)
+
+_cipher = None
+
+def cipher(path = KEY_PATH):
+	"""
+	Return the Cipher for the key stored at path. The key is read and its schedule worked out only the first time.
+
+	Raises
+	------
+	OSError - if the key file can not be read.
+	ValueError - if the key file is not 16 bytes.
+	"""
+	global _cipher
+	if _cipher is None:
+		with open(path, 'rb') as f:
+			_cipher = Cipher(f.read())
+	return _cipher
@@ -17,6 +17,11 @@ SSCOMMAND = {
 	"DUMPDONE":       0x4B, # PI  Data dump completed
 	"SHUTDOWN":       0x46, # WTC Shutdown now!
 
+	"BAUDCHANGE":     0x50, # PI  Switch to the baudrate that follows (4 bytes, big endian). WTC echoes to accept
+	"BAUDCONFIRM":    0x51, # PI  Test pattern follows at the new baudrate. WTC echoes it back
+	"CHECKSUMCHANGE": 0x52, # PI  Use the checksum algorithm that follows (1 byte, qpaceChecksum.ALGORITHMS). WTC echoes to accept
+	"LINKSETUP":      0x53, # WTC Idle and able to answer BAUDCHANGE and CHECKSUMCHANGE. Sent once per boot
+
 	"SENDBACK":       0x60, # WTC Send data back
 	"CHUNK1":         0x61, # WTC Sending chunk 1
 	"CHUNK2":         0x62, # WTC Sending chunk 2